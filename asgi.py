@@ -0,0 +1,262 @@
+'''asgi entry point of the bookshelf api
+
+    uvicorn asgi:application --workers 4
+
+the flask app - same resources, same db - runs on a bounded pool of threads,
+as under bookshelf.wsgi. the lookup path differs: queries of isbns not in db
+and cover downloads run as coroutines on the event loop (async http client,
+coalesced by isbn), and requests waiting for a lookup wait as coroutines too,
+so pending lookups hold no threads:
+
+- GET /book/<isbn> is run with async=1. if the book has to be looked up (202),
+  the lookup is awaited, then /book/lookup/<job> is run to save and return it
+- GET /book/lookup/<job>?wait=n awaits the lookup, then is run with wait=0
+- POST /books/lookup is run once to list the isbns to look up, they're looked
+  up BOOKS_LOOKUP_CONCURRENCY at a time, then the request is run again with
+  the results, which it saves in one transaction
+
+clients asking for async=1 themselves get the 202 + job, as under wsgi.
+'''
+import re, os, sys, json, asyncio
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlencode
+
+# Change working directory so relative paths (and template lookup) work again
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append('./')
+
+import async_http
+if async_http.httpx is None:
+    raise ImportError('the asgi mode looks books up with httpx, see requirement.txt')
+
+from main import COVER_PIC_DIR
+try:
+    if not os.path.exists(COVER_PIC_DIR):
+        os.makedirs(COVER_PIC_DIR)
+except Exception as e:
+    print(e)
+
+import ext_book_service
+from main import app, LOOKUP_DEFERRED, LOOKUP_FOUND
+from ext_book_service import get_lookup, query_books_async
+from cover_pipeline import cover_fetcher
+
+_book_path = re.compile(r'/book/\d+$')
+_lookup_path = re.compile(r'/book/lookup/([^/]+)$')
+
+
+class AsgiApp(object):
+    '''asgi application of a flask app, awaiting its book lookups on the event loop
+
+    threads: flask requests run at a time
+    max_wait: upper bound of ?wait= on /book/lookup/<job>, seconds
+    lookup_concurrency: upstream queries in flight for one POST /books/lookup
+    '''
+
+    # a finished lookup being saved by another request is polled again this often, this many times
+    saving_poll = 0.05
+    saving_polls = 40
+
+    def __init__(self, wsgi_app, threads=16, max_wait=30, lookup_concurrency=8):
+        self.wsgi_app = wsgi_app
+        self.logger = getattr(wsgi_app, 'logger', None)
+        self.max_wait = max_wait
+        self.lookup_concurrency = lookup_concurrency
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='asgi')
+        self.loop = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        # servers not sending lifespan events
+        if self.loop is None:
+            self.attach(asyncio.get_running_loop())
+
+        body = await _read_body(receive)
+        status, headers, content = await self.handle(scope, body)
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': content})
+
+    def attach(self, loop):
+        '''run book queries and cover downloads on loop'''
+        self.loop = loop
+        ext_book_service.use_event_loop(loop)
+        cover_fetcher.use_event_loop(loop)
+
+    def detach(self):
+        self.loop = None
+        ext_book_service.use_event_loop(None)
+        cover_fetcher.use_event_loop(None)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.attach(asyncio.get_running_loop())
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.detach()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def handle(self, scope, body):
+        '''(status, headers, body) of a request'''
+        method = scope['method']
+        path = scope['path']
+        query = parse_qsl(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True)
+        names = set(k for k, _ in query)
+
+        if method == 'GET' and _book_path.match(path) and 'async' not in names:
+            status, headers, content = await self.run(scope, body, query + [('async', '1')])
+            job = _pending_job(status, content)
+            if job is None:
+                return status, headers, content
+            return await self.finish_lookup(scope, job)
+
+        m = _lookup_path.match(path)
+        if method == 'GET' and m is not None and 'wait' in names:
+            try:
+                wait = float(dict(query)['wait'])
+            except ValueError:
+                wait = 0
+            lookup = get_lookup(m.group(1))
+            if lookup is None:
+                # started by another worker: polled from db, on a thread
+                return await self.run(scope, body, query)
+            if wait > 0:
+                await _wait(lookup.future, min(wait, self.max_wait))
+            return await self.run(scope, body, [(k, v) for k, v in query if k != 'wait'])
+
+        if method == 'POST' and path == '/books/lookup':
+            deferred = []
+            status, headers, content = await self.run(scope, body, query, {LOOKUP_DEFERRED: deferred})
+            if len(deferred) == 0:
+                return status, headers, content
+            found = await query_books_async(deferred, self.lookup_concurrency, self.logger)
+            return await self.run(scope, body, query, {LOOKUP_FOUND: found})
+
+        return await self.run(scope, body, query)
+
+    async def finish_lookup(self, scope, job_id):
+        '''await lookup job_id, then (status, headers, body) of /book/lookup/<job_id>'''
+        lookup = get_lookup(job_id)
+        if lookup is not None:
+            await _wait(lookup.future)
+
+        scope = dict(scope, method='GET', path='/book/lookup/%s' % job_id)
+        for _ in range(self.saving_polls):
+            status, headers, content = await self.run(scope, b'', [])
+            if _pending_job(status, content) is None:
+                break
+            # finished, but being saved by another request
+            await asyncio.sleep(self.saving_poll)
+        return status, headers, content
+
+    async def run(self, scope, body, query, extra=None):
+        '''run the request on the flask app, in a thread of the pool'''
+        environ = _environ(scope, body, urlencode(query))
+        environ.update(extra or {})
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._call, environ)
+
+    def _call(self, environ):
+        started = []
+        chunks = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and started:
+                raise exc_info[1].with_traceback(exc_info[2])
+            started[:] = [status, headers]
+            return chunks.append
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            for chunk in result:
+                chunks.append(chunk)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+        status = int(started[0].split(' ', 1)[0])
+        headers = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in started[1]]
+        return status, headers, b''.join(chunks)
+
+
+async def _read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    return bytes(body)
+
+
+def _environ(scope, body, query_string):
+    '''wsgi environ (PEP 3333) of an asgi http scope'''
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': query_string,
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+            continue
+        key = 'HTTP_' + name
+        if key in environ:
+            # repeated header: one value, cookies are joined the way a single Cookie header lists them
+            value = environ[key] + ('; ' if key == 'HTTP_COOKIE' else ',') + value
+        environ[key] = value
+    environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
+
+
+def _pending_job(status, content):
+    '''job of a 202 lookup pending response, None for any other'''
+    if status != 202:
+        return None
+    try:
+        return json.loads(content).get('job')
+    except (ValueError, AttributeError):
+        return None
+
+
+def _consume(future):
+    # failures are reported by the request reading the result, not as never retrieved
+    if not future.cancelled():
+        future.exception()
+
+
+async def _wait(future, timeout=None):
+    '''wait for a concurrent future without a thread, at most timeout seconds'''
+    waiter = asyncio.wrap_future(future)
+    waiter.add_done_callback(_consume)
+    await asyncio.wait([waiter], timeout=timeout)
+
+
+application = AsgiApp(app, app.config['ASGI_THREADS'], app.config['BOOK_LOOKUP_MAX_WAIT'],
+                      app.config['BOOKS_LOOKUP_CONCURRENCY'])
@@ -0,0 +1,59 @@
+'''GET over asyncio, for the lookup path of the asgi mode
+
+by httpx, one pooled AsyncClient per event loop. a request waiting for its
+answer is a coroutine, not a thread, and redirects are followed like
+requests does.
+'''
+import asyncio
+from urllib.parse import urlencode
+
+try:
+    import httpx
+except ImportError:
+    # only the asgi mode needs it (asgi.py refuses to start without), wsgi runs without
+    httpx = None
+
+
+class HTTPError(Exception):
+    '''too many redirects, or a body larger than allowed'''
+
+
+class Response(object):
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers      # lower case names
+        self.content = content
+
+
+MAX_REDIRECTS = 10
+
+_clients = {}   # event loop -> httpx.AsyncClient
+
+
+async def http_get(url, params=None, headers=None, timeout=(3.05, 10), max_size=None):
+    '''GET url, returns a Response, raises OSError / asyncio.TimeoutError /
+    HTTPError if it failed. timeout: (connect, read) seconds
+    '''
+    if params:
+        url = url + ('&' if '?' in url else '?') + urlencode(params)
+
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = _clients[loop] = httpx.AsyncClient(follow_redirects=True, max_redirects=MAX_REDIRECTS)
+
+    try:
+        async with client.stream('GET', url, headers=headers,
+                                 timeout=httpx.Timeout(timeout[1], connect=timeout[0])) as r:
+            body = bytearray()
+            async for chunk in r.aiter_bytes():
+                body += chunk
+                if max_size is not None and len(body) > max_size:
+                    raise HTTPError('body larger than %d bytes' % max_size)
+            return Response(r.status_code, dict((k.lower(), v) for k, v in r.headers.items()), bytes(body))
+    except httpx.TimeoutException as e:
+        raise asyncio.TimeoutError(str(e))
+    except httpx.TooManyRedirects as e:
+        raise HTTPError(str(e))
+    except httpx.HTTPError as e:
+        raise OSError('%s: %s' % (type(e).__name__, e))
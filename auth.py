@@ -1,7 +1,57 @@
-from flask import request
-from sqlalchemy.exc import IntegrityError, DatabaseError
+import os, time, threading, calendar
+from datetime import datetime
+from flask import request, current_app
+from itsdangerous import URLSafeSerializer, BadSignature
+from sqlalchemy.exc import DatabaseError
 
-from dao import Token
+from dao import db, Token, RevokedToken
+from db_routing import reading
+from cache import TTLCache
+from utils import DATETIME_FORMAT
+from profiling import timed
+
+
+TOKEN_MODE_OPAQUE = 'opaque'    # random token, stored in table token
+TOKEN_MODE_SIGNED = 'signed'    # self-verifying token, signed by SECRET_KEY
+
+# token string -> AuthUser, entries never outlive Token.expire_time. a hit is still
+# checked against table token, other workers' revocations don't reach this cache
+_token_cache = TTLCache(maxsize=4096, ttl=300)
+
+# jti -> expire time of revoked signed tokens, reloaded from db periodically
+_denylist = {}
+_denylist_loaded_at = None
+_denylist_lock = threading.Lock()
+
+
+class AuthUser(object):
+    '''session independent view of the user owning a token'''
+
+    def __init__(self, id):
+        self.id = id
+
+    def __repr__(self):
+        return '<AuthUser {}>'.format(self.id)
+
+
+def init_token_cache(maxsize, ttl):
+    '''resize the token cache, called once from main with app config'''
+    _token_cache.configure(maxsize, ttl)
+
+
+def cache_token(token):
+    '''put a (new) token into cache, so its first use needs no db query'''
+    ttl = (token.expire_time - datetime.utcnow()).total_seconds()
+    _token_cache.set(token.token, AuthUser(token.user_id), ttl)
+
+
+def invalidate_token(str_token):
+    '''drop a token from cache, must be called whenever a token row is deleted'''
+    _token_cache.delete(str_token)
+
+
+def token_cache_stats():
+    return _token_cache.stats()
 
 
 def generate_token():
@@ -9,8 +59,111 @@ def generate_token():
     return ''.join('{:02x}'.format(x) for x in os.urandom(16))
 
 
-def check_bearer_token(auth):
-    '''get token from query string and check for expiration'''
+def _serializer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='access-token')
+
+
+def is_signed_token(str_token):
+    '''opaque tokens are plain hex, signed ones always contain a "."'''
+    return '.' in str_token
+
+
+def issue_signed_token(user_id, create_time, expire_time):
+    '''issue a self-verifying token, returns the same fields as Token.toJSON()'''
+    payload = {
+        'uid': user_id,
+        'exp': calendar.timegm(expire_time.utctimetuple()),
+        'jti': ''.join('{:02x}'.format(x) for x in os.urandom(8)),
+    }
+    return {
+        'token': _serializer().dumps(payload),
+        'user_id': user_id,
+        'create_time': create_time.strftime(DATETIME_FORMAT),
+        'expire_time': expire_time.strftime(DATETIME_FORMAT)
+    }
+
+
+def _load_signed_token(str_token):
+    try:
+        payload = _serializer().loads(str_token)
+        return payload['uid'], payload['exp'], payload['jti']
+    except (BadSignature, KeyError, TypeError):
+        raise RuntimeError({'result':-30, 'msg':'token not found'})
+
+
+def _is_revoked(jti):
+    global _denylist, _denylist_loaded_at
+
+    now = time.monotonic()
+    refresh = current_app.config.get('TOKEN_DENYLIST_REFRESH', 30)
+    with _denylist_lock:
+        if _denylist_loaded_at is None or now - _denylist_loaded_at > refresh:
+            with reading():
+                rs = RevokedToken.query.filter(RevokedToken.expire_time > datetime.utcnow()).all()
+            _denylist = {r.jti: r.expire_time for r in rs}
+            _denylist_loaded_at = now
+
+        return jti in _denylist
+
+
+def check_signed_token(str_token):
+    '''verify a signed token without touching the token table'''
+    uid, exp, jti = _load_signed_token(str_token)
+
+    if time.time() > exp:
+        raise RuntimeError({'result':-31, 'msg':'token expired'})
+
+    if _is_revoked(jti):
+        raise RuntimeError({'result':-30, 'msg':'token not found'})
+
+    return AuthUser(uid)
+
+
+def revoke_token(str_token):
+    '''revoke a token of either kind, returns False if it's unknown'''
+    if is_signed_token(str_token):
+        uid, exp, jti = _load_signed_token(str_token)
+        expire_time = datetime.utcfromtimestamp(exp)
+        if expire_time > datetime.utcnow():
+            db.session.merge(RevokedToken(jti, expire_time))
+            db.session.commit()
+            with _denylist_lock:
+                _denylist[jti] = expire_time
+        return True
+
+    invalidate_token(str_token)
+    token = Token.query.filter_by(token=str_token).first()
+    if token is None:
+        return False
+
+    db.session.delete(token)
+    db.session.commit()
+    return True
+
+
+def limit_user_tokens(user_id, max_tokens):
+    '''keep at most max_tokens live tokens of a user (newest ones),
+    expired tokens of this user are removed as well
+    '''
+    now = datetime.utcnow()
+    stale = [t for (t,) in db.session.query(Token.token)
+             .filter(Token.user_id == user_id, Token.expire_time > now)
+             .order_by(Token.expire_time.desc()).offset(max_tokens)]
+    stale += [t for (t,) in db.session.query(Token.token)
+              .filter(Token.user_id == user_id, Token.expire_time <= now)]
+    if len(stale) == 0:
+        return 0
+
+    for str_token in stale:
+        invalidate_token(str_token)
+
+    Token.query.filter(Token.token.in_(stale)).delete(synchronize_session=False)
+    db.session.commit()
+    return len(stale)
+
+
+def bearer_token(auth):
+    '''extract token string from an Authorization header'''
     if auth is None:
         raise RuntimeError({'result':-30, 'msg':'token not found'})
 
@@ -21,15 +174,44 @@ def check_bearer_token(auth):
     if len(str_tokens) < 2:
         raise RuntimeError({'result':-30, 'msg':'token not found'})
 
-    str_token = str_tokens[1]
-    token = Token.query.filter_by(token=str_token).first()
+    return str_tokens[1]
+
+
+@timed('token_check')
+def check_bearer_token(auth):
+    '''get token from query string and check for expiration'''
+    str_token = bearer_token(auth)
+
+    # signed tokens are accepted whatever TOKEN_MODE is, so clients can migrate
+    if is_signed_token(str_token):
+        return check_signed_token(str_token)
+
+    user = _token_cache.get(str_token)
+    if user is not None:
+        # revoked on any worker (logout, login cap) means the row is gone: one primary key
+        # lookup, instead of the token + user query and the expiry check of a miss
+        with reading():
+            live = db.session.query(Token.token).filter_by(token=str_token).first() is not None
+        if live:
+            return user
+        invalidate_token(str_token)
+        raise RuntimeError({'result':-30, 'msg':'token not found'})
+
+    with reading():
+        token = Token.query.filter_by(token=str_token).first()
+        user_exists = token is not None and token.user is not None
+    if token is None:
+        # maybe issued a moment ago, not on a lagging replica yet
+        token = Token.query.filter_by(token=str_token).first()
+        user_exists = token is not None and token.user is not None
     if token is None:
         raise RuntimeError({'result':-30, 'msg':'token not found'})
 
-    if token.user is None:
+    if not user_exists:
         raise RuntimeError({'result':-41, 'msg':'user not exist'})
 
     if token.is_expired():
+        invalidate_token(str_token)
         try:
             db.session.delete(token)
             db.session.commit()
@@ -37,8 +219,9 @@ def check_bearer_token(auth):
             db.session.rollback()
 
         raise RuntimeError({'result':-31, 'msg':'token expired'})
-    
-    return token.user
+
+    cache_token(token)
+    return AuthUser(token.user_id)
 
 
 def TokenCheck(func):
@@ -52,4 +235,4 @@ def TokenCheck(func):
         except RuntimeError as e:
             return e.args[0]
 
-    return wrapper
\ No newline at end of file
+    return wrapper
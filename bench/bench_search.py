@@ -0,0 +1,130 @@
+'''latency of /books/search on a synthetic catalog
+
+    python bench/bench_search.py [books] [queries] [db_path]
+
+builds a catalog of `books` random books (default 1M) with a few shelves,
+indexes it (book_fts 'rebuild', as at first start) and runs `queries` searches
+of every kind: a long word (fts match), several words, a word shorter than a
+trigram (substring filter), a search in a shelf. reported are p50/p95/p99
+latency of search_books per kind. pass db_path to keep the catalog for
+the next run, otherwise it's built in a temporary directory.
+'''
+import os, sys, time, random, sqlite3, tempfile, itertools
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+SYLLABLES = ('ka ri mo ta ne shi lu pa ve do zen qu ar el in on ex bo '
+             '素 描 石 膏 绘 画 入 门 唐 诗 历 史 科 学 生 活 世 界 音 乐').split()
+AUTHORS = ['author%d' % i for i in range(5000)]
+PUBLISHERS = ['publisher%d' % i for i in range(300)]
+USERS = 100
+SHELF = 200
+
+
+def vocabulary(size=30000):
+    rnd = random.Random(1)
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 4))))
+    words = sorted(words)
+    rnd.shuffle(words)
+    return words
+
+
+WORDS = vocabulary()
+# zipf: the word of rank r is used in proportion to 1/r, a few are everywhere, most are rare
+WEIGHTS = list(itertools.accumulate(1.0 / r for r in range(1, len(WORDS) + 1)))
+
+
+def word(rnd):
+    return rnd.choices(WORDS, cum_weights=WEIGHTS)[0]
+
+
+def phrase(rnd, n):
+    return ' '.join(word(rnd) for _ in range(n))
+
+
+def build(path, books):
+    from sqlalchemy import create_engine
+    from dao import db
+
+    engine = create_engine('sqlite:///' + path)
+    db.metadata.create_all(engine)
+    engine.dispose()
+
+    rnd = random.Random(42)
+    con = sqlite3.connect(path)
+    con.execute('PRAGMA journal_mode = WAL')
+    con.execute('PRAGMA synchronous = OFF')
+    start = time.monotonic()
+    batch = []
+    for i in range(books):
+        batch.append((9780000000000 + i, phrase(rnd, rnd.randint(2, 5)), phrase(rnd, 2),
+                      rnd.choice(AUTHORS), rnd.choice(PUBLISHERS), phrase(rnd, 30)))
+        if len(batch) == 10000:
+            con.executemany('INSERT INTO book (isbn, title, subtitle, author, publisher, summary) '
+                            'VALUES (?, ?, ?, ?, ?, ?)', batch)
+            batch = []
+    if batch:
+        con.executemany('INSERT INTO book (isbn, title, subtitle, author, publisher, summary) '
+                        'VALUES (?, ?, ?, ?, ?, ?)', batch)
+    con.execute("INSERT INTO user (id, email, name, hashed_password) VALUES (1, 'bench', 'bench', '-')")
+    con.executemany('INSERT INTO user_book (user_id, book_isbn, add_date) VALUES (?, ?, CURRENT_TIMESTAMP)',
+                    [(u, 9780000000000 + rnd.randrange(books)) for u in range(1, USERS + 1)
+                     for _ in range(SHELF)])
+    con.commit()
+    con.close()
+    print('catalog of %d books built in %.1fs' % (books, time.monotonic() - start))
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda p: samples[min(len(samples) - 1, int(p * len(samples)))] * 1000
+    return pick(0.5), pick(0.95), pick(0.99)
+
+
+def main():
+    books = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    queries = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    path = sys.argv[3] if len(sys.argv) > 3 else os.path.join(tempfile.mkdtemp(prefix='bench-search-'), 'bench.db')
+
+    if not os.path.exists(path):
+        build(path, books)
+
+    settings = os.path.join(os.path.dirname(path), 'bench_settings.py')
+    with open(settings, 'w') as f:
+        f.write("SQLALCHEMY_DATABASE_URI = 'sqlite:///%s'\n" % path)
+        f.write("TOKEN_SWEEP_INTERVAL = 0\n")
+    os.environ['FLASKR_SETTINGS'] = settings
+
+    start = time.monotonic()
+    from main import app    # creates and fills book_fts if it's not there yet
+    rank_limit = app.config['BOOKS_SEARCH_RANK_LIMIT']
+    from search import search_books, fts_tokenizer
+    print('startup (indexing on first run) %.1fs, tokenizer %s' % (time.monotonic() - start, fts_tokenizer()))
+
+    rnd = random.Random(7)
+    long_word = lambda: next(w for w in iter(lambda: word(rnd), None) if len(w) >= 3)
+    kinds = [
+        ('one word', lambda: (long_word(), None)),
+        ('two words', lambda: ('%s %s' % (long_word(), long_word()), None)),
+        ('author', lambda: (rnd.choice(AUTHORS), None)),
+        ('short word', lambda: (rnd.choice(['素描', '唐诗', '历史', 'ka']), None)),
+        ('in shelf', lambda: (long_word(), rnd.randint(1, USERS))),
+    ]
+
+    print('%-12s %10s %10s %10s' % ('', 'p50 ms', 'p95 ms', 'p99 ms'))
+    with app.app_context():
+        for name, make in kinds:
+            samples = []
+            for _ in range(queries):
+                q, user_id = make()
+                t = time.perf_counter()
+                search_books(q, user_id, rnd.randint(1, 3), 20, rank_limit)
+                samples.append(time.perf_counter() - t)
+            print('%-12s %10.2f %10.2f %10.2f' % ((name,) + percentiles(samples)))
+
+
+if __name__ == '__main__':
+    main()
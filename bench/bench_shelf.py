@@ -0,0 +1,99 @@
+'''queries per page and serialization time of the shelf listing, before and after
+eager loading the books and encoding the response once
+
+    python bench/bench_shelf.py [books] [per_page] [rounds]
+
+runs on a throw-away sqlite database, the real one is not touched
+'''
+import os, sys, json, time, tempfile, datetime
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+_dir = tempfile.mkdtemp(prefix='bench-shelf-')
+_settings = os.path.join(_dir, 'settings.py')
+with open(_settings, 'w') as f:
+    f.write("SQLALCHEMY_DATABASE_URI = 'sqlite:///%s'\n" % os.path.join(_dir, 'bench.db'))
+    f.write("TOKEN_SWEEP_INTERVAL = 0\n")
+os.environ['FLASKR_SETTINGS'] = _settings
+
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload
+
+from main import app, db, UserBookEncoder, user_book_to_json
+from dao import User, Book, UserBook
+from utils import json_dumps
+
+
+def seed(n):
+    user = User('bench@example.com', 'bench', 'bench')
+    user.hashed_password = '-'
+    db.session.add(user)
+    db.session.flush()
+    for i in range(n):
+        isbn = 9780000000000 + i
+        b = Book(isbn, 'title %d' % i, 'author %d' % i)
+        b.summary = 'summary ' * 40
+        b.publisher = 'publisher'
+        db.session.add(b)
+        ub = UserBook(user.id, isbn, None)
+        ub.add_date = datetime.datetime(2017, 1, 1)
+        db.session.add(ub)
+    db.session.commit()
+    return user.id
+
+
+class QueryCounter(object):
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self)
+
+    def __call__(self, *args):
+        self.count += 1
+
+
+def before(user_id, per_page):
+    rs = UserBook.query.filter(UserBook.user_id == user_id, UserBook.rid > 0)\
+                                .order_by(UserBook.rid).limit(per_page + 1).all()
+    data = json.loads(json.dumps(rs[:per_page], cls=UserBookEncoder))
+    return json.dumps({'result': 0, 'data': data}).encode('utf-8')
+
+
+def after(user_id, per_page):
+    rs = UserBook.query.options(joinedload(UserBook.detail))\
+                                .filter(UserBook.user_id == user_id, UserBook.rid > 0)\
+                                .order_by(UserBook.rid).limit(per_page + 1).all()
+    return json_dumps({'result': 0, 'data': [user_book_to_json(r) for r in rs[:per_page]]})
+
+
+def measure(fn, user_id, per_page, rounds, counter):
+    queries = 0
+    elapsed = 0.0
+    for _ in range(rounds):
+        db.session.expunge_all()    # every request starts with an empty session
+        start_count = counter.count
+        start = time.perf_counter()
+        body = fn(user_id, per_page)
+        elapsed += time.perf_counter() - start
+        queries += counter.count - start_count
+    return queries / float(rounds), elapsed / rounds * 1000, len(body)
+
+
+def main():
+    books = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    per_page = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+
+    with app.app_context():
+        user_id = seed(books)
+        counter = QueryCounter(db.engine)
+        assert json.loads(before(user_id, per_page)) == json.loads(after(user_id, per_page))
+
+        print('%d books on shelf, %d per page, %d rounds' % (books, per_page, rounds))
+        print('%-8s %10s %10s %10s' % ('', 'queries', 'ms/page', 'bytes'))
+        for name, fn in (('before', before), ('after', after)):
+            print('%-8s %10.1f %10.2f %10d' % ((name,) + measure(fn, user_id, per_page, rounds, counter)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+'''concurrent read/write throughput of sqlite, default settings vs sqlite_tuning
+
+    python bench/bench_sqlite.py [workers] [threads] [seconds] [write_ratio]
+
+every worker process (as a wsgi worker) runs threads doing shelf reads
+(a page of user_book joined with book) or shelf writes (insert a user_book
+row and bump the shelf counter, in one transaction), write_ratio of them
+writes. reported are operations per second, and the "database is locked"
+errors, of each setting on a throw-away database.
+'''
+import os, sys, time, random, shutil, tempfile, threading, multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+from dao import db
+from sqlite_tuning import engine_options, tune_sqlite, DEFAULT_PRAGMAS
+
+USERS = 50
+BOOKS = 2000
+
+READ = text('SELECT ub.rid, ub.comment, b.* FROM user_book ub JOIN book b ON b.isbn = ub.book_isbn '
+            'WHERE ub.user_id = :uid AND ub.rid > :rid ORDER BY ub.rid LIMIT 20')
+INSERT = text("INSERT INTO user_book (user_id, book_isbn, add_date) VALUES (:uid, :isbn, datetime('now'))")
+COUNT = text('UPDATE shelf_counter SET book_count = book_count + 1 WHERE user_id = :uid')
+
+
+def seed(path):
+    engine = create_engine('sqlite:///' + path)
+    db.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO user (id, email, name, hashed_password) VALUES (:id, :e, 'u', '-')"),
+                     [{'id': u, 'e': '%d@bench' % u} for u in range(1, USERS + 1)])
+        conn.execute(text("INSERT INTO book (isbn, title, author, summary) VALUES (:isbn, 't', 'a', :s)"),
+                     [{'isbn': 9780000000000 + i, 's': 'summary ' * 50} for i in range(BOOKS)])
+        conn.execute(text('INSERT INTO shelf_counter (user_id, book_count) VALUES (:uid, 0)'),
+                     [{'uid': u} for u in range(1, USERS + 1)])
+    engine.dispose()
+
+
+def make_engine(path, tuned, threads):
+    uri = 'sqlite:///' + path
+    if not tuned:
+        # as main.py used to: default engine, rollback journal
+        return create_engine(uri)
+
+    engine = create_engine(uri, **engine_options(uri, pool_size=threads, max_overflow=0))
+    tune_sqlite(engine, DEFAULT_PRAGMAS)
+    return engine
+
+
+def worker(args):
+    path, tuned, threads, seconds, write_ratio = args
+    engine = make_engine(path, tuned, threads)
+    counts = {'reads': 0, 'writes': 0, 'locked': 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def run():
+        rnd = random.Random()
+        reads = writes = locked = 0
+        while time.monotonic() < deadline:
+            uid = rnd.randint(1, USERS)
+            try:
+                if rnd.random() < write_ratio:
+                    with engine.begin() as conn:
+                        conn.execute(INSERT, {'uid': uid, 'isbn': 9780000000000 + rnd.randrange(BOOKS)})
+                        conn.execute(COUNT, {'uid': uid})
+                    writes += 1
+                else:
+                    with engine.connect() as conn:
+                        conn.execute(READ, {'uid': uid, 'rid': 0}).fetchall()
+                    reads += 1
+            except OperationalError as e:
+                if 'locked' not in str(e):
+                    raise
+                locked += 1
+
+        with lock:
+            counts['reads'] += reads
+            counts['writes'] += writes
+            counts['locked'] += locked
+
+    pool = [threading.Thread(target=run) for _ in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    engine.dispose()
+    return counts
+
+
+def measure(tuned, workers, threads, seconds, write_ratio):
+    tmp = tempfile.mkdtemp(prefix='bench-sqlite-')
+    try:
+        path = os.path.join(tmp, 'bench.db')
+        seed(path)
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(worker, [(path, tuned, threads, seconds, write_ratio)] * workers)
+    finally:
+        shutil.rmtree(tmp)
+
+    total = dict((k, sum(r[k] for r in results)) for k in results[0])
+    return total['reads'] / seconds, total['writes'] / seconds, total['locked']
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 5
+    write_ratio = float(sys.argv[4]) if len(sys.argv) > 4 else 0.2
+
+    print('%d workers x %d threads, %gs, %d%% writes' % (workers, threads, seconds, write_ratio * 100))
+    print('%-8s %12s %12s %10s' % ('', 'reads/s', 'writes/s', 'locked'))
+    for name, tuned in (('default', False), ('tuned', True)):
+        print('%-8s %12.0f %12.0f %10d' % ((name,) + measure(tuned, workers, threads, seconds, write_ratio)))
+
+
+if __name__ == '__main__':
+    main()
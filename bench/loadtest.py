@@ -0,0 +1,498 @@
+'''load test of the REST API, against a local fake isbn service and cover server
+
+    python bench/loadtest.py [--books 200000] [--users 1000] [--shelf 200] [--db seed.db]
+                             [--concurrency 16] [--duration 30] [--warmup 5]
+                             [--mix book_hit=40,shelf=30,...]
+                             [--upstream-latency 50] [--upstream-error-rate 0.02] ...
+                             [--save baseline.json] [--compare baseline.json]
+
+seeds an sqlite database (users with a live token each, books, shelves),
+starts the app on it with werkzeug in a separate process, and drives it with
+`concurrency` threads for `duration` seconds, each one sending requests of
+the mix, picked at random by weight:
+
+    token       POST /token (basic auth, password hashing included)
+    book_hit    GET /book/<isbn> of a book in db
+    book_miss   GET /book/<isbn> of a book not in db: upstream lookup, or a known miss
+    shelf       GET /shelf/book, a random page of the user's shelf
+    shelf_add   POST /shelf/book/<isbn>
+    book_post   POST /book, a new book
+
+book info and covers come from fake servers run by this script, with the
+latency, jitter and error rates given. reported per request kind are
+throughput, p50/p95/p99 latency, errors (transport, 5xx, or a result code
+other than 0 - and -404 for book_miss) and db queries per request (counted
+by the server process). --save writes them to a json file, --compare diffs a
+run with such a baseline and exits with 1 on regression.
+
+the seeded database is kept when --db is given (and reused while the seed
+parameters are the same), every run works on a copy of it.
+'''
+import os, sys, json, time, random, shutil, sqlite3, argparse, threading, subprocess, tempfile
+from datetime import datetime, timedelta
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+import requests
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from utils import check_and_fix_isbn, generate_password_hash
+
+DEFAULT_MIX = 'token=1,book_hit=40,book_miss=5,shelf=40,shelf_add=8,book_post=2'
+# result codes other than 0 that are a normal answer of a request kind, any other one is an error
+EXPECTED_RESULTS = {'book_miss': ('-404',)}
+PASSWORD = 'bench'
+# bumped when seed() changes, older seeded databases are rebuilt
+SEED_VERSION = 2
+# a tiny jpeg is enough, covers are stored as they come
+JPEG = bytes.fromhex('ffd8ffe000104a46494600010100000100010000ffdb004300') + bytes(64) + bytes.fromhex('ffd9')
+
+
+def isbn13(prefix, n):
+    '''isbn of prefix (978 / 979) and a 9 digit number, with the check digit of the app'''
+    return check_and_fix_isbn(int('%s%09d' % (prefix, n)))
+
+
+def token_of(user_id):
+    return '%032x' % user_id
+
+
+def seed(path, books, users, shelf):
+    '''fill a new database at path'''
+    from sqlalchemy import create_engine
+    from dao import db
+
+    engine = create_engine('sqlite:///' + path)
+    db.metadata.create_all(engine)
+    engine.dispose()
+
+    rnd = random.Random(42)
+    con = sqlite3.connect(path)
+    con.execute('PRAGMA journal_mode = WAL')
+    con.execute('PRAGMA synchronous = OFF')
+    start = time.monotonic()
+
+    batch = []
+    for i in range(books):
+        batch.append((isbn13(978, i), 'title %d' % i, 'subtitle', 'author %d' % rnd.randrange(10000),
+                      'publisher %d' % rnd.randrange(300), 'summary of book %d ' % i * 8))
+        if len(batch) == 10000 or i == books - 1:
+            con.executemany('INSERT INTO book (isbn, title, subtitle, author, publisher, summary) '
+                            'VALUES (?, ?, ?, ?, ?, ?)', batch)
+            batch = []
+
+    hashed = generate_password_hash(PASSWORD)
+    now = str(datetime.utcnow())
+    con.executemany('INSERT INTO user (id, email, name, hashed_password) VALUES (?, ?, ?, ?)',
+                    [(u, 'user%d@bench' % u, 'user %d' % u, hashed) for u in range(1, users + 1)])
+    con.executemany('INSERT INTO token (token, user_id, create_time, expire_time) VALUES (?, ?, ?, ?)',
+                    [(token_of(u), u, now, str(datetime.utcnow() + timedelta(days=3650)))
+                     for u in range(1, users + 1)])
+    for u in range(1, users + 1):
+        con.executemany('INSERT INTO user_book (user_id, book_isbn, add_date) VALUES (?, ?, ?)',
+                        [(u, isbn13(978, rnd.randrange(books)), now) for _ in range(shelf)])
+    con.commit()
+    con.close()
+    print('seeded %d books, %d users, %d books per shelf in %.1fs'
+          % (books, users, shelf, time.monotonic() - start), file=sys.stderr)
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeUpstream(object):
+    '''isbn service (jisuapi format) and cover server with latency and errors
+
+    /isbn/query?isbn=n  finds isbns of the 978 prefix, and found_rate of the others
+    /cover/<isbn>.jpg   a small jpeg
+    '''
+
+    def __init__(self, latency=0.05, jitter=0.02, error_rate=0.0, found_rate=0.5,
+                 cover_latency=0.1, cover_error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.found_rate = found_rate
+        self.cover_latency = cover_latency
+        self.cover_error_rate = cover_error_rate
+        self.requests = {'isbn': 0, 'cover': 0}
+
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path.startswith('/cover/'):
+                    upstream.requests['cover'] += 1
+                    self.reply(upstream.cover_latency, upstream.cover_error_rate, 'image/jpeg', JPEG)
+                else:
+                    upstream.requests['isbn'] += 1
+                    isbn = int(parse_qs(url.query)['isbn'][0])
+                    body = json.dumps(upstream.record(isbn, self.server.server_address[1])).encode()
+                    self.reply(upstream.latency, upstream.error_rate, 'application/json', body)
+
+            def reply(self, latency, error_rate, content_type, body):
+                time.sleep(max(0, random.gauss(latency, upstream.jitter)))
+                if random.random() < error_rate:
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                try:
+                    self.send_response(200)
+                    self.send_header('Content-Type', content_type)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client gave up (timeout), or the server under test stopped
+                    pass
+
+        self.server = ThreadingServer(('127.0.0.1', 0), Handler)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def record(self, isbn, port):
+        if str(isbn).startswith('979') and isbn % 1000 >= self.found_rate * 1000:
+            return {'status': 205, 'msg': 'not found'}
+        return {'status': 0, 'msg': 'ok', 'result': {
+            'isbn': isbn, 'title': 'upstream %d' % isbn, 'author': 'upstream author',
+            'publisher': 'upstream', 'summary': 'found upstream', 'pic': 'http://127.0.0.1:%d/cover/%d.jpg' % (port, isbn)}}
+
+    def url(self):
+        return 'http://127.0.0.1:%d/isbn/query' % self.port
+
+    def stop(self):
+        self.server.shutdown()
+
+
+def write_settings(workdir, db_path, upstream_url):
+    path = os.path.join(workdir, 'settings.py')
+    with open(path, 'w') as f:
+        f.write('SQLALCHEMY_DATABASE_URI = %r\n' % ('sqlite:///' + db_path))
+        f.write('BOOK_PROVIDERS = [{%r: %r, %r: %r}]\n' % ('type', 'jisu', 'url', upstream_url))
+        f.write('TOKEN_SWEEP_INTERVAL = 0\n')
+    return path
+
+
+def serve(port):
+    '''run the app (configured by FLASKR_SETTINGS) with a header of the queries of each request'''
+    from flask import g, has_app_context
+    from sqlalchemy import event
+    from werkzeug.serving import make_server
+    from main import app, db
+    from db_routing import read_engine
+
+    def count(*args):
+        if has_app_context():
+            g._bench_queries = g.get('_bench_queries', 0) + 1
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', count)
+    if read_engine() is not None:
+        event.listen(read_engine(), 'before_cursor_execute', count)
+
+    @app.after_request
+    def queries_header(response):
+        response.headers['X-Queries'] = str(g.get('_bench_queries', 0))
+        return response
+
+    if port > 0:
+        make_server('127.0.0.1', port, app, threaded=True).serve_forever()
+
+
+def start_server(workdir, settings, port):
+    env = dict(os.environ, FLASKR_SETTINGS=settings, PYTHONPATH=ROOT)
+    # cwd: covers are downloaded to ./static/cover
+    log = open(os.path.join(workdir, 'server.log'), 'w')
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '_serve', str(port)],
+                               cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 600
+    while time.monotonic() < deadline:
+        try:
+            requests.get('http://127.0.0.1:%d/' % port, timeout=1)
+            return process
+        except requests.ConnectionError:
+            if process.poll() is not None:
+                raise RuntimeError('server exited with %d' % process.returncode)
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('server did not start')
+
+
+def free_port():
+    import socket
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class Client(object):
+    '''one virtual user'''
+
+    def __init__(self, base, args, rnd, counter):
+        self.base = base
+        self.args = args
+        self.rnd = rnd
+        self.counter = counter
+        self.user_id = rnd.randint(1, args.users)
+        self.http = requests.Session()
+        self.http.headers['Authorization'] = 'Bearer ' + token_of(self.user_id)
+
+    def token(self):
+        return self.http.post(self.base + '/token', auth=('user%d@bench' % self.user_id, PASSWORD))
+
+    def book_hit(self):
+        return self.http.get(self.base + '/book/%d' % isbn13(978, self.rnd.randrange(self.args.books)))
+
+    def book_miss(self):
+        # a small set, so that some are repeated misses
+        return self.http.get(self.base + '/book/%d' % isbn13(979, self.rnd.randrange(self.args.miss_isbns)))
+
+    def shelf(self):
+        pages = max(1, self.args.shelf // 20)
+        rid = (self.user_id - 1) * self.args.shelf + self.rnd.randrange(pages) * 20
+        return self.http.get(self.base + '/shelf/book', params={'rid': rid, 'page': 20})
+
+    def shelf_add(self):
+        return self.http.post(self.base + '/shelf/book/%d' % isbn13(978, self.rnd.randrange(self.args.books)))
+
+    def book_post(self):
+        isbn = isbn13(979, 500000000 + next(self.counter))
+        return self.http.post(self.base + '/book', json={'isbn': isbn, 'title': 'posted %d' % isbn,
+                                                         'author': 'bench'})
+
+
+class Stats(object):
+    def __init__(self, expected=()):
+        self.expected = ('0',) + tuple(expected)
+        self.latencies = []
+        self.queries = 0
+        self.answered = 0
+        self.errors = 0
+        self.results = {}
+
+    def add(self, latency, response):
+        self.latencies.append(latency)
+        if response is None or response.status_code >= 500:
+            self.errors += 1
+            return
+        self.queries += int(response.headers.get('X-Queries', 0))
+        self.answered += 1
+        try:
+            code = str(response.json().get('result'))
+        except ValueError:
+            code = 'http %d' % response.status_code
+        self.results[code] = self.results.get(code, 0) + 1
+        if code not in self.expected:
+            # an error answered with http 200
+            self.errors += 1
+
+    def summary(self, duration):
+        samples = sorted(self.latencies)
+        pick = lambda p: samples[min(len(samples) - 1, int(p * len(samples)))] * 1000 if samples else 0.0
+        return {
+            'requests': len(samples),
+            'rps': len(samples) / duration,
+            'p50_ms': pick(0.5),
+            'p95_ms': pick(0.95),
+            'p99_ms': pick(0.99),
+            'errors': self.errors,
+            'queries_per_request': float(self.queries) / self.answered if self.answered else 0.0,
+            'results': self.results,
+        }
+
+
+def run_load(base, args, mix):
+    kinds, weights = zip(*mix)
+    stats = dict((k, Stats(EXPECTED_RESULTS.get(k, ()))) for k in kinds)
+    lock = threading.Lock()
+    counter = iter(range(10 ** 9))
+    start = time.monotonic()
+    measure_from = start + args.warmup
+    stop_at = measure_from + args.duration
+
+    def worker(n):
+        rnd = random.Random(n)
+        client = Client(base, args, rnd, counter)
+        while True:
+            now = time.monotonic()
+            if now >= stop_at:
+                return
+            kind = rnd.choices(kinds, weights)[0]
+            t = time.perf_counter()
+            try:
+                response = getattr(client, kind)()
+            except requests.RequestException:
+                response = None
+            latency = time.perf_counter() - t
+            if now >= measure_from:
+                with lock:
+                    stats[kind].add(latency, response)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    results = dict((k, s.summary(args.duration)) for k, s in stats.items())
+    total = Stats()
+    for s in stats.values():
+        total.latencies.extend(s.latencies)
+        total.errors += s.errors
+        total.queries += s.queries
+        total.answered += s.answered
+    results['all'] = total.summary(args.duration)
+    return results
+
+
+def print_results(results):
+    print('%-10s %9s %9s %9s %9s %9s %7s %9s' % ('', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+                                                 'errors', 'queries'))
+    for kind, r in sorted(results.items(), key=lambda item: item[0] == 'all'):
+        print('%-10s %9d %9.1f %9.2f %9.2f %9.2f %7d %9.2f' % (
+            kind, r['requests'], r['rps'], r['p50_ms'], r['p95_ms'], r['p99_ms'], r['errors'],
+            r['queries_per_request']))
+
+
+def compare(results, baseline, tolerance):
+    '''print changes against baseline, returns the regressions found'''
+    regressions = []
+    print('\nagainst baseline (%s):' % baseline['meta']['time'])
+    print('%-10s %12s %12s %12s %12s' % ('', 'req/s', 'p50', 'p95', 'queries'))
+    for kind, r in sorted(results.items(), key=lambda item: item[0] == 'all'):
+        b = baseline['results'].get(kind)
+        if b is None:
+            continue
+        change = lambda key: (r[key] - b[key]) / b[key] * 100 if b[key] else 0.0
+        print('%-10s %+11.1f%% %+11.1f%% %+11.1f%% %+12.2f' % (
+            kind, change('rps'), change('p50_ms'), change('p95_ms'),
+            r['queries_per_request'] - b['queries_per_request']))
+        if min(r['requests'], b['requests']) < 100:
+            # too few for p95 to mean anything
+            continue
+        if change('p95_ms') > tolerance * 100:
+            regressions.append('%s p95 %.1fms -> %.1fms' % (kind, b['p95_ms'], r['p95_ms']))
+        if r['queries_per_request'] > b['queries_per_request'] + 0.05:
+            regressions.append('%s queries per request %.2f -> %.2f'
+                               % (kind, b['queries_per_request'], r['queries_per_request']))
+        if r['errors'] > b['errors'] and r['errors'] > r['requests'] * 0.01:
+            regressions.append('%s errors %d -> %d' % (kind, b['errors'], r['errors']))
+    for regression in regressions:
+        print('REGRESSION: ' + regression)
+    return regressions
+
+
+def prepare_db(args, workdir):
+    '''path of a copy of the seeded database for this run'''
+    seed_path = args.db or os.path.join(workdir, 'seed.db')
+    params = {'books': args.books, 'users': args.users, 'shelf': args.shelf, 'version': SEED_VERSION}
+    params_path = seed_path + '.seed.json'
+    seeded = os.path.exists(seed_path) and os.path.exists(params_path)
+    if seeded:
+        with open(params_path) as f:
+            seeded = json.load(f) == params
+
+    if not seeded:
+        for suffix in ('', '-wal', '-shm', '.seed.json'):
+            if os.path.exists(seed_path + suffix):
+                os.remove(seed_path + suffix)
+        seed(seed_path, args.books, args.users, args.shelf)
+        # first start of the app builds indexes (fts, shelf changes ...), done once in the seed
+        settings = write_settings(workdir, seed_path, 'http://127.0.0.1:9/')
+        start = time.monotonic()
+        subprocess.check_call([sys.executable, os.path.abspath(__file__), '_serve', '0'],
+                              env=dict(os.environ, FLASKR_SETTINGS=settings, PYTHONPATH=ROOT), cwd=workdir)
+        print('indexed in %.1fs' % (time.monotonic() - start), file=sys.stderr)
+        with open(params_path, 'w') as f:
+            json.dump(params, f)
+
+    run_path = os.path.join(workdir, 'run.db')
+    con = sqlite3.connect(seed_path)
+    con.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    con.close()
+    shutil.copyfile(seed_path, run_path)
+    return run_path
+
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == '_serve':
+        serve(int(sys.argv[2]))
+        return 0
+
+    parser = argparse.ArgumentParser(description='load test of the REST API')
+    parser.add_argument('--books', type=int, default=200000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--shelf', type=int, default=200, help='books per shelf')
+    parser.add_argument('--db', help='seeded database to keep / reuse')
+    parser.add_argument('--miss-isbns', type=int, default=2000, help='isbns asked for by book_miss')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=30, help='seconds measured')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds of load before measuring')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='kind=weight,...')
+    parser.add_argument('--seed-only', action='store_true')
+    parser.add_argument('--upstream-latency', type=float, default=50, help='ms')
+    parser.add_argument('--upstream-jitter', type=float, default=20, help='ms')
+    parser.add_argument('--upstream-error-rate', type=float, default=0.02)
+    parser.add_argument('--upstream-found-rate', type=float, default=0.5)
+    parser.add_argument('--cover-latency', type=float, default=100, help='ms')
+    parser.add_argument('--cover-error-rate', type=float, default=0.05)
+    parser.add_argument('--save', help='write results to this json file')
+    parser.add_argument('--compare', help='json file of a saved run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='p95 increase flagged as regression')
+    args = parser.parse_args()
+
+    mix = [(k, float(w)) for k, w in (item.split('=') for item in args.mix.split(','))]
+    for kind, _ in mix:
+        if not hasattr(Client, kind):
+            parser.error('unknown request kind: %s' % kind)
+
+    workdir = tempfile.mkdtemp(prefix='loadtest-')
+    try:
+        db_path = prepare_db(args, workdir)
+        if args.seed_only:
+            return 0
+
+        upstream = FakeUpstream(args.upstream_latency / 1000.0, args.upstream_jitter / 1000.0,
+                                args.upstream_error_rate, args.upstream_found_rate,
+                                args.cover_latency / 1000.0, args.cover_error_rate)
+        port = free_port()
+        server = start_server(workdir, write_settings(workdir, db_path, upstream.url()), port)
+        try:
+            print('%d threads, %.0fs (+%.0fs warmup), mix %s' % (args.concurrency, args.duration,
+                                                                 args.warmup, args.mix))
+            results = run_load('http://127.0.0.1:%d' % port, args, mix)
+        finally:
+            server.terminate()
+            server.wait()
+            upstream.stop()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results(results)
+    print('upstream requests: %s' % upstream.requests)
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+
+    if args.save:
+        meta = {'time': datetime.now().isoformat(timespec='seconds'), 'args': vars(args)}
+        with open(args.save, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2, sort_keys=True)
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
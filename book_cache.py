@@ -0,0 +1,155 @@
+import os, json, time, threading, tempfile
+
+from cache import TTLCache
+
+
+class FileCacheBackend(object):
+    '''cache shared by the worker processes of a host: one small json file per
+    key in a directory, written atomically. entries expire after ttl seconds
+    (wall clock, as processes don't share a monotonic clock), expired files
+    are removed on access and, every `prune_every` sets, by a sweep.
+    '''
+
+    def __init__(self, directory, ttl=3600, prune_every=1000):
+        self.directory = directory
+        self.ttl = ttl
+        self.prune_every = prune_every
+        self.hits = 0
+        self.misses = 0
+        self._sets = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, '%s.json' % key)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+
+        if entry['exp'] <= time.time():
+            self._remove(path)
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return entry['value']
+
+    def set(self, key, value):
+        entry = {'exp': time.time() + self.ttl, 'value': value}
+        try:
+            fd, tmp_name = tempfile.mkstemp(prefix='.tmp-', dir=self.directory)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_name, self._path(key))
+        except OSError as e:
+            print(e)
+            return
+
+        with self._lock:
+            self._sets += 1
+            prune = self._sets % self.prune_every == 0
+        if prune:
+            self.prune()
+
+    def delete(self, key):
+        self._remove(self._path(key))
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def prune(self):
+        '''remove expired entries (and temporary files left by a crash)'''
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.name.startswith('.tmp-'):
+                    if entry.stat().st_mtime < now - 60:
+                        self._remove(entry.path)
+                elif entry.stat().st_mtime < now - self.ttl:
+                    self._remove(entry.path)
+            except OSError:
+                pass
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            self._remove(entry.path)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'directory': self.directory,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / total if total else 0.0,
+        }
+
+
+class BookCache(object):
+    '''read-through cache of book payloads (Book.toJSON() and its cover url), by isbn
+
+    a process local LRU/TTL cache, optionally backed by a shared one, so that
+    a book read by a worker is a hit for the others too. invalidate() drops
+    an isbn from both; other workers' local entries of it expire within their
+    (short, when there's a shared backend) ttl.
+    '''
+
+    def __init__(self, maxsize=2048, ttl=300, shared=None):
+        self.local = TTLCache(maxsize, ttl)
+        self.shared = shared
+
+    def configure(self, maxsize=None, ttl=None, shared=None):
+        self.local.configure(maxsize, ttl)
+        self.shared = shared
+
+    def get(self, isbn):
+        '''{'data': payload, 'cover': url}, None if isbn is not cached'''
+        entry = self.local.get(isbn)
+        if entry is None and self.shared is not None:
+            entry = self.shared.get(isbn)
+            if entry is not None:
+                self.local.set(isbn, entry)
+        return entry
+
+    def put(self, book, cover=None):
+        '''cache a book read from (or just saved to) db'''
+        entry = {'data': book.toJSON(), 'cover': cover}
+        self.local.set(book.isbn, entry)
+        if self.shared is not None:
+            self.shared.set(book.isbn, entry)
+        return entry
+
+    def invalidate(self, isbn):
+        self.local.delete(isbn)
+        if self.shared is not None:
+            self.shared.delete(isbn)
+
+    def clear(self):
+        self.local.clear()
+        if self.shared is not None:
+            self.shared.clear()
+
+    def stats(self):
+        local = self.local.stats()
+        result = {'local': local}
+        hits, misses = local['hits'], local['misses']
+        if self.shared is not None:
+            shared = self.shared.stats()
+            result['shared'] = shared
+            # a local miss found in the shared cache is a hit
+            hits += shared['hits']
+            misses = shared['misses']
+
+        result['hit_ratio'] = float(hits) / (hits + misses) if hits + misses else 0.0
+        return result
+
+
+book_cache = BookCache()
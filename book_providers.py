@@ -0,0 +1,319 @@
+import os, json, time, asyncio, threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from dao import Book
+from provider_client import ProviderClient, ProviderError, LatencyHistogram, RecentStats
+
+
+def book_from_record(r):
+    '''Book from a provider record (jisuapi "result" fields, or those of Book.toJSON())'''
+    b = Book(int(r['isbn']), r['title'], r['author'])
+    b.isbn10 = r.get('isbn10')
+    b.subtitle = r.get('subtitle')
+    b.summary = r.get('summary')
+    b.publisher = r.get('publisher')
+    b.pub_date = r.get('pub_date', r.get('pubdate'))
+    b.binding = r.get('binding')
+    b.page = r.get('page')
+    b.price = r.get('price')
+    b.org_pic = r.get('pic')
+    b.content = r.get('class', r.get('content'))
+    return b
+
+
+class BookProvider(object):
+    '''a source of book info
+
+    subclasses implement _lookup(isbn), returning a Book or None if the isbn
+    is unknown to them, and raising ProviderError if they can't answer now.
+    counters and latency are of all calls, `recent` (used for ranking) of the
+    last stats_window to 2 * stats_window seconds
+    '''
+
+    def __init__(self, name, weight=1.0, stats_window=300):
+        self.name = name
+        self.weight = weight
+        self.latency = LatencyHistogram()
+        self.recent = RecentStats(stats_window)
+        self.found = 0
+        self.not_found = 0
+        self.errors = 0
+
+    def lookup(self, isbn):
+        start = time.monotonic()
+        try:
+            book = self._lookup(isbn)
+        except ProviderError:
+            self._failed(start)
+            raise
+        except Exception as e:
+            # malformed answer, same as unavailable
+            self._failed(start)
+            raise ProviderError('%s: %s: %s' % (self.name, type(e).__name__, e))
+
+        return self._answered(start, book)
+
+    async def lookup_async(self, isbn):
+        '''lookup() for asyncio code'''
+        start = time.monotonic()
+        try:
+            book = await self._lookup_async(isbn)
+        except ProviderError:
+            self._failed(start)
+            raise
+        except Exception as e:
+            self._failed(start)
+            raise ProviderError('%s: %s: %s' % (self.name, type(e).__name__, e))
+
+        return self._answered(start, book)
+
+    def _failed(self, start):
+        elapsed = time.monotonic() - start
+        self.errors += 1
+        self.latency.observe(elapsed)
+        self.recent.observe(elapsed, error=True)
+
+    def _answered(self, start, book):
+        elapsed = time.monotonic() - start
+        if book is None:
+            self.not_found += 1
+        else:
+            self.found += 1
+        self.latency.observe(elapsed)
+        self.recent.observe(elapsed)
+        return book
+
+    def _lookup(self, isbn):
+        raise NotImplementedError()
+
+    async def _lookup_async(self, isbn):
+        # providers without network i/o of their own just run in a thread
+        return await asyncio.get_running_loop().run_in_executor(None, self._lookup, isbn)
+
+    def error_rate(self):
+        '''of the recent calls'''
+        return self.recent.error_rate()
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'found': self.found,
+            'not_found': self.not_found,
+            'errors': self.errors,
+            'recent_error_rate': self.recent.error_rate(),
+            'p95': self.latency.percentile(0.95),
+            'latency': self.latency.snapshot(),
+        }
+
+
+class JisuProvider(BookProvider):
+    '''isbn service of api.jisuapi.com'''
+
+    URL = 'http://api.jisuapi.com/isbn/query'
+
+    def __init__(self, appkey, client=None, url=URL, name='jisu', weight=1.0):
+        BookProvider.__init__(self, name, weight)
+        self.appkey = appkey
+        self.client = client or ProviderClient()
+        self.url = url
+
+    def _lookup(self, isbn):
+        return self._book_of(self.client.get_json(self.url, params={'appkey': self.appkey, 'isbn': isbn}))
+
+    async def _lookup_async(self, isbn):
+        return self._book_of(await self.client.get_json_async(self.url, {'appkey': self.appkey, 'isbn': isbn}))
+
+    def _book_of(self, data):
+        if str(data['status']) != '0':
+            return None
+
+        return book_from_record(data['result'])
+
+
+class LocalFileProvider(BookProvider):
+    '''offline provider, book records read from a json lines file
+    the file is re-read when it changes (checked at most every `check_interval` seconds)
+    '''
+
+    def __init__(self, path, name='file', weight=1.0, check_interval=5):
+        BookProvider.__init__(self, name, weight)
+        self.path = path
+        self.check_interval = check_interval
+        self._records = {}
+        self._mtime = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.check_interval:
+            return
+
+        self._checked_at = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError as e:
+            raise ProviderError('%s: %s' % (self.name, e))
+
+        if mtime == self._mtime:
+            return
+
+        records = {}
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if len(line) > 0:
+                    r = json.loads(line)
+                    records[int(r['isbn'])] = r
+
+        self._records = records
+        self._mtime = mtime
+
+    def _lookup(self, isbn):
+        with self._lock:
+            self._load()
+            r = self._records.get(int(isbn))
+
+        return None if r is None else book_from_record(r)
+
+
+def create_provider(spec, client_options=None):
+    '''provider from a BOOK_PROVIDERS entry, e.g.
+    {'type': 'jisu', 'appkey': 'xxx'} or {'type': 'file', 'path': 'books.jsonl'}
+    '''
+    spec = dict(spec)
+    kind = spec.pop('type')
+    if kind == 'jisu':
+        spec.setdefault('client', ProviderClient(**(client_options or {})))
+        return JisuProvider(**spec)
+    if kind == 'file':
+        return LocalFileProvider(**spec)
+
+    raise ValueError('unknown book provider type: %s' % kind)
+
+
+class BookResolver(object):
+    '''ask providers for a book, best first, with hedged requests
+
+    providers are tried one after the other, the next one starting as soon as
+    the previous didn't find the book (or failed). if a provider is slow - still
+    running after hedge_delay, or, if that is None, after its own latency at
+    hedge_percentile - the next one is started too (hedged), and the first
+    book found wins. providers are ordered by the error rate and latency of
+    their recent calls, configured order (and weight) breaking ties.
+    '''
+
+    def __init__(self, providers, hedge_delay=None, hedge_percentile=0.95,
+                 min_hedge_delay=0.05, max_workers=16):
+        self.providers = list(providers)
+        self.hedge_delay = hedge_delay
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay
+        self.hedged = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def ordered(self):
+        def score(item):
+            index, p = item
+            p95 = p.recent.percentile(self.hedge_percentile)
+            # an unhealthy provider goes last, whatever its latency, until its errors are old enough
+            return (p.error_rate() > 0.5, (p95 or 0) / p.weight, index)
+
+        return [p for i, p in sorted(enumerate(self.providers), key=score)]
+
+    def _delay_of(self, provider):
+        if self.hedge_delay is not None:
+            return self.hedge_delay
+
+        p = provider.recent.percentile(self.hedge_percentile)
+        if p is None or p == float('inf'):
+            # no (usable) statistics yet, don't hedge
+            return None
+        return max(p, self.min_hedge_delay)
+
+    def resolve(self, isbn):
+        '''first book found, None if no provider knows isbn,
+        raises ProviderError if none found it and at least one failed
+        '''
+        queue = self.ordered()
+        running = {}
+        error = None
+        while len(queue) > 0 or len(running) > 0:
+            if len(running) == 0:
+                p = queue.pop(0)
+                running[self._executor.submit(p.lookup, isbn)] = p
+                started = p
+
+            timeout = self._delay_of(started) if len(queue) > 0 else None
+            done, _ = wait(list(running), timeout, FIRST_COMPLETED)
+            if len(done) == 0:
+                # slow, fire a hedged request at the next provider
+                self.hedged += 1
+                p = queue.pop(0)
+                running[self._executor.submit(p.lookup, isbn)] = p
+                started = p
+                continue
+
+            for f in done:
+                running.pop(f)
+                try:
+                    book = f.result()
+                except ProviderError as e:
+                    error = e
+                    continue
+
+                if book is not None:
+                    return book
+
+        if error is not None:
+            raise error
+        return None
+
+    async def resolve_async(self, isbn):
+        '''resolve() for asyncio code, providers and hedged ones run as tasks'''
+        running = {}
+        try:
+            return await self._resolve_tasks(isbn, running)
+        finally:
+            # the book was found (or this was cancelled): the providers still asked are not waited for
+            for f in running:
+                f.cancel()
+
+    async def _resolve_tasks(self, isbn, running):
+        queue = self.ordered()
+        error = None
+        while len(queue) > 0 or len(running) > 0:
+            if len(running) == 0:
+                p = queue.pop(0)
+                running[asyncio.ensure_future(p.lookup_async(isbn))] = p
+                started = p
+
+            timeout = self._delay_of(started) if len(queue) > 0 else None
+            done, _ = await asyncio.wait(list(running), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if len(done) == 0:
+                self.hedged += 1
+                p = queue.pop(0)
+                running[asyncio.ensure_future(p.lookup_async(isbn))] = p
+                started = p
+                continue
+
+            for f in done:
+                running.pop(f)
+                try:
+                    book = f.result()
+                except ProviderError as e:
+                    error = e
+                    continue
+
+                if book is not None:
+                    return book
+
+        if error is not None:
+            raise error
+        return None
+
+    def stats(self):
+        return {
+            'hedged': self.hedged,
+            'providers': [p.stats() for p in self.ordered()],
+        }
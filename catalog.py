@@ -0,0 +1,283 @@
+'''bulk import / export of the book catalog
+
+    python catalog.py import books.jsonl [--format csv] [--batch 5000] [--mode upsert|ignore]
+    python catalog.py export books.jsonl [--format csv] [--chunk 5000]
+
+records are json lines or csv rows with Book columns (as written by export),
+isbn service records (jisuapi "result" fields) are accepted too. the database
+is the one of main.py, FLASKR_SETTINGS is read the same way.
+
+import inserts in batches, one transaction each, and keeps a checkpoint file
+(<file>.checkpoint) after every batch: an interrupted import started again
+with the same file continues after the last batch committed. export reads the
+table by chunks of isbn order, both run in flat memory whatever the size.
+books replaced by an import are dropped from the shared book cache of the
+server (BOOK_CACHE_DIR) if it has one; in memory caches of running workers
+catch up within BOOK_CACHE_LOCAL_TTL.
+'''
+import os, sys, csv, json, time, argparse
+
+from flask import Flask
+from sqlalchemy import text
+
+from dao import db, Book
+from utils import URL_COVER_PIC_ROOT
+from sqlite_tuning import DEFAULT_PRAGMAS, tune_sqlite
+from book_cache import FileCacheBackend
+
+COLUMNS = [c.key for c in Book.__table__.columns]
+
+
+def create_app():
+    '''app bound to the database of main.py, without starting its services'''
+    app = Flask(__name__)
+    db_full_path = os.path.join(app.root_path, 'bookshelf.db')
+    app.config.update(dict(
+        SQLALCHEMY_DATABASE_URI='sqlite:///' + db_full_path,
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+    ))
+    app.config.from_envvar('FLASKR_SETTINGS', silent=True)
+    db.init_app(app)
+    return app
+
+
+def book_row(r):
+    '''row of table book from a record, None if it lacks a valid isbn, title or author'''
+    try:
+        isbn = int(r['isbn'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if not r.get('title') or not r.get('author'):
+        return None
+
+    row = dict((c, r.get(c) if r.get(c) != '' else None) for c in COLUMNS)
+    row['isbn'] = isbn
+    if 'org_pic' not in r:
+        # isbn service record: pic is the picture to download, served locally
+        row['pub_date'] = r.get('pub_date', r.get('pubdate'))
+        row['content'] = r.get('content', r.get('class'))
+        row['org_pic'] = r.get('pic') or None
+        row['pic'] = None if row['org_pic'] is None else \
+            URL_COVER_PIC_ROOT + str(isbn) + '.' + row['org_pic'].split('.')[-1]
+
+    for c, kind in (('isbn10', int), ('page', int), ('price', float)):
+        try:
+            row[c] = None if row[c] is None else kind(row[c])
+        except (TypeError, ValueError):
+            row[c] = None
+    return row
+
+
+class Progress(object):
+    '''rows/sec, printed to stderr every `every` seconds and at the end'''
+
+    def __init__(self, what, every=2.0):
+        self.what = what
+        self.every = every
+        self.rows = 0
+        self.start = self.last = time.monotonic()
+
+    def add(self, n):
+        self.rows += n
+        now = time.monotonic()
+        if now - self.last >= self.every:
+            self.last = now
+            self.report()
+
+    def rate(self):
+        elapsed = time.monotonic() - self.start
+        return self.rows / elapsed if elapsed > 0 else 0.0
+
+    def report(self, end=False):
+        print('%s%s %d rows, %.0f rows/s' % ('done, ' if end else '', self.what, self.rows, self.rate()),
+              file=sys.stderr)
+
+
+class Checkpoint(object):
+    '''position in the input after the last batch committed'''
+
+    def __init__(self, source):
+        self.path = source + '.checkpoint'
+        st = os.stat(source)
+        self.source = {'size': st.st_size, 'mtime': st.st_mtime}
+        self.offset = 0     # bytes, json lines
+        self.records = 0    # records read, csv
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if saved.get('source') != self.source:
+            print('%s is of another version of the input, starting over' % self.path, file=sys.stderr)
+            return False
+
+        self.offset = saved['offset']
+        self.records = saved['records']
+        return True
+
+    def save(self, offset, records):
+        self.offset, self.records = offset, records
+        tmp_name = self.path + '.tmp'
+        with open(tmp_name, 'w') as f:
+            json.dump({'source': self.source, 'offset': offset, 'records': records}, f)
+        os.replace(tmp_name, self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def read_jsonl(f, checkpoint):
+    '''(record, offset after it, records read) from a binary file, from the checkpoint on'''
+    f.seek(checkpoint.offset)
+    offset, records = checkpoint.offset, checkpoint.records
+    for line in f:
+        offset += len(line)
+        records += 1
+        line = line.strip()
+        if len(line) > 0:
+            try:
+                yield json.loads(line.decode('utf-8')), offset, records
+            except ValueError:
+                yield None, offset, records
+
+
+def read_csv(f, checkpoint):
+    '''(record, offset, records read) from a text file with a header row, from the checkpoint on'''
+    records = 0
+    for r in csv.DictReader(f):
+        records += 1
+        if records > checkpoint.records:
+            yield r, 0, records
+
+
+def import_books(path, fmt, batch_size, mode, cache=None):
+    checkpoint = Checkpoint(path)
+    if checkpoint.load():
+        print('resuming after record %d' % checkpoint.records, file=sys.stderr)
+
+    if fmt == 'csv':
+        f = open(path, encoding='utf-8', newline='')
+        records = read_csv(f, checkpoint)
+    else:
+        f = open(path, 'rb')
+        records = read_jsonl(f, checkpoint)
+
+    # upsert: a record replaces the book of the same isbn; ignore: existing books are kept
+    statement = Book.__table__.insert().prefix_with('OR REPLACE' if mode == 'upsert' else 'OR IGNORE')
+    progress = Progress('imported')
+    skipped = 0
+    batch = []
+    position = (checkpoint.offset, checkpoint.records)
+
+    def flush():
+        if len(batch) > 0:
+            with db.engine.begin() as conn:
+                # rows replaced by OR REPLACE must fire the delete trigger of book_fts
+                conn.execute(text('PRAGMA recursive_triggers = ON'))
+                conn.execute(statement, batch)
+            if cache is not None and mode == 'upsert':
+                for row in batch:
+                    cache.delete(row['isbn'])
+        checkpoint.save(*position)
+        progress.add(len(batch))
+        del batch[:]
+
+    with f:
+        for r, offset, n in records:
+            row = None if r is None else book_row(r)
+            if row is None:
+                skipped += 1
+                if skipped <= 10:
+                    print('skipped record %d: %s' % (n, r), file=sys.stderr)
+            else:
+                batch.append(row)
+
+            position = (offset, n)
+            if len(batch) >= batch_size:
+                flush()
+        flush()
+
+    progress.report(end=True)
+    if skipped > 0:
+        print('%d invalid records skipped' % skipped, file=sys.stderr)
+    checkpoint.remove()
+
+
+def export_books(path, fmt, chunk_size):
+    f = sys.stdout if path == '-' else open(path, 'w', encoding='utf-8', newline='')
+    writer = None
+    if fmt == 'csv':
+        writer = csv.DictWriter(f, COLUMNS)
+        writer.writeheader()
+
+    table = Book.__table__
+    progress = Progress('exported')
+    last = None
+    try:
+        while True:
+            # keyset by isbn, every chunk is an index range scan
+            query = table.select().order_by(table.c.isbn).limit(chunk_size)
+            if last is not None:
+                query = query.where(table.c.isbn > last)
+
+            with db.engine.connect() as conn:
+                rows = [dict(zip(COLUMNS, row)) for row in conn.execute(query)]
+            if len(rows) == 0:
+                break
+
+            for row in rows:
+                if writer is not None:
+                    writer.writerow(row)
+                else:
+                    f.write(json.dumps(row, ensure_ascii=False))
+                    f.write('\n')
+            last = rows[-1]['isbn']
+            progress.add(len(rows))
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+    progress.report(end=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='bulk import / export of the book catalog')
+    commands = parser.add_subparsers(dest='command')
+
+    p = commands.add_parser('import', help='load books from a json lines or csv file')
+    p.add_argument('file')
+    p.add_argument('--format', choices=['jsonl', 'csv'])
+    p.add_argument('--batch', type=int, default=5000, help='rows per transaction')
+    p.add_argument('--mode', choices=['upsert', 'ignore'], default='upsert')
+
+    p = commands.add_parser('export', help='write all books to a json lines or csv file (- for stdout)')
+    p.add_argument('file')
+    p.add_argument('--format', choices=['jsonl', 'csv'])
+    p.add_argument('--chunk', type=int, default=5000, help='rows read per query')
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 1
+
+    fmt = args.format or ('csv' if args.file.lower().endswith('.csv') else 'jsonl')
+    app = create_app()
+    with app.app_context():
+        tune_sqlite(db.engine, app.config.get('SQLITE_PRAGMAS', DEFAULT_PRAGMAS))
+        db.create_all()
+        if args.command == 'import':
+            cache = FileCacheBackend(app.config['BOOK_CACHE_DIR']) if app.config.get('BOOK_CACHE_DIR') else None
+            import_books(args.file, fmt, args.batch, args.mode, cache)
+        else:
+            export_books(args.file, fmt, args.chunk)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
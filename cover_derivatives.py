@@ -0,0 +1,151 @@
+import os, io, hashlib, threading
+
+try:
+    from PIL import Image
+except ImportError:
+    # no resizing without pillow (the standard library decodes neither jpeg nor png):
+    # every size is served from the original picture, Book.pic_sizes only lists 'o'
+    Image = None
+
+from utils import COVER_PIC_DIR, COVER_SIZES
+
+
+ORIGINAL_SUFFIXES = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+MIMETYPES = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png',
+             '.gif': 'image/gif', '.webp': 'image/webp'}
+
+
+def can_resize():
+    return Image is not None
+
+
+def can_webp():
+    if Image is None:
+        return False
+    try:
+        from PIL import features
+        return features.check('webp')
+    except ImportError:
+        return False
+
+
+class CoverDerivatives(object):
+    '''thumbnails of cover pictures, in the sizes of COVER_SIZES (longest edge, px)
+
+    derivatives are generated on first request (or by generate() when a cover
+    is downloaded) below <cover_dir>/.thumb/<size>/, and described by
+    (path, mimetype, etag) where etag is a hash of the content. without
+    pillow, or for size 'o', the original picture is served.
+    '''
+
+    THUMB_DIR = '.thumb'
+
+    def __init__(self, cover_dir=COVER_PIC_DIR, sizes=COVER_SIZES, quality=80):
+        self.cover_dir = cover_dir
+        self.sizes = dict(sizes)
+        self.quality = quality
+        self.generated = 0
+        self._known = {}    # (isbn, size, webp) -> (path, mimetype, etag)
+        self._lock = threading.Lock()
+
+    def original(self, isbn):
+        '''path of the original cover of isbn, None if not downloaded'''
+        for suffix in ORIGINAL_SUFFIXES:
+            path = os.path.join(self.cover_dir, '%d%s' % (isbn, suffix))
+            if os.path.exists(path):
+                return path
+        return None
+
+    def get(self, isbn, size='o', webp=False):
+        '''(path, mimetype, etag) of a cover derivative, None if there's no cover'''
+        if size not in self.sizes or Image is None:
+            # unknown sizes are the original, and aren't kept apart: size comes from any client
+            size, webp = 'o', False
+        key = (isbn, size, webp)
+        found = self._known.get(key)
+        if found is not None and os.path.exists(found[0]):
+            return found
+
+        found = self._make(isbn, size, webp)
+        if found is not None:
+            with self._lock:
+                self._known[key] = found
+        return found
+
+    def generate(self, isbn):
+        '''(re)generate all sizes of isbn, e.g. right after its cover was downloaded'''
+        self.invalidate(isbn)
+        for size in self.sizes:
+            self.get(isbn, size)
+
+    def invalidate(self, isbn):
+        with self._lock:
+            for key in [k for k in self._known if k[0] == isbn]:
+                del self._known[key]
+
+        for size in self.sizes:
+            for suffix in ('.jpg', '.png', '.webp'):
+                try:
+                    os.remove(self._path(isbn, size, suffix))
+                except OSError:
+                    pass
+
+    def _path(self, isbn, size, suffix):
+        return os.path.join(self.cover_dir, self.THUMB_DIR, size, '%d%s' % (isbn, suffix))
+
+    def _make(self, isbn, size, webp):
+        original = self.original(isbn)
+        if original is None:
+            return None
+
+        if size not in self.sizes or Image is None:
+            return self._describe(original)
+
+        try:
+            image = Image.open(original)
+            image.thumbnail((self.sizes[size], self.sizes[size]))
+        except (IOError, ValueError) as e:
+            print(e)
+            return self._describe(original)
+
+        if webp and can_webp():
+            suffix, kind = '.webp', 'WEBP'
+        elif image.mode in ('RGBA', 'LA', 'P'):
+            suffix, kind = '.png', 'PNG'
+        else:
+            suffix, kind = '.jpg', 'JPEG'
+
+        path = self._path(isbn, size, suffix)
+        if os.path.exists(path):
+            return self._describe(path)
+
+        buf = io.BytesIO()
+        if kind == 'PNG':
+            image.save(buf, kind, optimize=True)
+        else:
+            image.convert('RGB').save(buf, kind, quality=self.quality)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_name = '%s.tmp-%d' % (path, threading.get_ident())
+        with open(tmp_name, 'wb') as f:
+            f.write(buf.getvalue())
+        os.replace(tmp_name, path)
+
+        self.generated += 1
+        return path, MIMETYPES[suffix], hashlib.sha1(buf.getvalue()).hexdigest()
+
+    @staticmethod
+    def _describe(path):
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                h.update(chunk)
+
+        suffix = os.path.splitext(path)[1].lower()
+        return path, MIMETYPES.get(suffix, 'application/octet-stream'), h.hexdigest()
+
+    def stats(self):
+        return {'known': len(self._known), 'generated': self.generated, 'resize': can_resize()}
+
+
+cover_derivatives = CoverDerivatives()
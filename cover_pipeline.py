@@ -0,0 +1,415 @@
+import os, time, json, asyncio, threading, tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils import COVER_PIC_DIR
+from profiling import timed
+from async_http import http_get, HTTPError
+
+COVER_MAX_SIZE = 2 * 1024 * 1024     # bytes
+COVER_TIMEOUT = (3.05, 20)          # connect / read timeout, seconds
+CHUNK_SIZE = 64 * 1024
+
+# result of fetch_cover
+DOWNLOADED = 'downloaded'
+NOT_MODIFIED = 'not_modified'
+FAILED = 'failed'
+
+_session = requests.Session()
+_session.mount('http://', HTTPAdapter(pool_maxsize=8, max_retries=0))
+_session.mount('https://', HTTPAdapter(pool_maxsize=8, max_retries=0))
+
+
+
+def cover_source(book):
+    '''url to download the cover of book from, None if it has none'''
+    if book.org_pic is not None:
+        return book.org_pic
+    if book.pic is not None and book.pic.startswith(('http://', 'https://')):
+        return book.pic
+    return None
+
+
+def cover_file_name(isbn, url, cover_dir=COVER_PIC_DIR):
+    suffix = '.' + url.split('.')[-1]
+    return os.path.join(cover_dir, str(isbn) + suffix)
+
+
+@timed('cover_download')
+def fetch_cover(file_url, file_name, etag=None, last_modified=None, max_size=COVER_MAX_SIZE):
+    '''download file_url to file_name, conditionally if etag / last_modified of
+    the current file are given. the picture is streamed into a temporary file
+    which replaces file_name only when complete, so a half written file is
+    never visible. returns (DOWNLOADED | NOT_MODIFIED | FAILED, validators)
+    where validators is a dict of etag / last_modified of the new picture
+    '''
+    headers = {}
+    if etag is not None:
+        headers['If-None-Match'] = etag
+    if last_modified is not None:
+        headers['If-Modified-Since'] = last_modified
+
+    tmp_name = None
+    try:
+        with _session.get(file_url, headers=headers, stream=True, timeout=COVER_TIMEOUT) as r:
+            if r.status_code == 304:
+                return NOT_MODIFIED, {'etag': etag, 'last_modified': last_modified}
+
+            if r.status_code != 200:
+                print("HTTP Error:", r.status_code, file_url)
+                return FAILED, None
+
+            content_type = r.headers.get('Content-Type', '')
+            if not content_type.startswith('image/'):
+                print("Not an image:", content_type, file_url)
+                return FAILED, None
+
+            if int(r.headers.get('Content-Length') or 0) > max_size:
+                print("Too large:", r.headers['Content-Length'], file_url)
+                return FAILED, None
+
+            fd, tmp_name = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(file_name) or '.')
+            size = 0
+            with os.fdopen(fd, 'wb') as local_file:
+                for chunk in r.iter_content(CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > max_size:
+                        print("Too large:", size, file_url)
+                        return FAILED, None
+                    local_file.write(chunk)
+
+            os.replace(tmp_name, file_name)
+            tmp_name = None
+            return DOWNLOADED, {'etag': r.headers.get('ETag'),
+                                'last_modified': r.headers.get('Last-Modified')}
+
+    #handle errors
+    except requests.RequestException as e:
+        print("URL Error:", e, file_url)
+    except Exception as e:
+        print(e)
+    finally:
+        if tmp_name is not None:
+            try:
+                os.remove(tmp_name)
+            except OSError:
+                pass
+
+    return FAILED, None
+
+
+@timed('cover_download')
+async def fetch_cover_async(file_url, file_name, etag=None, last_modified=None, max_size=COVER_MAX_SIZE):
+    '''fetch_cover() for asyncio code, the picture (at most max_size) is read
+    into memory, then written the same way
+    '''
+    headers = {}
+    if etag is not None:
+        headers['If-None-Match'] = etag
+    if last_modified is not None:
+        headers['If-Modified-Since'] = last_modified
+
+    try:
+        r = await http_get(file_url, headers=headers, timeout=COVER_TIMEOUT, max_size=max_size)
+    except HTTPError as e:
+        print("HTTP Error:", e, file_url)
+        return FAILED, None
+    except (OSError, EOFError, asyncio.TimeoutError) as e:
+        print("URL Error:", e, file_url)
+        return FAILED, None
+
+    if r.status_code == 304:
+        return NOT_MODIFIED, {'etag': etag, 'last_modified': last_modified}
+
+    if r.status_code != 200:
+        print("HTTP Error:", r.status_code, file_url)
+        return FAILED, None
+
+    content_type = r.headers.get('content-type', '')
+    if not content_type.startswith('image/'):
+        print("Not an image:", content_type, file_url)
+        return FAILED, None
+
+    tmp_name = None
+    try:
+        fd, tmp_name = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(file_name) or '.')
+        with os.fdopen(fd, 'wb') as local_file:
+            local_file.write(r.content)
+        os.replace(tmp_name, file_name)
+        tmp_name = None
+    except OSError as e:
+        print(e)
+        return FAILED, None
+    finally:
+        if tmp_name is not None:
+            try:
+                os.remove(tmp_name)
+            except OSError:
+                pass
+
+    return DOWNLOADED, {'etag': r.headers.get('etag'), 'last_modified': r.headers.get('last-modified')}
+
+
+def downloadCoverPic(file_url, file_name):
+    '''download file_url to file_name, returns True on success'''
+    return fetch_cover(file_url, file_name)[0] == DOWNLOADED
+
+
+class CoverFetcher(object):
+    '''downloads cover pictures in background
+
+    ensure() is meant for the request path: it only looks at an in-memory set
+    of isbns whose cover is on disk, and queues a download if it's not there.
+    downloads run on a few worker threads, one per isbn at a time, failed ones
+    are retried with exponential backoff. the set is persisted, one isbn per
+    line, in an index file next to the covers.
+
+    etag / last-modified of every picture are kept in a small json file, so
+    refresh() re-fetches a cover with a conditional GET.
+    '''
+
+    INDEX_FILE = '.present'
+    META_DIR = '.meta'
+
+    def __init__(self, cover_dir=COVER_PIC_DIR, workers=2, retries=3, retry_delay=30,
+                 failure_ttl=86400, max_size=COVER_MAX_SIZE):
+        self.cover_dir = cover_dir
+        self.max_size = max_size
+        self.workers = workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.failure_ttl = failure_ttl
+
+        self.downloaded = 0
+        self.not_modified = 0
+        self.retried = 0
+        self.failed = 0
+
+        self.listeners = []     # called with isbn whenever a cover was (re)downloaded
+
+        self._present = set()
+        self._pending = set()
+        self._given_up = {}     # isbn -> time of the last failed attempt
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._loop = None
+
+    def use_event_loop(self, loop):
+        '''download as coroutines on loop (asgi mode) instead of on the worker threads, None to go back'''
+        self._loop = loop
+
+    def configure(self, workers=None, retries=None, retry_delay=None, failure_ttl=None,
+                  max_size=None):
+        if workers is not None and workers != self.workers:
+            self.workers = workers
+            self._executor = ThreadPoolExecutor(max_workers=workers)
+        if retries is not None:
+            self.retries = retries
+        if retry_delay is not None:
+            self.retry_delay = retry_delay
+        if failure_ttl is not None:
+            self.failure_ttl = failure_ttl
+        if max_size is not None:
+            self.max_size = max_size
+
+    @property
+    def index_path(self):
+        return os.path.join(self.cover_dir, self.INDEX_FILE)
+
+    def _meta_path(self, isbn):
+        return os.path.join(self.cover_dir, self.META_DIR, '%d.json' % isbn)
+
+    def _read_meta(self, isbn):
+        try:
+            with open(self._meta_path(isbn)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_meta(self, isbn, meta):
+        path = self._meta_path(isbn)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_name = path + '.tmp-%d' % threading.get_ident()
+            with open(tmp_name, 'w') as f:
+                json.dump(meta, f)
+            os.replace(tmp_name, path)
+        except OSError as e:
+            print(e)
+
+    def load(self):
+        '''read the set of present covers, built by scanning cover_dir once if there's no index'''
+        present = set()
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                present = set(int(line) for line in f if line.strip().isdigit())
+        elif os.path.isdir(self.cover_dir):
+            for name in os.listdir(self.cover_dir):
+                isbn = name.split('.')[0]
+                if isbn.isdigit():
+                    present.add(int(isbn))
+
+            with open(self.index_path, 'w') as f:
+                f.writelines('%d\n' % isbn for isbn in sorted(present))
+
+        with self._lock:
+            self._present |= present
+            self._loaded = True
+
+    def is_present(self, isbn):
+        return int(isbn) in self._present
+
+    def ensure(self, isbn, url):
+        '''queue a download of the cover of isbn from url, unless it's present or queued already'''
+        if url is None:
+            return
+
+        isbn = int(isbn)
+        if not self._loaded:
+            self.load()
+
+        if isbn in self._present:
+            return
+
+        with self._lock:
+            if isbn in self._pending or isbn in self._present:
+                return
+
+            given_up = self._given_up.get(isbn)
+            if given_up is not None and time.monotonic() - given_up < self.failure_ttl:
+                return
+
+            self._pending.add(isbn)
+
+        self._submit(isbn, url, 0)
+
+    def refresh(self, isbn, url):
+        '''queue a conditional re-fetch of a (present) cover, it's only transferred if changed'''
+        if url is None:
+            return
+
+        isbn = int(isbn)
+        with self._lock:
+            if isbn in self._pending:
+                return
+            self._pending.add(isbn)
+
+        self._submit(isbn, url, 0, True)
+
+    def update(self, isbn, url):
+        '''cover url of isbn (possibly) changed: refresh if present, download otherwise'''
+        if self.is_present(isbn):
+            self.refresh(isbn, url)
+        else:
+            self.ensure(isbn, url)
+
+    def _submit(self, isbn, url, attempt, refresh=False):
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._fetch_async(isbn, url, attempt, refresh), self._loop)
+        else:
+            self._executor.submit(self._fetch, isbn, url, attempt, refresh)
+
+    def _target(self, isbn, url, refresh):
+        '''(file to download url to, validators of the current one), None if there's nothing to do'''
+        file_name = cover_file_name(isbn, url, self.cover_dir)
+        if not os.path.exists(file_name):
+            return file_name, {}
+
+        if not refresh:
+            # another process got it meanwhile
+            self._mark_present(isbn)
+            return None
+
+        meta = self._read_meta(isbn)
+        if meta.get('url') != url:
+            meta = {}
+        return file_name, meta
+
+    def _fetch(self, isbn, url, attempt, refresh=False):
+        target = self._target(isbn, url, refresh)
+        if target is None:
+            return
+
+        file_name, meta = target
+        result, validators = fetch_cover(url, file_name, meta.get('etag'),
+                                         meta.get('last_modified'), self.max_size)
+        self._fetched(isbn, url, attempt, refresh, result, validators)
+
+    async def _fetch_async(self, isbn, url, attempt, refresh=False):
+        try:
+            target = self._target(isbn, url, refresh)
+            if target is None:
+                return
+
+            file_name, meta = target
+            result, validators = await fetch_cover_async(url, file_name, meta.get('etag'),
+                                                         meta.get('last_modified'), self.max_size)
+        except Exception as e:
+            # anything unexpected is a failed download: retried, and isbn no longer pending
+            print(e)
+            result, validators = FAILED, None
+        # bookkeeping and listeners (thumbnails ...) don't belong on the event loop
+        self._executor.submit(self._fetched, isbn, url, attempt, refresh, result, validators)
+
+    def _fetched(self, isbn, url, attempt, refresh, result, validators):
+        if result != FAILED:
+            if result == DOWNLOADED:
+                self._write_meta(isbn, dict(validators, url=url))
+            self._mark_present(isbn, result)
+
+            if result == DOWNLOADED:
+                for listener in self.listeners:
+                    try:
+                        listener(isbn)
+                    except Exception as e:
+                        print(e)
+            return
+
+        if attempt < self.retries:
+            with self._lock:
+                self.retried += 1
+            timer = threading.Timer(self.retry_delay * (2 ** attempt), self._submit,
+                                    (isbn, url, attempt + 1, refresh))
+            timer.daemon = True
+            timer.start()
+            return
+
+        with self._lock:
+            self.failed += 1
+            self._pending.discard(isbn)
+            self._given_up[isbn] = time.monotonic()
+
+    def _mark_present(self, isbn, result=None):
+        with self._lock:
+            if result == DOWNLOADED:
+                self.downloaded += 1
+            elif result == NOT_MODIFIED:
+                self.not_modified += 1
+
+            self._pending.discard(isbn)
+            self._given_up.pop(isbn, None)
+            if isbn in self._present:
+                return
+
+            self._present.add(isbn)
+            try:
+                with open(self.index_path, 'a') as f:
+                    f.write('%d\n' % isbn)
+            except OSError as e:
+                print(e)
+
+    def stats(self):
+        return {
+            'present': len(self._present),
+            'pending': len(self._pending),
+            'downloaded': self.downloaded,
+            'not_modified': self.not_modified,
+            'retried': self.retried,
+            'failed': self.failed,
+        }
+
+
+cover_fetcher = CoverFetcher()
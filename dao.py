@@ -1,10 +1,30 @@
-from datetime import timedelta, datetime
-from flask_sqlalchemy import SQLAlchemy
+from datetime import datetime
+from sqlalchemy import inspect, literal, text
 
-from utils import generate_password_hash, check_password_hash, DATETIME_FORMAT
+from utils import generate_password_hash, check_password_hash, DATETIME_FORMAT, \
+    URL_COVER_ROOT, COVER_SIZES
+from db_routing import RoutingSQLAlchemy
+from cover_derivatives import can_resize
 
 
-db = SQLAlchemy()
+# db.session sends reads of read only code to the read engine, see db_routing
+db = RoutingSQLAlchemy()
+
+
+def ensure_indexes():
+    '''create indexes declared on models but missing in an existing database,
+    db.create_all() skips them as it skips every table that already exists
+    '''
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    for table in db.Model.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+
+        existing = set(ix['name'] for ix in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=db.engine)
 
 
 class User(db.Model):
@@ -53,6 +73,12 @@ class User(db.Model):
 
 class Token(db.Model):
     '''model of user'''
+    __table_args__ = (
+        # per-user live tokens (cap on login) and the expired-token sweeper
+        db.Index('ix_token_user_id_expire_time', 'user_id', 'expire_time'),
+        db.Index('ix_token_expire_time', 'expire_time'),
+    )
+
     token = db.Column(db.String, nullable=False, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     create_time = db.Column(db.DateTime, nullable=False)
@@ -83,6 +109,19 @@ class Token(db.Model):
         return '<Token {}: {} -> {}>'.format(self.token, self.create_time, self.expire_time)
 
 
+class RevokedToken(db.Model):
+    '''model of table revoked_token, denylist of signed (stateless) tokens'''
+    jti = db.Column(db.String, primary_key=True)
+    expire_time = db.Column(db.DateTime, nullable=False)
+
+    def __init__(self, jti, expire_time):
+        self.jti = jti
+        self.expire_time = expire_time
+
+    def __repr__(self):
+        return '<RevokedToken {} -> {}>'.format(self.jti, self.expire_time)
+
+
 class Book(db.Model):
     '''model of table book'''
     isbn = db.Column(db.Integer, primary_key=True)
@@ -121,14 +160,38 @@ class Book(db.Model):
             'page': self.page,
             'price': self.price,
             'pic': self.pic,
+            'pic_sizes': self.pic_sizes(),
             'content': self.content
         }
 
+    def pic_sizes(self):
+        '''urls of the cover by size: 'o' (original) always, thumbnails only when
+        they can be made (pillow installed), None without a cover
+        '''
+        if self.pic is None:
+            return None
+
+        url = '{}{}'.format(URL_COVER_ROOT, self.isbn)
+        sizes = list(COVER_SIZES) if can_resize() else []
+        return dict((size, '{}?size={}'.format(url, size)) for size in sizes + ['o'])
+
+    def copy(self):
+        '''a new, transient book with same column values'''
+        book = Book(self.isbn, self.title, self.author)
+        for column in self.__table__.columns:
+            setattr(book, column.key, getattr(self, column.key))
+        return book
+
     def __repr__(self):
         return '<Book {} - {}>'.format(self.isbn, self.title)
 
 
 class UserBook(db.Model):
+    __table_args__ = (
+        # keyset pagination of a user's shelf: WHERE user_id = ? AND rid > ? ORDER BY rid
+        db.Index('ix_user_book_user_id_rid', 'user_id', 'rid'),
+    )
+
     rid = db.Column(db.Integer, nullable=False,
                     autoincrement=True, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -139,13 +202,13 @@ class UserBook(db.Model):
 
     def __init__(self, user_id, book_isbn, comment):
         self.user_id = user_id
-        self.book = book_isbn
+        self.book_isbn = book_isbn
         self.add_date = datetime.utcnow()
         self.comment = comment
 
     def toJSON(self):
         return {
-            'rid': self.isbn,
+            'rid': self.rid,
             'user_id': self.user_id,
             'book_isbn': self.book_isbn,
             'add_date': self.add_date.strftime(DATETIME_FORMAT),
@@ -153,6 +216,114 @@ class UserBook(db.Model):
         }
 
 
+class ShelfCounter(db.Model):
+    '''model of table shelf_counter, number of books on each user's shelf'''
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    book_count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __init__(self, user_id, book_count):
+        self.user_id = user_id
+        self.book_count = book_count
+
+    @staticmethod
+    def get(user_id):
+        '''books on shelf of user, counted once and maintained by adjust() from then on'''
+        counter = ShelfCounter.query.filter_by(user_id=user_id).first()
+        if counter is not None:
+            return counter.book_count
+
+        # count and insert in one statement on the writer: no add / remove can fall
+        # between them, and a concurrent first count of the same user is a no-op
+        db.session.execute(text('INSERT INTO shelf_counter (user_id, book_count) '
+                                'SELECT :user_id, count(*) FROM user_book WHERE user_id = :user_id '
+                                'ON CONFLICT (user_id) DO NOTHING'), {'user_id': user_id})
+        db.session.commit()
+        # the session wrote, so this reads the writer too
+        return db.session.query(ShelfCounter.book_count).filter_by(user_id=user_id).scalar()
+
+    @staticmethod
+    def adjust(user_id, delta):
+        '''change the counter within the current transaction of the shelf change,
+        a user not counted yet is left alone, get() counts everything later
+        '''
+        ShelfCounter.query.filter_by(user_id=user_id) \
+            .update({ShelfCounter.book_count: ShelfCounter.book_count + delta},
+                    synchronize_session=False)
+
+
+class ShelfChange(db.Model):
+    '''model of table shelf_change, change log of users' shelves for incremental sync
+
+    there's one row per book on shelf (UserBook.rid), holding its latest change:
+    a new change of a book replaces its row by one with a higher version, and a
+    removed book leaves a tombstone. rows of books still on shelf carry their
+    current state (added at `time`, comment), so clients simply upsert them,
+    keep the highest version they've seen and ask for the rows above it.
+    '''
+    __table_args__ = (
+        db.Index('ix_shelf_change_user_id_version', 'user_id', 'version'),
+        # versions must never be reused, even when the newest row is replaced
+        {'sqlite_autoincrement': True},
+    )
+
+    ADD = 'a'
+    COMMENT = 'c'
+    REMOVE = 'd'
+
+    FIELDS = ['version', 'op', 'rid', 'isbn', 'time', 'comment']
+
+    version = db.Column(db.Integer, nullable=False, autoincrement=True, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    rid = db.Column(db.Integer, nullable=False, unique=True)
+    book_isbn = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(1), nullable=False)
+    comment = db.Column(db.Text)
+    time = db.Column(db.DateTime, nullable=False)
+
+    def __init__(self, user_id, rid, book_isbn, op, comment, time):
+        self.user_id = user_id
+        self.rid = rid
+        self.book_isbn = book_isbn
+        self.op = op
+        self.comment = comment
+        self.time = time
+
+    @staticmethod
+    def record(user_book, op):
+        '''log a change of user_book (flushed, so it has a rid) within the current transaction'''
+        ShelfChange.record_all([user_book], op)
+
+    @staticmethod
+    def record_all(user_books, op):
+        '''log the same change of many books, replacing their previous rows in one statement'''
+        # a book just added may have one too: sqlite hands the rid of the newest removed
+        # book (its tombstone) out again, clients upserting by rid take the new row over it
+        ShelfChange.query.filter(ShelfChange.rid.in_([ub.rid for ub in user_books])) \
+            .delete(synchronize_session=False)
+
+        now = datetime.utcnow()
+        db.session.add_all([ShelfChange(ub.user_id, ub.rid, ub.book_isbn, op,
+                                        None if op == ShelfChange.REMOVE else ub.comment,
+                                        now if op == ShelfChange.REMOVE else ub.add_date)
+                            for ub in user_books])
+
+    @staticmethod
+    def backfill():
+        '''log books put on shelves before there was a change log, as added'''
+        logged = db.session.query(ShelfChange.rid)
+        rows = db.session.query(UserBook.user_id, UserBook.rid, UserBook.book_isbn,
+                                literal(ShelfChange.ADD), UserBook.comment, UserBook.add_date) \
+            .filter(~UserBook.rid.in_(logged))
+        db.session.execute(ShelfChange.__table__.insert().from_select(
+            ['user_id', 'rid', 'book_isbn', 'op', 'comment', 'time'], rows))
+        db.session.commit()
+
+    def toJSON(self):
+        '''compact form, a list in the order of FIELDS'''
+        return [self.version, self.op, self.rid, self.book_isbn,
+                self.time.strftime('%Y-%m-%dT%H:%M:%S'), self.comment]
+
+
 class CheckRecord(db.Model):
     '''model of table check_record'''
     isbn = db.Column(db.Integer, primary_key=True)
@@ -0,0 +1,95 @@
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine, orm
+from sqlalchemy.sql import Select
+
+try:
+    # flask-sqlalchemy 3
+    from flask_sqlalchemy.session import Session as _Session
+except ImportError:
+    from flask_sqlalchemy import SignallingSession as _Session
+
+
+# engine of read connections, None: everything goes to the writer (db.engine)
+_read_engine = None
+
+
+def read_engine():
+    return _read_engine
+
+
+def set_read_engine(engine):
+    '''route reads of read only code to engine, None to stop routing'''
+    global _read_engine
+    old, _read_engine = _read_engine, engine
+    if old is not None and old is not engine:
+        old.dispose()
+
+
+def create_read_engine(uri, options=None):
+    return create_engine(uri, **(options or {}))
+
+
+def is_reading():
+    return has_app_context() and g.get('_db_reading', 0) > 0
+
+
+@contextmanager
+def reading():
+    '''queries run within go to the read engine (if any), writes still go to the writer'''
+    if not has_app_context():
+        yield
+        return
+
+    g._db_reading = g.get('_db_reading', 0) + 1
+    try:
+        yield
+    finally:
+        g._db_reading -= 1
+
+
+def read_only(func):
+    '''decorator of resource methods that (mostly) read, their queries use the read engine'''
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with reading():
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+class RoutingSession(_Session):
+    '''session sending SELECTs of read only code to the read engine,
+    flushes, bulk updates / deletes and everything else to the writer.
+    once the session wrote, it reads from the writer too, so a replica
+    lagging behind never hides the session's own writes
+    '''
+
+    _db_wrote = False
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        engine = _read_engine
+        if engine is not None and not self._db_wrote:
+            if not self._flushing and isinstance(clause, Select) and is_reading():
+                return engine
+
+        if self._flushing or (clause is not None and not isinstance(clause, Select)):
+            self._db_wrote = True
+        return _Session.get_bind(self, mapper, clause, **kwargs)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    '''SQLAlchemy whose db.session is a RoutingSession'''
+
+    def __init__(self, **kwargs):
+        if _Session.__module__ == 'flask_sqlalchemy.session':
+            kwargs.setdefault('session_options', {}).setdefault('class_', RoutingSession)
+        SQLAlchemy.__init__(self, **kwargs)
+
+    def create_session(self, options):
+        # flask-sqlalchemy 2, 3 takes the class from session_options
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
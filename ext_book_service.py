@@ -1,104 +1,218 @@
-import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import os, threading, time, uuid, asyncio
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-import requests
-import urllib.request
-from urllib.error import HTTPError, URLError
+from flask import current_app
 
-from dao import Book
-from utils import URL_COVER_PIC_ROOT, COVER_PIC_DIR
+from singleflight import SingleFlight, LoopExecutor
+from provider_client import ProviderError
+from book_providers import BookResolver, JisuProvider
+from cover_pipeline import cover_fetcher
+from utils import URL_COVER_PIC_ROOT
+from profiling import timed
 
 
-_lock = threading.Lock()
-_query_queue = {}
 _executor = ThreadPoolExecutor()
+_resolver = BookResolver([JisuProvider(os.environ.get('ISBN_API_APPKEY', ''))])
 
+# concurrent (and, within retention, subsequent) queries of an isbn share one upstream call
+_flight = SingleFlight(_executor, retention=5)
+# function querying an isbn, run by the executor of _flight
+_query = None
 
+# lookup jobs for the non-blocking (202 + polling) path
+LOOKUP_JOB_RETENTION = 600     # seconds a finished job can still be polled
+_jobs_lock = threading.Lock()
+_jobs = {}          # job id -> LookupJob
+_pending_jobs = {}  # isbn -> LookupJob still running
+# called on a worker thread with every LookupJob that finished, e.g. to save its result
+lookup_listeners = []
+
+
+class LookupJob(object):
+    '''a background query of one isbn, shared by every client asking for it'''
+
+    def __init__(self, isbn, future):
+        # <isbn>-<unix time started>-<random>: a worker that didn't start the job
+        # can still answer polls of it from db, see parse_job_id()
+        self.id = '%s-%d-%s' % (isbn, int(time.time()), uuid.uuid4().hex[:16])
+        self.isbn = isbn
+        self.future = future
+        self.created = time.monotonic()
+        self._claimed = False
+
+    def done(self):
+        return self.future.done()
+
+    def wait(self, timeout):
+        '''wait at most timeout seconds, returns True if job finished'''
+        return len(wait([self.future], timeout).done) > 0
+
+    def result(self):
+        '''Book or None, blocks until job finished'''
+        return _copy(self.future.result())
+
+    def claim(self):
+        '''True for exactly one caller, the one who should save the result'''
+        with _jobs_lock:
+            claimed = self._claimed
+            self._claimed = True
+            return not claimed
+
+    def release(self):
+        '''let the next caller claim the job, e.g. after saving its result failed'''
+        with _jobs_lock:
+            self._claimed = False
+
+
+def _copy(book):
+    # a shared result is handed to several callers (and sessions), each gets its own instance
+    return None if book is None else book.copy()
+
+
+@timed('upstream_wait')
 def queue_to_get_book_info(isbn):
     '''add a book query request into queue, if a request (same isbn) already exist, wait for it'''
-    _lock.acquire()
-    if isbn in _query_queue:
-        f = _query_queue[isbn]
-        _lock.release()
-        if f is None:
-            return None
-        else:
-            return f.result()
+    return _copy(submit_book_query(isbn).result())
+
+
+def submit_book_query(isbn):
+    '''like queue_to_get_book_info, but returns the (shared) future without waiting'''
+    return _flight.submit(isbn, _query or query_book_from_internet, isbn)
+
+
+def use_event_loop(loop):
+    '''run queries as coroutines on loop (asgi mode) instead of on threads, None to go back'''
+    global _query
+    if loop is None:
+        _flight.executor, _query = _executor, None
     else:
-        f = _executor.submit(query_book_from_internet, isbn)
-        _query_queue[isbn] = f
-        _lock.release()
+        _flight.executor, _query = LoopExecutor(loop), query_book_from_internet_async
 
-        book = f.result()
-        try:
-            del _query_queue[isbn]
-        except KeyError:
-            pass
-        return book
 
-def query_book_from_internet(isbn):
-    '''try get book info from internet'''
+@timed('upstream_wait')
+def query_books(isbns, max_concurrency=8):
+    '''query many isbns, at most max_concurrency of them in flight at a time,
+    returns a dict isbn -> Book (or None if not found), isbns failed to query are missing
+    '''
+    books = {}
+    pending = {}
+    isbns = list(set(isbns))
+    while len(isbns) > 0 or len(pending) > 0:
+        while len(isbns) > 0 and len(pending) < max_concurrency:
+            isbn = isbns.pop(0)
+            pending[submit_book_query(isbn)] = isbn
+
+        done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+        for f in done:
+            isbn = pending.pop(f)
+            try:
+                books[isbn] = _copy(f.result())
+            except ProviderError as e:
+                # unknown, rather than not found: left out of result
+                current_app.logger.warning('book query of %s failed: %s', isbn, e)
+
+    return books
+
+
+async def query_books_async(isbns, max_concurrency=8, logger=None):
+    '''query_books() for asyncio code: waits as coroutines, not threads.
+    there's no app context on the event loop, failures go to logger
+    '''
+    semaphore = asyncio.Semaphore(max_concurrency)
+    books = {}
+
+    async def query(isbn):
+        async with semaphore:
+            try:
+                # shielded: the query is shared with other callers
+                books[isbn] = _copy(await asyncio.shield(asyncio.wrap_future(submit_book_query(isbn))))
+            except ProviderError as e:
+                # unknown, rather than not found: left out of result
+                if logger is not None:
+                    logger.warning('book query of %s failed: %s', isbn, e)
+
+    await asyncio.gather(*(query(isbn) for isbn in set(isbns)))
+    return books
+
+
+def set_query_retention(seconds):
+    '''how long a finished query is reused by callers arriving after it'''
+    _flight.retention = seconds
+
+
+def query_stats():
+    '''counters of upstream queries issued vs. coalesced into a running/retained one'''
+    return _flight.stats()
+
+
+def start_lookup(isbn):
+    '''start (or join) a background query of isbn, returns its LookupJob'''
+    now = time.monotonic()
+    with _jobs_lock:
+        # forget jobs nobody polled for long enough
+        for job_id in [k for k, j in _jobs.items() if now - j.created > LOOKUP_JOB_RETENTION]:
+            del _jobs[job_id]
+
+        job = _pending_jobs.get(isbn)
+        if job is not None and not job.done():
+            return job
+
+        job = LookupJob(isbn, submit_book_query(isbn))
+        _jobs[job.id] = job
+        _pending_jobs[isbn] = job
+
+    job.future.add_done_callback(lambda _: _finish_job(job))
+    return job
+
+
+def _finish_job(job):
+    with _jobs_lock:
+        if _pending_jobs.get(job.isbn) is job:
+            del _pending_jobs[job.isbn]
+
+    # not on the thread (or event loop) that ran the query
+    for listener in lookup_listeners:
+        _executor.submit(listener, job)
+
+
+def get_lookup(job_id):
+    '''LookupJob by id, None if unknown or expired'''
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+def parse_job_id(job_id):
+    '''(isbn, unix time started) of a job id of any worker, None if malformed'''
     try:
-        response = requests.get('http://api.jisuapi.com/isbn/query?appkey=fcb21d46d079130b&isbn=' \
-                    + str(isbn))
-
-        # fake json service
-        # response = requests.get('http://jsonplaceholder.typicode.com/users')
-
-        # free weather service
-        # response = requests.get('http://api.openweathermap.org/data/2.5/weather?appid=7f22b3079794cc7bb5970bddf8b308ee&units=metric&lang=zh_cn&q=changsha,cn')
-
-        data = response.json()
-
-        if data['status'] == '0':
-            # got book info
-            r = data['result']
-
-            b = Book(r['isbn'], r['title'], r['author'])
-            b.isbn10 = r['isbn10']
-            b.subtitle = r['subtitle']
-            b.summary = r['summary']
-            b.publisher = r['publisher']
-            b.pub_date = r['pub_date']
-            b.binding = r['binding']
-            b.page = r['page']
-            b.price = r['price']
-            b.org_pic = r['pic']
-            b.content = r['class']
-
-            # download pic
-            if r['pic'] is not None:
-                suffix = '.' + r['pic'].split('.')[-1]
-                b.pic = URL_COVER_PIC_ROOT + r['isbn'] + suffix
-                downloadCoverPic(r['pic'], COVER_PIC_DIR + r['isbn'] + suffix)
-
-            return b
-        else:
-            return None
-    except Exception as e:
-        print(e)
+        isbn, started, _ = job_id.split('-')
+        return int(isbn), int(started)
+    except ValueError:
         return None
 
-#function that downloads a file
-# def downloadFile(file_url, file_name, file_mode):
-def downloadCoverPic(file_url, file_name):
-    # Open the url
-    try:
-        f = urllib.request.urlopen(file_url)
-        # print("downloading ", file_url)
-
-        # Open our local file for writing
-        local_file = open(file_name, "wb")
-
-        #Write to our local file
-        local_file.write(f.read())
-        local_file.close()
-
-    #handle errors
-    except HTTPError as e:
-        print("HTTP Error:", e.code, file_url)
-    except URLError as e:
-        print("URL Error:", e.reason, file_url)
-    except Exception as e:
-        print(e)
-        
\ No newline at end of file
+
+def set_book_resolver(resolver):
+    '''replace the providers used to query book info, see book_providers.BookResolver'''
+    global _resolver
+    _resolver = resolver
+
+
+def query_book_from_internet(isbn):
+    '''try get book info from internet
+    returns None if the book is not found, raises ProviderError if the providers are unavailable
+    '''
+    return _with_cover(_resolver.resolve(isbn))
+
+
+async def query_book_from_internet_async(isbn):
+    '''query_book_from_internet() for asyncio code'''
+    return _with_cover(await _resolver.resolve_async(isbn))
+
+
+def _with_cover(b):
+    # download pic, in background
+    if b is not None and b.org_pic is not None:
+        suffix = '.' + b.org_pic.split('.')[-1]
+        b.pic = URL_COVER_PIC_ROOT + str(b.isbn) + suffix
+        cover_fetcher.update(b.isbn, b.org_pic)
+
+    return b
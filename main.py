@@ -1,18 +1,34 @@
-import os, threading, re, hashlib, json
+import os, threading, re, hashlib, json, time
 from datetime import timedelta, datetime
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from sqlalchemy.exc import IntegrityError, DatabaseError
+from sqlalchemy.orm import joinedload
 from flask import Flask, render_template, request, session, g, \
-    redirect, url_for, abort, flash
+    redirect, url_for, abort, flash, send_file, make_response
 from flask_restful import Resource, Api
 from flask_sqlalchemy import SQLAlchemy
 import traceback
 import requests
 
 from dao import *
-from auth import TokenCheck, generate_token
-from utils import COVER_PIC_DIR, email_regex, check_and_fix_isbn
-from ext_book_service import queue_to_get_book_info, downloadCoverPic
+from auth import TokenCheck, generate_token, init_token_cache, cache_token, \
+    issue_signed_token, revoke_token, bearer_token, limit_user_tokens, token_cache_stats, \
+    TOKEN_MODE_SIGNED
+from token_sweeper import TokenSweeper
+from utils import COVER_PIC_DIR, email_regex, check_and_fix_isbn, json_dumps
+from ext_book_service import queue_to_get_book_info, start_lookup, get_lookup, parse_job_id, \
+    set_query_retention, query_books, set_book_resolver, lookup_listeners, LOOKUP_JOB_RETENTION
+from provider_client import ProviderError
+from book_providers import BookResolver, create_provider
+from cover_pipeline import cover_fetcher, cover_source
+from cover_derivatives import cover_derivatives
+from sqlite_tuning import DEFAULT_PRAGMAS, engine_options, tune_sqlite, is_memory
+from db_routing import read_only, create_read_engine, set_read_engine, read_engine
+from search import ensure_book_fts, search_books
+from book_cache import book_cache, FileCacheBackend
+from miss_cache import miss_cache
+from profiling import Profiler, span
+from slow_query_log import SlowQueryLog
 
 # pylint: disable=C0103
 
@@ -28,20 +44,181 @@ app.config.update(dict(
     SQLALCHEMY_TRACK_MODIFICATIONS='true',
     SECRET_KEY='development key',
     USERNAME='admin',
-    PASSWORD='default'
+    PASSWORD='default',
+    TOKEN_CACHE_SIZE=4096,      # max cached tokens, 0 disables the cache
+    TOKEN_CACHE_TTL=300,        # seconds, a cached token's user is re-read after this (revocation is checked on every use)
+    TOKEN_MODE='opaque',        # 'opaque' (table token) or 'signed' (stateless, signed by SECRET_KEY)
+    TOKEN_DENYLIST_REFRESH=30,  # seconds between reloads of revoked signed tokens
+    TOKEN_MAX_PER_USER=10,      # live opaque tokens kept per user, oldest ones are dropped on login
+    TOKEN_SWEEP_INTERVAL=600,   # seconds between expired token sweeps, 0 disables the sweeper
+    TOKEN_SWEEP_BATCH=500,      # rows deleted per sweep transaction
+    BOOK_LOOKUP_ASYNC=0,        # 1: a book not in db is looked up in background, GET /book returns 202
+    BOOK_LOOKUP_MAX_WAIT=30,    # seconds, upper bound of ?wait= on /book/lookup/<job>
+    BOOK_QUERY_RETENTION=5,     # seconds a finished isbn query is reused by later callers
+    BOOKS_LOOKUP_MAX=100,       # max isbns per POST /books/lookup
+    BOOKS_LOOKUP_CONCURRENCY=8, # max upstream queries in flight for one POST /books/lookup
+    BOOK_CACHE_SIZE=4096,       # books kept in memory by each worker process, 0 disables that cache
+    BOOK_CACHE_TTL=3600,        # seconds, a cached book is read again from db after this
+    BOOK_CACHE_DIR=None,        # directory of a book cache shared by the workers of a host, None: no shared cache
+    BOOK_CACHE_LOCAL_TTL=10,    # seconds, ttl of the in memory cache when there's a shared one
+    BOOK_RECHECK_DELAY=86400,   # seconds before a book not found is looked up again, doubled by every miss
+    BOOK_RECHECK_MAX_DELAY=30 * 86400,
+    BOOK_MISS_CACHE_SIZE=10000, # check records kept in memory, so a repeated miss costs no query
+    BOOK_MISS_CACHE_TTL=3600,
+    BOOK_MISS_FLUSH_INTERVAL=2, # seconds between batched check record writes, 0: written at once
+    BOOK_MISS_BLOOM_CAPACITY=0, # > 0: bloom filter of checked isbns (~1.2 bytes each), skips queries for new ones
+    BOOKS_SEARCH_PER_PAGE=20,   # default (and max) results per page of /books/search
+    BOOKS_SEARCH_MAX_PAGES=50,  # deeper pages of a ranked search are refused
+    BOOKS_SEARCH_RANK_LIMIT=5000,   # matches ranked at most, broader queries are ranked among the first ones
+    BOOKS_SEARCH_SCAN_LIMIT=50000,  # books read at most by a query of terms too short for the index (2 chinese characters ...)
+    BOOK_PROVIDERS=[{'type': 'jisu'}],  # tried in order (then by stats), e.g. {'type': 'file', 'path': 'books.jsonl'}
+    BOOK_PROVIDER_HEDGE_DELAY=None,     # seconds before asking the next provider too, None: its p95 latency
+    BOOK_PROVIDER_HEDGE_PERCENTILE=0.95,
+    ISBN_API_APPKEY=os.environ.get('ISBN_API_APPKEY', 'fcb21d46d079130b'),
+    ISBN_API_POOL_SIZE=10,      # pooled connections to the isbn service
+    ISBN_API_CONNECT_TIMEOUT=3.05,
+    ISBN_API_READ_TIMEOUT=10,
+    ISBN_API_RETRIES=2,         # retries of a failed request, with jittered exponential backoff
+    ISBN_API_FAILURE_THRESHOLD=5,   # consecutive failures opening the circuit breaker
+    ISBN_API_RESET_TIMEOUT=30,  # seconds the circuit stays open before a trial request
+    COVER_DOWNLOAD_WORKERS=2,   # threads downloading cover pictures
+    COVER_DOWNLOAD_RETRIES=3,
+    COVER_DOWNLOAD_RETRY_DELAY=30,  # seconds before the first retry, doubled for each next one
+    COVER_MAX_SIZE=2 * 1024 * 1024, # bytes, larger cover pictures are rejected
+    COVER_THUMBS_AT_INGEST=0,   # 1: make thumbnails right after download, 0: on first request
+    COVER_CACHE_MAX_AGE=30 * 24 * 3600, # seconds, Cache-Control max-age of /cover/<isbn>
+    SHELF_CHANGES_MAX=500,      # max changes per GET /shelf/changes
+    SHELF_BATCH_MAX=500,        # max books added + removed per POST /shelf/books
+    SQLITE_PRAGMAS=DEFAULT_PRAGMAS, # set on every new connection (WAL, busy_timeout ...), {} keeps defaults
+    SQLITE_POOL_SIZE=5,         # pooled read connections per worker process, ~ its threads
+    SQLITE_POOL_OVERFLOW=5,     # extra read connections opened under load, closed when returned
+    SQLITE_POOL_TIMEOUT=30,     # seconds a request waits for a pooled connection
+    DB_READ_SPLIT=1,            # 1: read only requests use a pool of read connections, 0: all on the writer
+    DB_READ_URI=None,           # read replica, None: SQLALCHEMY_DATABASE_URI (fine with sqlite WAL)
+    # sqlite takes one writer at a time anyway: writing requests of a worker queue for its write
+    # connection (SQLITE_POOL_TIMEOUT), each holding it until its transaction ends, so their
+    # throughput is bounded by the length of those transactions; none waits on upstream holding it
+    DB_WRITER_POOL_SIZE=1,      # write connections per worker process, 1 serializes its writers
+    SLOW_QUERY_THRESHOLD=0.25,  # seconds, slower statements are logged (json lines), 0 disables the log
+    SLOW_QUERY_LOG=None,        # file of the slow query log, None: stderr. report: python slow_query_log.py report <file>
+    SLOW_QUERY_EXPLAIN=1,       # 1: log the query plan of a slow statement the first time, flagging full scans
+    PROFILING=0,                # 1: time requests and their spans (db, upstream ...), served at /metrics
+    PROFILING_SAMPLE_RATE=0.0,  # fraction of requests run under cProfile, with PROFILING=1
+    PROFILING_DIR='profiles',   # where .prof files of sampled requests are written
+    ASGI_THREADS=16,            # asgi.py: flask requests run at a time, lookups and cover downloads wait as coroutines
 ))
 app.config.from_envvar('FLASKR_SETTINGS', silent=True)
 
+init_token_cache(app.config['TOKEN_CACHE_SIZE'], app.config['TOKEN_CACHE_TTL'])
+if app.config['BOOK_CACHE_DIR']:
+    # a book changed by a worker is dropped from the shared cache at once, from the
+    # memory of the other workers within the (short) local ttl
+    book_cache.configure(app.config['BOOK_CACHE_SIZE'], app.config['BOOK_CACHE_LOCAL_TTL'],
+                         FileCacheBackend(app.config['BOOK_CACHE_DIR'], app.config['BOOK_CACHE_TTL']))
+else:
+    book_cache.configure(app.config['BOOK_CACHE_SIZE'], app.config['BOOK_CACHE_TTL'])
+set_query_retention(app.config['BOOK_QUERY_RETENTION'])
+cover_fetcher.configure(app.config['COVER_DOWNLOAD_WORKERS'], app.config['COVER_DOWNLOAD_RETRIES'],
+                        app.config['COVER_DOWNLOAD_RETRY_DELAY'], max_size=app.config['COVER_MAX_SIZE'])
+cover_fetcher.listeners.append(cover_derivatives.generate if app.config['COVER_THUMBS_AT_INGEST'] \
+                                   else cover_derivatives.invalidate)
+
+
+def book_provider(spec):
+    '''provider of a BOOK_PROVIDERS entry, http ones use the ISBN_API_* settings'''
+    client_options = dict(pool_size=app.config['ISBN_API_POOL_SIZE'],
+                          connect_timeout=app.config['ISBN_API_CONNECT_TIMEOUT'],
+                          read_timeout=app.config['ISBN_API_READ_TIMEOUT'],
+                          retries=app.config['ISBN_API_RETRIES'],
+                          failure_threshold=app.config['ISBN_API_FAILURE_THRESHOLD'],
+                          reset_timeout=app.config['ISBN_API_RESET_TIMEOUT'])
+    if spec['type'] == 'jisu' and 'appkey' not in spec:
+        spec = dict(spec, appkey=app.config['ISBN_API_APPKEY'])
+    return create_provider(spec, client_options)
+
+set_book_resolver(BookResolver([book_provider(spec) for spec in app.config['BOOK_PROVIDERS']],
+                               hedge_delay=app.config['BOOK_PROVIDER_HEDGE_DELAY'],
+                               hedge_percentile=app.config['BOOK_PROVIDER_HEDGE_PERCENTILE']))
+
+
 api = Api(app)
 
+
+@api.representation('application/json')
+def output_json(data, code, headers=None):
+    '''encode responses once, with orjson when it's installed'''
+    with span('json_encode'):
+        body = json_dumps(data)
+    resp = make_response(body, code)
+    resp.headers.extend(headers or {})
+    resp.mimetype = 'application/json'
+    return resp
+
+# pools of each worker process: reads (if split) and writes, db.engine is the writer.
+# explicit SQLALCHEMY_ENGINE_OPTIONS win
+read_split = app.config['DB_READ_SPLIT'] and not is_memory(app.config['SQLALCHEMY_DATABASE_URI'])
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(
+    engine_options(app.config['SQLALCHEMY_DATABASE_URI'],
+                   app.config['DB_WRITER_POOL_SIZE'] if read_split else app.config['SQLITE_POOL_SIZE'],
+                   0 if read_split else app.config['SQLITE_POOL_OVERFLOW'],
+                   app.config['SQLITE_POOL_TIMEOUT']),
+    **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+
 # db = SQLAlchemy(app)
 db.init_app(app)
 
+# create tables and indexes added after the initial schema (e.g. revoked_token)
+with app.app_context():
+    tune_sqlite(db.engine, app.config['SQLITE_PRAGMAS'])
+    db.create_all()
+    ensure_indexes()
+    ensure_book_fts(db.engine)
+    ShelfChange.backfill()
+
+if read_split:
+    read_uri = app.config['DB_READ_URI'] or app.config['SQLALCHEMY_DATABASE_URI']
+    set_read_engine(create_read_engine(read_uri, engine_options(
+        read_uri, app.config['SQLITE_POOL_SIZE'], app.config['SQLITE_POOL_OVERFLOW'],
+        app.config['SQLITE_POOL_TIMEOUT'])))
+    # read connections can't write, whatever goes wrong in routing
+    tune_sqlite(read_engine(), dict(app.config['SQLITE_PRAGMAS'], query_only=1))
+
+token_sweeper = TokenSweeper(app, app.config['TOKEN_SWEEP_INTERVAL'], app.config['TOKEN_SWEEP_BATCH'])
+token_sweeper.start()
+
+miss_cache.configure(app, app.config['BOOK_MISS_CACHE_SIZE'], app.config['BOOK_MISS_CACHE_TTL'],
+                     app.config['BOOK_RECHECK_DELAY'], app.config['BOOK_RECHECK_MAX_DELAY'],
+                     app.config['BOOK_MISS_FLUSH_INTERVAL'], bloom_capacity=app.config['BOOK_MISS_BLOOM_CAPACITY'])
+with app.app_context():
+    miss_cache.load_bloom()
+miss_cache.start()
+
+if app.config['SLOW_QUERY_THRESHOLD']:
+    slow_query_log = SlowQueryLog(app.config['SLOW_QUERY_THRESHOLD'], app.config['SLOW_QUERY_LOG'],
+                                  app.config['SLOW_QUERY_EXPLAIN'])
+    with app.app_context():
+        slow_query_log.watch_engine(db.engine)
+    if read_engine() is not None:
+        slow_query_log.watch_engine(read_engine())
+
+if app.config['PROFILING']:
+    profiler = Profiler(app, app.config['PROFILING_SAMPLE_RATE'], app.config['PROFILING_DIR'])
+    with app.app_context():
+        profiler.watch_engine(db.engine)
+    if read_engine() is not None:
+        profiler.watch_engine(read_engine())
+    profiler.add_stats('book_cache', book_cache.stats)
+    profiler.add_stats('token_cache', token_cache_stats)
+    profiler.add_stats('miss_cache', miss_cache.stats)
+    profiler.add_stats('token_sweeper', token_sweeper.stats)
+    profiler.add_stats('cover', cover_fetcher.stats)
+
 
 # @app.route("/user", methods=['POST'])
 # def register_user():
 class UserResource(Resource):
     @TokenCheck
+    @read_only
     def get(self, uid, **kwargs):
         user = User.query.filter_by(id=uid).first()
         return user.toJSON()
@@ -117,18 +294,42 @@ class AccessTokenResource(Resource):
         if not user.verify_password(_pwd):
             return {'result':-31, 'msg':'Wrong password'}
 
+        if app.config['TOKEN_MODE'] == TOKEN_MODE_SIGNED:
+            now = datetime.utcnow()
+            return {'result': 0, 'data': issue_signed_token(user.id, now, now + timedelta(days=7))}
+
         try:
             token = Token(generate_token(), user.id, datetime.utcnow(), \
                         datetime.utcnow() + timedelta(days=7))
             db.session.add(token)
             db.session.commit()
+
+            limit_user_tokens(user.id, app.config['TOKEN_MAX_PER_USER'])
         except IntegrityError as e:
             return {'result':-21, 'msg':'database integrity error: %s' % e}
         except DatabaseError as e:
             return {'result':-20, 'msg':'database error: %s' % e}
 
+        cache_token(token)
+
         return {'result': 0, 'data': token.toJSON()}
 
+    def delete(self):
+        '''revoke the access token in Authorization header
+        curl -X DELETE -H "Authorization: Bearer <token>" /token
+        '''
+        try:
+            str_token = bearer_token(request.headers.get('Authorization'))
+            if not revoke_token(str_token):
+                return {'result':-30, 'msg':'token not found'}
+        except RuntimeError as e:
+            return e.args[0]
+        except DatabaseError as e:
+            db.session.rollback()
+            return {'result':-20, 'msg':'database error: %s' % e}
+
+        return {'result': 0, 'msg': 'token revoked'}
+
 api.add_resource(AccessTokenResource, '/token')
 
 # class DateEncoder(json.JSONEncoder):
@@ -137,11 +338,16 @@ api.add_resource(AccessTokenResource, '/token')
 # 			return obj.__str__()
 # 		return json.JSONEncoder.default(self, obj)
 
+def user_book_to_json(obj):
+    '''a book on shelf, with its detail (load UserBook.detail eagerly for lists)'''
+    return {'rid': obj.rid, 'add_date': obj.add_date.strftime('%Y-%m-%dT%H:%M:%S'), \
+                'comment': obj.comment, 'detail': obj.detail.toJSON()}
+
+
 class UserBookEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, UserBook):
-            return {'rid': obj.rid, 'add_date': obj.add_date.strftime('%Y-%m-%dT%H:%M:%S'), \
-                        'comment': obj.comment, 'detail': obj.detail.toJSON()}
+            return user_book_to_json(obj)
         return json.JSONEncoder.default(self, obj)
 
 
@@ -151,6 +357,40 @@ def main():
     return render_template('hello.html')
 
 
+@app.route("/cover/<int:isbn>")
+def get_cover(isbn):
+    '''cover picture of a book
+    size: optional parameter, s / m / l thumbnail or o (original, default)
+    fmt: optional parameter, webp to get a webp thumbnail if supported
+    url: /cover/xxxxxx?size=m
+    '''
+    found = cover_derivatives.get(isbn, request.args.get('size', 'o'),
+                                  request.args.get('fmt') == 'webp')
+    if found is None:
+        abort(404)
+
+    path, mimetype, etag = found
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = send_file(os.path.abspath(path), mimetype=mimetype)
+
+    response.set_etag(etag)
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['COVER_CACHE_MAX_AGE']
+    return response
+
+
+@app.route("/stats/cache")
+def cache_stats():
+    '''size and hit ratio of the caches of this worker process, and its expired token sweeps'''
+    return output_json({'result': 0, 'data': {'book': book_cache.stats(),
+                                              'token': token_cache_stats(),
+                                              'miss': miss_cache.stats(),
+                                              'token_sweeper': token_sweeper.stats()}}, 200)
+
+
 # @app.route("/isbn/<int:isbn>")
 # @TokenCheck
 # def get_book_by_isbn(isbn, **kwargs):
@@ -329,11 +569,14 @@ def main():
 # def add_book_to_shelf(isbn):
 class ShelfBookResource(Resource):
     @TokenCheck
+    @read_only
     def get(self, user=None):
         '''all books from user's shelf
         rid: optional parameter, returns books which's rid great then this parameter, or all books
         page: optional parameter, default=20, how many books this query returns
+        total: optional parameter, 1: also return count (books on shelf) and pages
         url: /shelf?token=xxxx&rid=nnn&page=10
+        next page: rid=<next_rid of this page>, while has_more
         '''
 
         #
@@ -347,20 +590,31 @@ class ShelfBookResource(Resource):
         _rid = request.args.get('rid', 0, type=int)
 
         _page = request.args.get('page', 20, type=int)
-        if _page > 20:
-            _page = 20
+        _page = max(1, min(_page, 20))
 
         # if _page is None:
         #     rs = UserBook.query.filter(UserBook.user_id == user.id, UserBook.rid > _rid).all()
         #     return {'result': 0, 'data': json.loads(json.dumps(rs, cls=UserBookEncoder))}
         # else:
-        rs = UserBook.query.filter(UserBook.user_id == user.id, UserBook.rid > _rid)\
-                                    .order_by(UserBook.rid).paginate(1, _page)
+        # keyset pagination, one more row tells if there's a next page
+        # books are joined in, not loaded one by one when serializing
+        rs = UserBook.query.options(joinedload(UserBook.detail))\
+                                    .filter(UserBook.user_id == user.id, UserBook.rid > _rid)\
+                                    .order_by(UserBook.rid).limit(_page + 1).all()
         # rs = db.Session.query(Book, UserBook).join(UserBook) \
         #         .filter_by(user_id == user.id, rid > _rid).all()
-        return {'result': 0, 'count': rs.total, 'more': rs.has_next, 
-                        'per_page': rs.per_page, 'pages': rs.pages, \
-                        'data': json.loads(json.dumps(rs.items, cls=UserBookEncoder))}
+        has_more = len(rs) > _page
+        rs = rs[:_page]
+
+        result = {'result': 0, 'more': has_more, 'has_more': has_more,
+                        'next_rid': rs[-1].rid if len(rs) > 0 else _rid, 'per_page': _page, \
+                        'data': [user_book_to_json(r) for r in rs]}
+
+        if request.args.get('total', 0, type=int):
+            result['count'] = ShelfCounter.get(user.id)
+            result['pages'] = (result['count'] + _page - 1) // _page if _page > 0 else 0
+
+        return result
 
 
     @TokenCheck
@@ -384,20 +638,328 @@ class ShelfBookResource(Resource):
 
         try:
             db.session.add(user_book)
+            db.session.flush()
+            ShelfChange.record(user_book, ShelfChange.ADD)
+            ShelfCounter.adjust(user.id, 1)
             db.session.commit()
         except IntegrityError as e:
+            db.session.rollback()
             return {'result':-21, 'msg':'database integrity error: %s' % e}
         except DatabaseError as e:
+            db.session.rollback()
             return {'result':-20, 'msg':'database error: %s' % e}
 
         return {'result': 0, 'msg': 'book {}-{} added to shelf'.format(book.isbn, book.title)}
 
+    @staticmethod
+    def books_on_shelf(user, isbn):
+        '''the copies of isbn on user's shelf, only the one of rid if that's given'''
+        query = UserBook.query.filter_by(user_id=user.id, book_isbn=isbn)
+        _rid = request.args.get('rid', type=int)
+        if _rid is not None:
+            query = query.filter_by(rid=_rid)
+        return query.all()
+
+    @TokenCheck
+    def put(self, isbn, user=None):
+        '''change the comment of a book on user's shelf
+        url: /shelf/book/<isbn>?rid=nnn, json body {"comment": "xxx"}
+        rid: optional parameter, only this copy of the book
+        '''
+        json_data = request.get_json(silent=True) or {}
+        if 'comment' not in json_data:
+            return {'result':-10, 'msg':'missing required parameter(s)',
+                'required': [{'name': 'comment'}]}
+
+        rs = self.books_on_shelf(user, isbn)
+        if len(rs) == 0:
+            return {'result':-42, 'msg':'book not on shelf'}
+
+        try:
+            for user_book in rs:
+                user_book.comment = json_data['comment']
+                ShelfChange.record(user_book, ShelfChange.COMMENT)
+            db.session.commit()
+        except DatabaseError as e:
+            db.session.rollback()
+            return {'result':-20, 'msg':'database error: %s' % e}
+
+        return {'result': 0, 'msg': 'comment of book {} changed'.format(isbn)}
+
+    @TokenCheck
+    def delete(self, isbn, user=None):
+        '''remove a book from user's shelf
+        url: /shelf/book/<isbn>?rid=nnn
+        rid: optional parameter, only this copy of the book
+        '''
+        rs = self.books_on_shelf(user, isbn)
+        if len(rs) == 0:
+            return {'result':-42, 'msg':'book not on shelf'}
+
+        try:
+            for user_book in rs:
+                ShelfChange.record(user_book, ShelfChange.REMOVE)
+                db.session.delete(user_book)
+            ShelfCounter.adjust(user.id, -len(rs))
+            db.session.commit()
+        except DatabaseError as e:
+            db.session.rollback()
+            return {'result':-20, 'msg':'database error: %s' % e}
+
+        return {'result': 0, 'msg': 'book {} removed from shelf'.format(isbn)}
+
 api.add_resource(ShelfBookResource, "/shelf/book", "/shelf/book/<int:isbn>")
 
+
+def _fix_isbn(isbn):
+    try:
+        return check_and_fix_isbn(isbn)
+    except (ValueError, TypeError):
+        return None
+
+
+class ShelfBooksResource(Resource):
+    @TokenCheck
+    def post(self, user=None):
+        '''add and remove many books of user's shelf in one transaction
+        add: list of isbn, or of {"isbn": xxx, "comment": "yyy"}
+        remove: list of isbn, every copy of the book is removed
+        unique: optional, 1: books already on shelf are not added again (result -43)
+        lookup: optional, 1: books not in db are looked up in background (result 1 + job)
+        url: /shelf/books, json body {"add": [xxxxxx, {"isbn": yyyyyy, "comment": "..."}], "remove": [zzzzzz]}
+        returns one result per item, in the same order
+        '''
+        json_data = request.get_json(silent=True) or {}
+        _add = json_data.get('add', [])
+        _remove = json_data.get('remove', [])
+        if not isinstance(_add, list) or not isinstance(_remove, list) or \
+                len(_add) + len(_remove) == 0:
+            return {'result':-10, 'msg':'missing required parameter(s)',
+                'required': [{'name': 'add'}, {'name': 'remove'}]}
+
+        if len(_add) + len(_remove) > app.config['SHELF_BATCH_MAX']:
+            return {'result':-11, 'msg':'invalid parameter',
+                'reason': 'too many', 'parameter(s)': [{'name': 'add'}, {'name': 'remove'}]}
+
+        items = [i if isinstance(i, dict) else {'isbn': i} for i in _add]
+        to_add = [_fix_isbn(i.get('isbn')) for i in items]
+        to_remove = [_fix_isbn(i) for i in _remove]
+
+        # books and the user's copies of them, one query each
+        wanted = set(i for i in to_add if i is not None)
+        books = set()
+        if len(wanted) > 0:
+            books = set(isbn for (isbn,) in db.session.query(Book.isbn).filter(Book.isbn.in_(wanted)))
+
+        mine = set(i for i in to_remove if i is not None)
+        if json_data.get('unique'):
+            mine |= books
+        on_shelf = {}
+        if len(mine) > 0:
+            for ub in UserBook.query.filter(UserBook.user_id == user.id, UserBook.book_isbn.in_(mine)):
+                on_shelf.setdefault(ub.book_isbn, []).append(ub)
+
+        added, add_results = [], []
+        for item, isbn in zip(items, to_add):
+            if isbn is None:
+                add_results.append({'isbn': item.get('isbn'), 'result':-1, 'msg':'invalid isbn'})
+            elif isbn not in books:
+                add_results.append({'isbn': item.get('isbn'), 'result':-41, 'msg':'book not found'})
+            elif json_data.get('unique') and isbn in on_shelf:
+                add_results.append({'isbn': item.get('isbn'), 'result':-43, 'msg':'book already on shelf'})
+            else:
+                user_book = UserBook(user.id, isbn, item.get('comment'))
+                added.append(user_book)
+                add_results.append({'isbn': item.get('isbn'), 'result': 0, 'book': user_book})
+                if json_data.get('unique'):
+                    on_shelf[isbn] = [user_book]
+
+        removed, remove_results = [], []
+        for _isbn, isbn in zip(_remove, to_remove):
+            if isbn is None:
+                remove_results.append({'isbn': _isbn, 'result':-1, 'msg':'invalid isbn'})
+            elif isbn not in on_shelf or on_shelf[isbn][0] in added:
+                remove_results.append({'isbn': _isbn, 'result':-42, 'msg':'book not on shelf'})
+            else:
+                removed.extend(on_shelf.pop(isbn))
+                remove_results.append({'isbn': _isbn, 'result': 0})
+
+        try:
+            db.session.add_all(added)
+            db.session.flush()
+            if len(added) > 0:
+                ShelfChange.record_all(added, ShelfChange.ADD)
+            if len(removed) > 0:
+                ShelfChange.record_all(removed, ShelfChange.REMOVE)
+                for user_book in removed:
+                    db.session.delete(user_book)
+            ShelfCounter.adjust(user.id, len(added) - len(removed))
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            return {'result':-21, 'msg':'database integrity error: %s' % e}
+        except DatabaseError as e:
+            db.session.rollback()
+            return {'result':-20, 'msg':'database error: %s' % e}
+
+        for r in add_results:
+            if 'book' in r:
+                r['rid'] = r.pop('book').rid
+
+        unknown = wanted - books
+        if json_data.get('lookup') and len(unknown) > 0:
+            # unknown books are looked up now so that the client can add them later,
+            # unless they were checked recently
+            jobs = {i: start_lookup(i) for i in miss_cache.due(unknown)}
+            for r, isbn in zip(add_results, to_add):
+                if isbn in jobs:
+                    r.update({'result': 1, 'msg': 'lookup pending', 'job': jobs[isbn].id})
+
+        return {'result': 0, 'added': len(added), 'removed': len(removed),
+                'data': {'add': add_results, 'remove': remove_results}}
+
+api.add_resource(ShelfBooksResource, "/shelf/books")
+
+
+class ShelfChangesResource(Resource):
+    @TokenCheck
+    @read_only
+    def get(self, user=None):
+        '''changes of user's shelf after a version, for incremental sync
+        since: optional parameter, default=0 (the whole shelf), version the client has synced to
+        limit: optional parameter, max changes returned
+        books: optional parameter, default=1, 0: leave out details of the books listed
+        url: /shelf/changes?token=xxxx&since=nnn
+        every book is listed once, with its latest change: 'a' added, 'c' comment
+        changed, 'd' removed (tombstone); rows of 'a' and 'c' hold the current state
+        of the book on shelf. next request: since=<version>, while has_more
+        '''
+        _since = request.args.get('since', 0, type=int)
+        _limit = request.args.get('limit', app.config['SHELF_CHANGES_MAX'], type=int)
+        _limit = max(1, min(_limit, app.config['SHELF_CHANGES_MAX']))
+
+        rs = ShelfChange.query.filter(ShelfChange.user_id == user.id, ShelfChange.version > _since)\
+                                    .order_by(ShelfChange.version).limit(_limit + 1).all()
+        has_more = len(rs) > _limit
+        rs = rs[:_limit]
+
+        result = {'result': 0, 'version': rs[-1].version if len(rs) > 0 else _since,
+                  'has_more': has_more, 'fields': ShelfChange.FIELDS,
+                  'changes': [r.toJSON() for r in rs]}
+
+        if request.args.get('books', 1, type=int):
+            present = set(r.book_isbn for r in rs if r.op != ShelfChange.REMOVE)
+            result['books'] = [b.toJSON() for b in Book.query.filter(Book.isbn.in_(present))] \
+                                if len(present) > 0 else []
+
+        return result
+
+api.add_resource(ShelfChangesResource, "/shelf/changes")
+
+def save_query_result(isbn, book):
+    '''save the result of an internet query of isbn and build the response,
+    a book found is added to db, otherwise check record of isbn is updated
+    '''
+    if book is None:
+        # if still can't get book info from internet
+        # update count of check record (in background)
+        miss_cache.record_miss(isbn)
+        return {'result':-404, 'msg':'not found'}
+
+    try:
+        db.session.add(book)
+        db.session.commit()
+    except IntegrityError as e:
+        # ignore this error silently
+        db.session.rollback()
+    except DatabaseError as e:
+        return {'result':-20, 'msg':'database error: %s' % e}
+
+    book_cache.invalidate(isbn)
+    return {'result': 0, 'data': book.toJSON()}
+
+
+def save_lookup(job):
+    '''save the result of a finished background lookup, whether or not a client polls it'''
+    if not job.claim():
+        return
+
+    try:
+        found = job.result()
+    except ProviderError:
+        return
+
+    with app.app_context():
+        if save_query_result(job.isbn, found)['result'] == -20:
+            # a poller tries again
+            job.release()
+
+lookup_listeners.append(save_lookup)
+
+
+def provider_unavailable(e):
+    '''book info service failed: isbn is unknown rather than not found, no check record'''
+    return {'result':-50, 'msg':'book info service unavailable: %s' % e}
+
+
+# set by asgi.py on POST /books/lookup: the resource only lists the isbns to look up in
+# environ[LOOKUP_DEFERRED], they're looked up on the event loop, then the request is run
+# again with what was found in environ[LOOKUP_FOUND] (isbn -> Book, failed ones missing)
+LOOKUP_DEFERRED = 'bookshelf.lookup_deferred'
+LOOKUP_FOUND = 'bookshelf.lookup_found'
+
+
+def release_db():
+    '''give the request's connection back to its pool before a slow wait (upstream queries),
+    so waiting requests don't starve the pool; the session is usable again afterwards
+    '''
+    db.session.close()
+
+
+def lookup_pending(job_id):
+    '''response of a lookup still running in background'''
+    return {'result': 1, 'msg': 'lookup pending', 'job': job_id,
+            'location': api.url_for(BookLookupResource, job=job_id)}, 202
+
+
+# a poll of a job started by another worker process re-reads db this often
+LOOKUP_POLL_INTERVAL = 0.25
+
+
+def poll_lookup_elsewhere(job_id, wait):
+    '''answer a poll of a job this process doesn't know, e.g. started by another worker:
+    the job id carries its isbn and start time, the outcome is read from db - the book
+    once saved, or a check record written after the job started for not found.
+    a job whose query failed upstream stays pending until it expires
+    '''
+    parsed = parse_job_id(job_id)
+    if parsed is None or time.time() - parsed[1] > LOOKUP_JOB_RETENTION:
+        return {'result':-404, 'msg':'lookup job not found'}
+
+    isbn, started = parsed
+    started = datetime.fromtimestamp(started)
+    deadline = time.monotonic() + wait
+    while True:
+        book = Book.query.filter_by(isbn=isbn).first()
+        if book is not None:
+            return {'result': 0, 'data': book.toJSON()}
+
+        checked = db.session.query(CheckRecord.last_check_time).filter_by(isbn=isbn).scalar()
+        if checked is not None and checked >= started:
+            return {'result':-404, 'msg':'not found'}
+
+        # don't hold a connection (or a read snapshot) between polls
+        release_db()
+        if time.monotonic() >= deadline:
+            return lookup_pending(job_id)
+        time.sleep(LOOKUP_POLL_INTERVAL)
+
+
 # @app.route("/book", methods=['POST'])
 # def upload_book():
 class BookResoure(Resource):
     @TokenCheck
+    @read_only
     def get(self, isbn, **kwargs):
         '''get book info by isbn
         need token as query parameter, get token first
@@ -414,63 +976,35 @@ class BookResoure(Resource):
         if isbn is None:
             return {'result':-1, 'msg':'invalid isbn'}
 
+        cached = book_cache.get(isbn)
+        if cached is not None:
+            cover_fetcher.ensure(isbn, cached['cover'])
+            return {'result': 0, 'data': cached['data']}
+
         # check local db first
         book = Book.query.filter_by(isbn=isbn).first()
         if book is None:
-            # check if this isbn in notfound list
-            now = datetime.now()
-            do_query = False
-
-            check_record = CheckRecord.query.filter_by(isbn=isbn).first()
-            if check_record is None:
-                # query book info from internet
-                do_query = True
-                book = queue_to_get_book_info(isbn) # query_book_from_internet(isbn)
-            else:
-                delta = now - check_record.last_check_time
-                if delta.days >= 1:
-                    # re-query book info from internet
-                    do_query = True
+            # check if this isbn in notfound list, and if it's time to query it again
+            if miss_cache.is_due(isbn):
+                if request.args.get('async', app.config['BOOK_LOOKUP_ASYNC'], type=int):
+                    # don't block this worker, client polls /book/lookup/<job> instead
+                    return lookup_pending(start_lookup(isbn).id)
+
+                release_db()
+                try:
                     book = queue_to_get_book_info(isbn) # query_book_from_internet(isbn)
-
-            if do_query:
-                if book is None:
-                    # if still can't get book info from internet
-                    # update count of check record
-                    if check_record is None:
-                        check_record = CheckRecord(isbn)
-                    else:
-                        check_record.last_check_time = datetime.now()
-                        check_record.check_count += 1
-
-                    try:
-                        db.session.add(check_record)
-                        db.session.commit()
-                    except DatabaseError as e:
-                        db.session.rollback()
-
-                    return {'result':-404, 'msg':'not found'}
-                else:
-                    try:
-                        db.session.add(book)
-                        db.session.commit()
-                    except IntegrityError as e:
-                        # ignore this error silently
-                        db.session.rollback()
-                    except DatabaseError as e:
-                        return {'result':-20, 'msg':'database error: %s' % e}
+                except ProviderError as e:
+                    return provider_unavailable(e)
+                return save_query_result(isbn, book)
 
             else:
                 return {'result':-404, 'msg':'not found'}
 
-        else:
-            # check and download pic
-            suffix = '.' + book.pic.split('.')[-1]
-            cover_pic_file_name = COVER_PIC_DIR + str(book.isbn) + suffix
-            if not os.path.exists(cover_pic_file_name):
-                downloadCoverPic(book.pic, cover_pic_file_name)
+        # check and download pic, in background
+        cached = book_cache.put(book, cover_source(book))
+        cover_fetcher.ensure(book.isbn, cached['cover'])
 
-        return {'result': 0, 'data': book.toJSON()}
+        return {'result': 0, 'data': cached['data']}
 
 
     @TokenCheck
@@ -486,7 +1020,7 @@ class BookResoure(Resource):
                 _summary = json_data.get('summary')
                 _author = json_data.get('author')
                 _publisher = json_data.get('publisher')
-                _pubd_ate = json_data.get('pub_date')
+                _pub_date = json_data.get('pub_date')
                 _binding = json_data.get('binding')
                 _page = json_data.get('page')
                 _price = json_data.get('price')
@@ -528,12 +1062,196 @@ class BookResoure(Resource):
             return {'result':-21, 'msg':'database integrity error: %s' % e}
         except DatabaseError as e:
             return {'result':-20, 'msg':'database error: %s' % e}
-            
+
+        book_cache.invalidate(book.isbn)
+        cover_fetcher.update(book.isbn, cover_source(book))
+
         return {'result': 0, 'data': book.toJSON()}
 
 api.add_resource(BookResoure, '/book', '/book/<int:isbn>')
 
 
+class BookLookupResource(Resource):
+    @TokenCheck
+    @read_only
+    def get(self, job, **kwargs):
+        '''poll a background book lookup started by GET /book/<isbn>?async=1
+        wait: optional parameter, seconds to wait for the lookup (long-poll)
+        url: /book/lookup/<job>?wait=10
+        '''
+        _wait = request.args.get('wait', 0, type=float)
+        _wait = max(0, min(_wait, app.config['BOOK_LOOKUP_MAX_WAIT']))
+
+        lookup = get_lookup(job)
+        if lookup is None:
+            return poll_lookup_elsewhere(job, _wait)
+
+        if _wait > 0 and not lookup.done():
+            release_db()
+        if not lookup.wait(_wait):
+            return lookup_pending(lookup.id)
+
+        try:
+            found = lookup.result()
+        except ProviderError as e:
+            return provider_unavailable(e)
+
+        # saved once, by save_lookup as the job finished or by a poller arriving first,
+        # others read it back from db
+        if lookup.claim():
+            return save_query_result(lookup.isbn, found)
+
+        book = Book.query.filter_by(isbn=lookup.isbn).first()
+        if book is None:
+            if found is not None:
+                # being saved right now
+                return {'result': 0, 'data': found.toJSON()}
+            return {'result':-404, 'msg':'not found'}
+
+        return {'result': 0, 'data': book.toJSON()}
+
+api.add_resource(BookLookupResource, '/book/lookup/<job>')
+
+
+class BooksLookupResource(Resource):
+    @TokenCheck
+    @read_only
+    def post(self, **kwargs):
+        '''get info of many books at once
+        isbns: required, list of isbn
+        async: optional parameter, 1: books not in db are looked up in background (result 1 + job)
+        url: /books/lookup, json body {"isbns": [xxxxxx, yyyyyy]}
+        returns one result per isbn, in the same order
+        '''
+        json_data = request.get_json(silent=True) or {}
+        _isbns = json_data.get('isbns')
+        if not isinstance(_isbns, list):
+            return {'result':-10, 'msg':'missing required parameter(s)',
+                'required': [{'name': 'isbns'}]}
+
+        if len(_isbns) > app.config['BOOKS_LOOKUP_MAX']:
+            return {'result':-11, 'msg':'invalid parameter',
+                'reason': 'too many', 'parameter(s)': [{'name': 'isbns'}]}
+
+        fixed = [_fix_isbn(i) for i in _isbns]
+        valid = set(i for i in fixed if i is not None)
+
+        # cached books, then the other local hits and check records, one query each
+        books = {}
+        for i in valid:
+            cached = book_cache.get(i)
+            if cached is not None:
+                books[i] = cached['data']
+
+        uncached = valid - set(books)
+        if len(uncached) > 0:
+            for b in Book.query.filter(Book.isbn.in_(uncached)):
+                books[b.isbn] = book_cache.put(b, cover_source(b))['data']
+
+        to_query = list(miss_cache.due(valid - set(books)))
+
+        jobs = {}
+        failed = set()
+        if request.args.get('async', app.config['BOOK_LOOKUP_ASYNC'], type=int):
+            jobs = {i: start_lookup(i) for i in to_query}
+        elif len(to_query) > 0:
+            deferred = request.environ.get(LOOKUP_DEFERRED)
+            if deferred is not None:
+                deferred.extend(to_query)
+                return {'result': 1, 'msg': 'lookup deferred'}
+
+            found = request.environ.get(LOOKUP_FOUND)
+            if found is None:
+                release_db()
+                found = query_books(to_query, app.config['BOOKS_LOOKUP_CONCURRENCY'])
+            else:
+                found = dict((i, found[i]) for i in to_query if i in found)
+            self.save(found)
+            books.update((i, b.toJSON()) for i, b in found.items() if b is not None)
+            failed = set(to_query) - set(found)
+
+        data = []
+        for _isbn, isbn in zip(_isbns, fixed):
+            if isbn is None:
+                data.append({'isbn': _isbn, 'result':-1, 'msg':'invalid isbn'})
+            elif isbn in books:
+                data.append({'isbn': _isbn, 'result': 0, 'data': books[isbn]})
+            elif isbn in jobs:
+                data.append({'isbn': _isbn, 'result': 1, 'msg': 'lookup pending', 'job': jobs[isbn].id})
+            elif isbn in failed:
+                data.append({'isbn': _isbn, 'result':-50, 'msg':'book info service unavailable'})
+            else:
+                data.append({'isbn': _isbn, 'result':-404, 'msg':'not found'})
+
+        return {'result': 0, 'data': data}
+
+    @staticmethod
+    def save(found):
+        '''save books found in one transaction, check records of those not found in background'''
+        for isbn, book in found.items():
+            if book is None:
+                miss_cache.record_miss(isbn)
+
+        books = [b for b in found.values() if b is not None]
+        if len(books) == 0:
+            return
+
+        try:
+            db.session.add_all(books)
+            db.session.commit()
+            for book in books:
+                book_cache.invalidate(book.isbn)
+        except IntegrityError:
+            # someone saved one of the books meanwhile, fall back to one by one
+            db.session.rollback()
+            for book in books:
+                save_query_result(book.isbn, book)
+        except DatabaseError:
+            db.session.rollback()
+
+api.add_resource(BooksLookupResource, '/books/lookup')
+
+
+class BooksSearchResource(Resource):
+    @TokenCheck
+    @read_only
+    def get(self, user=None):
+        '''search books by title, subtitle, author, publisher and summary
+        q: required, words to search, a book matches if it has all of them
+        scope: optional parameter, 'shelf': only books on user's shelf
+        page: optional parameter, default=1, page of results, best ones first
+        per_page: optional parameter, results per page
+        url: /books/search?token=xxxx&q=yyy&scope=shelf&page=2
+        '''
+        _q = request.args.get('q', '').strip()
+        if len(_q) == 0:
+            return {'result':-10, 'msg':'missing required parameter(s)',
+                'required': [{'name': 'q'}]}
+
+        _page = request.args.get('page', 1, type=int)
+        _per_page = request.args.get('per_page', app.config['BOOKS_SEARCH_PER_PAGE'], type=int)
+        _per_page = max(1, min(_per_page, app.config['BOOKS_SEARCH_PER_PAGE']))
+        if _page < 1 or _page > app.config['BOOKS_SEARCH_MAX_PAGES']:
+            return {'result':-11, 'msg':'invalid parameter', 'parameter(s)': [{'name': 'page'}]}
+
+        _scope = request.args.get('scope')
+        try:
+            rs, has_more, truncated = search_books(_q, user.id if _scope == 'shelf' else None, _page, _per_page,
+                                        app.config['BOOKS_SEARCH_RANK_LIMIT'],
+                                        app.config['BOOKS_SEARCH_SCAN_LIMIT'])
+        except DatabaseError as e:
+            # e.g. a malformed query
+            db.session.rollback()
+            return {'result':-20, 'msg':'database error: %s' % e}
+
+        # truncated: the query was too broad (or its terms too short for the index), only
+        # the first BOOKS_SEARCH_RANK_LIMIT matches / BOOKS_SEARCH_SCAN_LIMIT books were searched
+        return {'result': 0, 'page': _page, 'per_page': _per_page, 'has_more': has_more,
+                'truncated': truncated, 'data': [b.toJSON() for b in rs]}
+
+api.add_resource(BooksSearchResource, '/books/search')
+
+
 if __name__ == "__main__":
     try:
         if not os.path.exists(COVER_PIC_DIR):
@@ -0,0 +1,254 @@
+import math, atexit, hashlib, threading
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from flask import has_app_context
+from sqlalchemy.exc import DatabaseError
+
+from dao import db, CheckRecord
+from cache import TTLCache
+
+
+def recheck_delay(check_count, base=86400, maximum=30 * 86400):
+    '''seconds before an isbn not found check_count times is looked up again:
+    base, then doubled for every further miss, up to maximum. check_count of
+    check records older than the count is NULL, taken as 0
+    '''
+    return min(base * 2 ** max((check_count or 0) - 1, 0), maximum)
+
+
+class BloomFilter(object):
+    '''set of keys in a fixed bit array, no false negatives, false positives
+    at about error_rate once capacity keys were added
+    '''
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(str(key).encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for p in self._positions(key):
+            self._bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self._bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def clear(self):
+        self._bits = bytearray(len(self._bits))
+        self.count = 0
+
+
+class MissCache(object):
+    '''isbns not found upstream, in front of table check_record
+
+    the last check time and check count of an isbn are kept in memory once
+    read, so repeated misses of an isbn cost no query. a new miss updates
+    memory at once and check_record in batches, by a background writer (at
+    once, in the caller's thread, if flush_interval is 0). an isbn is looked
+    up again after recheck_delay(check_count).
+
+    with a bloom filter of the isbns having a check record (loaded at start),
+    an isbn never checked costs no query either. the filter only learns about
+    the records of this process: an isbn checked meanwhile by another worker
+    is looked up again, once, by this one.
+    '''
+
+    def __init__(self, maxsize=10000, ttl=3600):
+        self.app = None
+        self.base_delay = 86400
+        self.max_delay = 30 * 86400
+        self.flush_interval = 0
+        self.batch_size = 500
+        self.bloom = None
+
+        self.memory_hits = 0
+        self.db_reads = 0
+        self.bloom_skips = 0
+        self.written = 0
+        self.flushes = 0
+
+        self._records = TTLCache(maxsize, ttl)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def configure(self, app, maxsize=None, ttl=None, base_delay=None, max_delay=None,
+                  flush_interval=None, batch_size=None, bloom_capacity=0):
+        self.app = app
+        self._records.configure(maxsize, ttl)
+        if base_delay is not None:
+            self.base_delay = base_delay
+        if max_delay is not None:
+            self.max_delay = max_delay
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        if batch_size is not None:
+            self.batch_size = batch_size
+        self.bloom = BloomFilter(bloom_capacity) if bloom_capacity > 0 else None
+
+    def load_bloom(self):
+        '''add the isbns of check_record to the bloom filter, needs an app context'''
+        if self.bloom is None:
+            return
+        for (isbn,) in db.session.query(CheckRecord.isbn).yield_per(10000):
+            self.bloom.add(isbn)
+
+    def start(self):
+        if self._thread is not None or self.flush_interval <= 0:
+            return
+
+        self._thread = threading.Thread(target=self._run, name='check-record-writer')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        self.flush()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                self.app.logger.error('check record flush failed: %s', e)
+
+    def _state(self, isbn):
+        '''(last check time, check count) of isbn known in memory, None if not'''
+        with self._lock:
+            state = self._pending.get(isbn)
+        if state is None:
+            state = self._records.get(isbn)
+        return state
+
+    def _is_due(self, state, now):
+        last_check_time, check_count = state
+        if last_check_time is None:
+            return True
+        delay = recheck_delay(check_count, self.base_delay, self.max_delay)
+        return now - last_check_time >= timedelta(seconds=delay)
+
+    def due(self, isbns, now=None):
+        '''isbns of the (not found in db) isbns given that have to be looked up upstream'''
+        now = datetime.now() if now is None else now
+        states, unknown = {}, []
+        for isbn in isbns:
+            state = self._state(isbn)
+            if state is not None:
+                self.memory_hits += 1
+                states[isbn] = state
+            elif self.bloom is not None and isbn not in self.bloom:
+                # never checked
+                self.bloom_skips += 1
+            else:
+                unknown.append(isbn)
+
+        if len(unknown) > 0:
+            self.db_reads += 1
+            for r in CheckRecord.query.filter(CheckRecord.isbn.in_(unknown)):
+                states[r.isbn] = (r.last_check_time, r.check_count)
+                self._records.set(r.isbn, states[r.isbn])
+
+        return set(i for i in isbns if i not in states or self._is_due(states[i], now))
+
+    def is_due(self, isbn, now=None):
+        return isbn in self.due([isbn], now)
+
+    def record_miss(self, isbn):
+        '''isbn was just looked up upstream and not found'''
+        state = self._state(isbn)
+        if state is None and (self.bloom is None or isbn in self.bloom):
+            r = CheckRecord.query.filter_by(isbn=isbn).first()
+            if r is not None:
+                state = (r.last_check_time, r.check_count)
+
+        state = (datetime.now(), 1 if state is None else (state[1] or 0) + 1)
+        self._records.set(isbn, state)
+        if self.bloom is not None:
+            self.bloom.add(isbn)
+
+        with self._lock:
+            self._pending[isbn] = state
+            full = len(self._pending) >= self.batch_size
+
+        if self._thread is None:
+            self.flush()
+        elif full:
+            self._wake.set()
+
+    def flush(self):
+        '''write pending check records, batch_size per transaction'''
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if len(pending) == 0:
+                return
+
+            items = list(pending.items())
+            failed = {}
+            # written at once (no background writer): in the caller's session, a session of
+            # its own would wait for the pooled write connection the caller may hold
+            with nullcontext() if has_app_context() else self.app.app_context():
+                for i in range(0, len(items), self.batch_size):
+                    batch = dict(items[i:i + self.batch_size])
+                    try:
+                        self._write(batch)
+                    except DatabaseError as e:
+                        # e.g. another worker inserted one of the records, retried next time
+                        db.session.rollback()
+                        print(e)
+                        failed.update(batch)
+
+            if len(failed) > 0:
+                with self._lock:
+                    for isbn, state in failed.items():
+                        self._pending.setdefault(isbn, state)
+
+    def _write(self, batch):
+        existing = {r.isbn: r for r in CheckRecord.query.filter(CheckRecord.isbn.in_(list(batch)))}
+        for isbn, (last_check_time, check_count) in batch.items():
+            r = existing.get(isbn)
+            if r is None:
+                r = CheckRecord(isbn)
+                db.session.add(r)
+            elif r.check_count is not None and r.check_count > check_count:
+                # counted by another worker too
+                check_count = r.check_count
+            r.last_check_time = last_check_time
+            r.check_count = check_count
+        db.session.commit()
+        self.written += len(batch)
+        self.flushes += 1
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            'size': len(self._records),
+            'memory_hits': self.memory_hits,
+            'db_reads': self.db_reads,
+            'bloom_skips': self.bloom_skips,
+            'bloom_size': None if self.bloom is None else self.bloom.count,
+            'pending': pending,
+            'written': self.written,
+            'flushes': self.flushes,
+        }
+
+
+miss_cache = MissCache()
@@ -0,0 +1,266 @@
+'''opt-in per request profiling
+
+spans - token check, db queries, upstream waits, cover downloads, json
+encoding - are timed with span() / @timed wherever they run. within a request
+their totals are sent back in a Server-Timing header; everywhere (background
+threads too) they go to histograms of this process, which /metrics serves in
+the prometheus text format, with the request durations by endpoint and the
+numbers of the caches. a sample of requests is run under cProfile, one .prof
+file each. when profiling is off, span() costs one check of a global.
+'''
+import os, time, random, asyncio, cProfile, threading
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import g, request, has_request_context, make_response
+from sqlalchemy import event
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_enabled = False
+
+
+def enabled():
+    return _enabled
+
+
+def record(name, seconds):
+    '''account seconds spent in span name'''
+    if not _enabled:
+        return
+    _metrics.observe('span', (('span', name),), seconds)
+    if has_request_context():
+        spans = g.get('_spans')
+        if spans is not None:
+            count, total = spans.get(name, (0, 0.0))
+            spans[name] = (count + 1, total + seconds)
+
+
+@contextmanager
+def span(name):
+    if not _enabled:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def timed(name):
+    '''decorator timing every call of a function as span name'''
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not _enabled:
+                    return await func(*args, **kwargs)
+                with span(name):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = 0
+        while i < len(BUCKETS) and value > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics(object):
+    '''histograms by metric and labels, of this process'''
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, metric, labels, value):
+        with self._lock:
+            h = self._histograms.get((metric, labels))
+            if h is None:
+                h = self._histograms[(metric, labels)] = Histogram()
+            h.observe(value)
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def exposition(self, prefix):
+        '''prometheus text format of the histograms'''
+        with self._lock:
+            items = sorted((k, (list(h.counts), h.count, h.sum)) for k, h in self._histograms.items())
+
+        lines = []
+        declared = set()
+        for (metric, labels), (counts, count, total) in items:
+            name = '%s_%s_duration_seconds' % (prefix, metric)
+            if name not in declared:
+                declared.add(name)
+                lines.append('# TYPE %s histogram' % name)
+
+            label_text = ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+            cumulative = 0
+            for bound, n in zip(BUCKETS + ('+Inf',), counts):
+                cumulative += n
+                le = 'le="%s"' % bound
+                lines.append('%s_bucket{%s} %d' % (name, label_text + ',' + le if label_text else le, cumulative))
+            lines.append('%s_sum{%s} %f' % (name, label_text, total))
+            lines.append('%s_count{%s} %d' % (name, label_text, count))
+        return lines
+
+
+_metrics = Metrics()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _flatten(prefix, stats):
+    '''numeric values of a stats() dict, nested keys joined by _'''
+    for key, value in stats.items():
+        name = '%s_%s' % (prefix, key)
+        if isinstance(value, dict):
+            for item in _flatten(name, value):
+                yield item
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, value
+
+
+class Profiler(object):
+    '''request timing, spans and sampled cProfile of a flask app, served at /metrics
+
+    profiler = Profiler(app, sample_rate=0.01, profile_dir='profiles')
+    profiler.watch_engine(db.engine)
+    profiler.add_stats('book_cache', book_cache.stats)
+    '''
+
+    prefix = 'bookshelf'
+
+    def __init__(self, app=None, sample_rate=0.0, profile_dir='profiles', metrics_path='/metrics'):
+        self.sample_rate = sample_rate
+        self.profile_dir = profile_dir
+        self.metrics_path = metrics_path
+        self.profiled = 0
+        self._stats = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        global _enabled
+        _enabled = True
+
+        app.before_request(self._before)
+        app.after_request(self._after)
+        app.teardown_request(self._teardown)
+        app.add_url_rule(self.metrics_path, 'metrics', self.metrics)
+
+    def add_stats(self, prefix, stats):
+        '''serve the numbers of a stats() function as gauges'''
+        self._stats.append((prefix, stats))
+
+    def watch_engine(self, engine):
+        '''time every query of engine as span db'''
+
+        def before(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('_query_start', []).append(time.perf_counter())
+
+        def after(conn, cursor, statement, parameters, context, executemany):
+            record('db', time.perf_counter() - conn.info['_query_start'].pop())
+
+        def error(context):
+            stack = context.connection.info.get('_query_start') if context.connection is not None else None
+            if stack:
+                stack.pop()
+
+        event.listen(engine, 'before_cursor_execute', before)
+        event.listen(engine, 'after_cursor_execute', after)
+        event.listen(engine, 'handle_error', error)
+
+    def _before(self):
+        g._spans = {}
+        g._request_start = time.perf_counter()
+        if self.sample_rate > 0 and random.random() < self.sample_rate \
+                and request.endpoint != 'metrics':
+            g._profile = cProfile.Profile()
+            g._profile.enable()
+
+    def _after(self, response):
+        start = g.get('_request_start')
+        if start is None:
+            return response
+
+        elapsed = time.perf_counter() - start
+        if request.endpoint != 'metrics':
+            _metrics.observe('request', (('endpoint', request.endpoint or 'none'),
+                                         ('method', request.method),
+                                         ('status', response.status_code)), elapsed)
+
+        timings = ['%s;dur=%.1f;desc="%d"' % (name, total * 1000, count)
+                   for name, (count, total) in sorted(g._spans.items())]
+        timings.append('total;dur=%.1f' % (elapsed * 1000))
+        response.headers['Server-Timing'] = ', '.join(timings)
+
+        profile = g.pop('_profile', None)
+        if profile is not None:
+            profile.disable()
+            self._dump(profile, elapsed)
+        return response
+
+    def _teardown(self, exc):
+        # a request failed before after_request
+        profile = g.pop('_profile', None)
+        if profile is not None:
+            profile.disable()
+
+    def _dump(self, profile, elapsed):
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            name = '%s-%s-%dms-%d.prof' % (time.strftime('%Y%m%d-%H%M%S'), request.endpoint or 'none',
+                                            elapsed * 1000, os.getpid())
+            profile.dump_stats(os.path.join(self.profile_dir, name))
+            self.profiled += 1
+        except OSError as e:
+            print(e)
+
+    def metrics(self):
+        lines = _metrics.exposition(self.prefix)
+        for prefix, stats in self._stats:
+            try:
+                values = list(_flatten('%s_%s' % (self.prefix, prefix), stats()))
+            except Exception as e:
+                print(e)
+                continue
+            for name, value in values:
+                lines.append('# TYPE %s gauge' % name)
+                lines.append('%s %s' % (name, value))
+        lines.append('# TYPE %s_profiled_requests gauge' % self.prefix)
+        lines.append('%s_profiled_requests %d' % (self.prefix, self.profiled))
+
+        response = make_response('\n'.join(lines) + '\n')
+        response.mimetype = 'text/plain'
+        response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        return response
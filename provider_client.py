@@ -0,0 +1,284 @@
+import json, time, random, asyncio, threading, bisect
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from async_http import http_get, HTTPError
+
+
+class ProviderError(Exception):
+    '''book info provider could not be reached or answered with an error'''
+
+
+class CircuitOpenError(ProviderError):
+    '''request not sent, provider is considered down'''
+
+
+class LatencyHistogram(object):
+    '''cumulative latency histogram with fixed buckets (seconds), prometheus style'''
+
+    BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)    # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def percentile(self, p):
+        '''upper bound of the bucket holding the p-th (0..1) observation, None if empty'''
+        with self._lock:
+            if self.count == 0:
+                return None
+
+            rank = p * self.count
+            seen = 0
+            for i, n in enumerate(self.counts):
+                seen += n
+                if seen >= rank and n > 0:
+                    return self.buckets[i] if i < len(self.buckets) else float('inf')
+
+    def snapshot(self):
+        with self._lock:
+            cumulative = []
+            seen = 0
+            for le, n in zip(self.buckets + (float('inf'),), self.counts):
+                seen += n
+                cumulative.append((le, seen))
+            return {'buckets': cumulative, 'count': self.count, 'sum': self.sum}
+
+
+class RecentStats(object):
+    '''error rate and latency of the calls of the last one to two windows (seconds)
+
+    older calls are forgotten, so that a provider demoted by an outage is
+    ranked on its recent calls only - and as nothing, once none is left
+    '''
+
+    def __init__(self, window=300, buckets=LatencyHistogram.BUCKETS):
+        self.window = window
+        self.buckets = tuple(buckets)
+        self._current = self._new()
+        self._previous = self._new()
+        self._rotated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _new(self):
+        return {'calls': 0, 'errors': 0, 'latency': LatencyHistogram(self.buckets)}
+
+    def _rotate(self):
+        '''lock must be held'''
+        now = time.monotonic()
+        elapsed = now - self._rotated
+        if elapsed >= self.window:
+            self._previous = self._current if elapsed < 2 * self.window else self._new()
+            self._current = self._new()
+            self._rotated = now
+
+    def observe(self, seconds, error=False):
+        with self._lock:
+            self._rotate()
+            self._current['calls'] += 1
+            self._current['errors'] += 1 if error else 0
+            self._current['latency'].observe(seconds)
+
+    def error_rate(self):
+        with self._lock:
+            self._rotate()
+            calls = self._current['calls'] + self._previous['calls']
+            errors = self._current['errors'] + self._previous['errors']
+        return float(errors) / calls if calls else 0.0
+
+    def percentile(self, p):
+        '''like LatencyHistogram.percentile, of the recent calls'''
+        merged = LatencyHistogram(self.buckets)
+        with self._lock:
+            self._rotate()
+            for w in (self._current, self._previous):
+                merged.counts = [a + b for a, b in zip(merged.counts, w['latency'].counts)]
+                merged.count += w['latency'].count
+        return merged.percentile(p)
+
+
+class CircuitBreaker(object):
+    '''opens after `failure_threshold` consecutive failures; once `reset_timeout`
+    seconds passed a single trial request is let through (half open), its
+    outcome closes or re-opens the circuit
+    '''
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+
+            # open, or half open with the trial request still running
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class ProviderClient(object):
+    '''http client of an external book info provider
+
+    keeps connections in a pooled session, bounds every request by connect/read
+    timeouts, retries transient failures with jittered exponential backoff and
+    stops calling the provider while the circuit breaker is open
+    '''
+
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, pool_size=10, connect_timeout=3.05, read_timeout=10,
+                 retries=2, backoff=0.2, max_backoff=2.0,
+                 failure_threshold=5, reset_timeout=30):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.latency = LatencyHistogram()
+
+        self.requests = 0
+        self.failures = 0
+        self.retried = 0
+        self.short_circuited = 0
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _sleep_before_retry(self, attempt):
+        # "full jitter": uniform in [0, capped exponential backoff]
+        time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt))))
+
+    def get(self, url, **kwargs):
+        '''GET url, returns the response, raises ProviderError if it failed after all retries'''
+        if not self.breaker.allow():
+            self.short_circuited += 1
+            raise CircuitOpenError('circuit open, not calling %s' % url)
+
+        kwargs.setdefault('timeout', self.timeout)
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                self.retried += 1
+                self._sleep_before_retry(attempt - 1)
+
+            self.requests += 1
+            start = time.monotonic()
+            try:
+                response = self.session.get(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = ProviderError('%s: %s' % (type(e).__name__, e))
+                continue
+            except requests.RequestException as e:
+                # not transient (invalid url, too many redirects ...), don't retry
+                error = ProviderError('%s: %s' % (type(e).__name__, e))
+                break
+            finally:
+                self.latency.observe(time.monotonic() - start)
+
+            if response.status_code in self.RETRY_STATUS:
+                response.close()
+                error = ProviderError('HTTP %d from %s' % (response.status_code, url))
+                continue
+
+            self.breaker.record_success()
+            return response
+
+        self.failures += 1
+        self.breaker.record_failure()
+        raise error
+
+    def get_json(self, url, **kwargs):
+        response = self.get(url, **kwargs)
+        try:
+            return response.json()
+        except ValueError as e:
+            raise ProviderError('invalid json from %s: %s' % (url, e))
+
+    async def get_async(self, url, params=None):
+        '''get() for asyncio code: same timeouts, retries, breaker and counters'''
+        if not self.breaker.allow():
+            self.short_circuited += 1
+            raise CircuitOpenError('circuit open, not calling %s' % url)
+
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                self.retried += 1
+                await asyncio.sleep(random.uniform(0, min(self.max_backoff, self.backoff * (2 ** (attempt - 1)))))
+
+            self.requests += 1
+            start = time.monotonic()
+            try:
+                response = await http_get(url, params, timeout=self.timeout)
+            except (OSError, EOFError, asyncio.TimeoutError) as e:
+                error = ProviderError('%s: %s' % (type(e).__name__, e))
+                continue
+            except HTTPError as e:
+                error = ProviderError('%s: %s' % (type(e).__name__, e))
+                break
+            finally:
+                self.latency.observe(time.monotonic() - start)
+
+            if response.status_code in self.RETRY_STATUS:
+                error = ProviderError('HTTP %d from %s' % (response.status_code, url))
+                continue
+
+            self.breaker.record_success()
+            return response
+
+        self.failures += 1
+        self.breaker.record_failure()
+        raise error
+
+    async def get_json_async(self, url, params=None):
+        response = await self.get_async(url, params)
+        try:
+            return json.loads(response.content)
+        except ValueError as e:
+            raise ProviderError('invalid json from %s: %s' % (url, e))
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'failures': self.failures,
+            'retried': self.retried,
+            'short_circuited': self.short_circuited,
+            'circuit': self.breaker.state,
+            'latency': self.latency.snapshot(),
+        }
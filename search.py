@@ -0,0 +1,187 @@
+'''full-text search of books, by an sqlite fts5 index
+
+book_fts is an external content fts5 table over book (rowid = isbn), kept in
+sync by triggers on book, so every write path - BookResoure.post, upstream
+ingest, catalog.py - updates it. the trigram tokenizer matches substrings,
+which also suits CJK titles that have no spaces between words; sqlite older
+than 3.34 falls back to unicode61 (word prefixes). without fts5, or on
+another database, search falls back to LIKE over title and author. terms
+shorter than a trigram (most chinese words are 2 characters) filter the
+matches of the longer ones; a query of short terms only has no index to
+use, and scans at most scan_limit books, in isbn order; a broad one is ranked
+among its first rank_limit matches. either way the search reports it's
+truncated: books past the cap are never considered. a search in a shelf
+doesn't need the index: the few books there are filtered by substring, which
+is what a trigram match is too.
+'''
+import re
+
+from sqlalchemy import MetaData, Table, Column, Integer, Text, or_, and_, case, literal_column, text
+
+from dao import db, Book, UserBook
+
+FTS_TABLE = 'book_fts'
+FTS_COLUMNS = ('title', 'subtitle', 'author', 'publisher', 'summary')
+# bm25 weights of the columns above
+FTS_WEIGHTS = (10.0, 4.0, 6.0, 2.0, 1.0)
+TRIGRAM = 'trigram'
+UNICODE61 = 'unicode61'
+
+# tokenizer of book_fts, None if there's no index
+_tokenizer = None
+
+_fts = Table(FTS_TABLE, MetaData(), Column('rowid', Integer),
+             *[Column(c, Text) for c in FTS_COLUMNS])
+
+_cols = ', '.join(FTS_COLUMNS)
+_new = ', '.join('new.' + c for c in FTS_COLUMNS)
+_old = ', '.join('old.' + c for c in FTS_COLUMNS)
+_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS book_fts_ai AFTER INSERT ON book BEGIN
+        INSERT INTO book_fts (rowid, {cols}) VALUES (new.isbn, {new});
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS book_fts_ad AFTER DELETE ON book BEGIN
+        INSERT INTO book_fts (book_fts, rowid, {cols}) VALUES ('delete', old.isbn, {old});
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS book_fts_au AFTER UPDATE ON book BEGIN
+        INSERT INTO book_fts (book_fts, rowid, {cols}) VALUES ('delete', old.isbn, {old});
+        INSERT INTO book_fts (rowid, {cols}) VALUES (new.isbn, {new});
+    END''',
+]
+_TRIGGERS = [t.format(cols=_cols, new=_new, old=_old) for t in _TRIGGERS]
+
+
+def fts_tokenizer():
+    return _tokenizer
+
+
+def ensure_book_fts(engine):
+    '''create (and fill) book_fts and its triggers if missing, returns the tokenizer
+    in use, None if the database can't have it
+    '''
+    global _tokenizer
+
+    if engine.dialect.name != 'sqlite':
+        _tokenizer = None
+        return None
+
+    with engine.begin() as conn:
+        row = conn.execute(text("SELECT sql FROM sqlite_master WHERE name = :name"),
+                           {'name': FTS_TABLE}).first()
+        if row is not None:
+            _tokenizer = TRIGRAM if TRIGRAM in row[0] else UNICODE61
+        else:
+            _tokenizer = _create_fts(conn)
+            if _tokenizer is None:
+                return None
+
+        for trigger in _TRIGGERS:
+            conn.execute(text(trigger))
+
+        # ORDER BY rank ranks by bm25 with the column weights
+        conn.execute(text("INSERT INTO book_fts (book_fts, rank) VALUES ('rank', :rank)"),
+                     {'rank': 'bm25(%s)' % ', '.join(str(w) for w in FTS_WEIGHTS)})
+
+        if row is None:
+            # index the books already there
+            conn.execute(text("INSERT INTO book_fts (book_fts) VALUES ('rebuild')"))
+
+    return _tokenizer
+
+
+def _create_fts(conn):
+    for tokenizer in (TRIGRAM, UNICODE61):
+        try:
+            with conn.begin_nested():
+                conn.execute(text(
+                    "CREATE VIRTUAL TABLE {} USING fts5({}, content='book', content_rowid='isbn', "
+                    "tokenize='{}')".format(FTS_TABLE, _cols, tokenizer)))
+            return tokenizer
+        except Exception as e:
+            # no trigram tokenizer (sqlite < 3.34), or no fts5 at all
+            print(e)
+    return None
+
+
+def fts_terms(q):
+    '''(fts5 query of the terms of q, terms too short for it)'''
+    terms = [t for t in re.split(r'\s+', q.strip()) if len(t) > 0]
+    if _tokenizer == TRIGRAM:
+        long_terms = [t for t in terms if len(t) >= 3]
+        short_terms = [t for t in terms if len(t) < 3]
+    else:
+        long_terms, short_terms = terms, []
+
+    # every term is quoted, so its characters are never fts5 syntax
+    quoted = ['"%s"' % t.replace('"', '""') for t in long_terms]
+    if _tokenizer == UNICODE61:
+        quoted = [t + '*' for t in quoted]
+    return ' '.join(quoted), short_terms
+
+
+def _like(term, columns):
+    pattern = '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    return or_(*[c.like(pattern, escape='\\') for c in columns])
+
+
+def _scan_capped(query, scan_limit):
+    '''(query (filtering book by LIKE) reading at most the first scan_limit books,
+    are there books it doesn't read)
+    '''
+    if not scan_limit:
+        return query, False
+    boundary = db.session.query(Book.isbn).order_by(Book.isbn).offset(scan_limit).limit(1).scalar()
+    return (query, False) if boundary is None else (query.filter(Book.isbn < boundary), True)
+
+
+def search_books(q, user_id=None, page=1, per_page=20, rank_limit=None, scan_limit=None):
+    '''(books matching every term of q, best first, is there a next page, were
+    matches left out by rank_limit or scan_limit)
+    user_id limits the search to books on the shelf of that user
+    scan_limit caps the books read by a search the index can't serve
+    '''
+    truncated = False
+    if user_id is not None:
+        # a shelf is small: substring filter over its books, those matching by title first
+        terms = [t for t in re.split(r'\s+', q.strip()) if len(t) > 0]
+        columns = [getattr(Book, c) for c in FTS_COLUMNS]
+        query = Book.query.join(UserBook, UserBook.book_isbn == Book.isbn) \
+            .filter(UserBook.user_id == user_id, *[_like(t, columns) for t in terms]) \
+            .order_by(case((and_(*[_like(t, [Book.title]) for t in terms]), 0), else_=1), UserBook.rid)
+
+    elif _tokenizer is None:
+        query, truncated = _scan_capped(
+            Book.query.filter(*[_like(t, (Book.title, Book.author)) for t in q.split()]), scan_limit)
+        query = query.order_by(Book.isbn)
+
+    else:
+        match, short_terms = fts_terms(q)
+        if match:
+            # rank and page in the index alone, only books of the page are read
+            ranked = db.session.query(_fts.c.rowid, literal_column('rank').label('rank')) \
+                .filter(literal_column(FTS_TABLE).op('MATCH')(match))
+            if rank_limit:
+                # ranking costs per match: a query matching most of the catalog (a stop
+                # word ...) is ranked among its first rank_limit matches only
+                boundary = db.session.query(_fts.c.rowid) \
+                    .filter(literal_column(FTS_TABLE).op('MATCH')(match)) \
+                    .order_by(_fts.c.rowid).offset(rank_limit).limit(1).scalar()
+                if boundary is not None:
+                    ranked = ranked.filter(_fts.c.rowid < boundary)
+                    truncated = True
+            for t in short_terms:
+                # shorter than a trigram: substring filter of the matches
+                ranked = ranked.filter(_like(t, [_fts.c[c] for c in FTS_COLUMNS]))
+            ranked = ranked.order_by(literal_column('rank')) \
+                .offset((page - 1) * per_page).limit(per_page + 1).subquery()
+
+            rs = Book.query.join(ranked, ranked.c.rowid == Book.isbn).order_by(ranked.c.rank).all()
+            return rs[:per_page], len(rs) > per_page, truncated
+
+        columns = [getattr(Book, c) for c in FTS_COLUMNS]
+        query, truncated = _scan_capped(Book.query.filter(*[_like(t, columns) for t in short_terms]),
+                                        scan_limit)
+        query = query.order_by(Book.isbn)
+
+    rs = query.offset((page - 1) * per_page).limit(per_page + 1).all()
+    return rs[:per_page], len(rs) > per_page, truncated
@@ -0,0 +1,89 @@
+import time, asyncio, threading
+
+
+class SingleFlight(object):
+    '''coalesce concurrent calls with the same key into a single call
+
+    the first caller of a key submits fn to executor, callers arriving while
+    it runs - or within `retention` seconds after it finished - share its
+    future. a call that raised is forgotten at once, so the next caller retries.
+    '''
+
+    def __init__(self, executor, retention=0):
+        self.executor = executor
+        self.retention = retention
+        self.issued = 0
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        self._calls = {}    # key -> [future, expire time (None while running)]
+        self._next_purge = 0
+
+    def submit(self, key, fn, *args, **kwargs):
+        '''returns the future of fn(*args, **kwargs), shared by all callers of key'''
+        now = time.monotonic()
+        with self._lock:
+            if now >= self._next_purge:
+                self._purge(now)
+
+            call = self._calls.get(key)
+            if call is not None and (call[1] is None or call[1] > now):
+                self.coalesced += 1
+                return call[0]
+
+            f = self.executor.submit(fn, *args, **kwargs)
+            self._calls[key] = [f, None]
+            self.issued += 1
+
+        # outside of lock: runs at once in this thread if f is already done
+        f.add_done_callback(lambda _: self._done(key, f))
+        return f
+
+    def do(self, key, fn, *args, **kwargs):
+        '''blocking version of submit, returns result (or raises) of the shared call'''
+        return self.submit(key, fn, *args, **kwargs).result()
+
+    def forget(self, key):
+        '''drop a retained result, the next caller of key issues a new call'''
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None and call[1] is not None:
+                del self._calls[key]
+
+    def _done(self, key, f):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None or call[0] is not f:
+                return
+
+            if self.retention <= 0 or f.cancelled() or f.exception() is not None:
+                del self._calls[key]
+            else:
+                call[1] = time.monotonic() + self.retention
+
+    def _purge(self, now):
+        '''drop expired results, lock must be held'''
+        for key in [k for k, c in self._calls.items() if c[1] is not None and c[1] <= now]:
+            del self._calls[key]
+        self._next_purge = now + max(self.retention, 1)
+
+    def stats(self):
+        with self._lock:
+            in_flight = sum(1 for c in self._calls.values() if c[1] is None)
+            return {
+                'issued': self.issued,
+                'coalesced': self.coalesced,
+                'in_flight': in_flight,
+                'retained': len(self._calls) - in_flight,
+            }
+
+
+class LoopExecutor(object):
+    '''executor of coroutine functions on an asyncio event loop, usable by
+    SingleFlight from any thread: submit() returns a concurrent future
+    '''
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    def submit(self, fn, *args, **kwargs):
+        return asyncio.run_coroutine_threadsafe(fn(*args, **kwargs), self.loop)
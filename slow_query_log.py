@@ -0,0 +1,245 @@
+'''slow query log: statements slower than a threshold, as json lines
+
+    python slow_query_log.py report slow_query.log [--top 20] [--sort total|count|max] [--json]
+
+every statement of a watched engine taking at least `threshold` seconds is
+logged with its parameters, the resource (endpoint) running it and the time
+taken, writes with the rows they changed. the rows a SELECT returns are not
+logged: sqlite reports no row count for them (-1), and they're fetched only
+after the statement was timed. the first time a statement (by fingerprint:
+literals and parameter lists folded) is slow, its EXPLAIN QUERY PLAN is logged
+too, and full scans of the tables that grow with the users - user_book,
+token, check_record - are flagged. statements on the token and user tables
+are logged with literals folded and without their parameters. `report`
+aggregates a log by fingerprint, worst first.
+'''
+import re, sys, json, time, logging, argparse, threading
+from datetime import datetime
+
+from sqlalchemy import event
+
+FLAGGED_TABLES = ('user_book', 'token', 'check_record')
+# statements on these tables carry secrets or personal data (password hashes, emails)
+REDACTED_TABLES = ('token', 'revoked_token', 'user')
+
+_literal = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_in_list = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_space = re.compile(r'\s+')
+
+
+def fingerprint(statement):
+    '''statement with literals as ? and lists of parameters (IN, VALUES) folded, to group the same query'''
+    s = _space.sub(' ', statement.strip())
+    s = _literal.sub('?', s)
+    return _in_list.sub('(?, ...)', s)
+
+
+def _mentions(statement, tables):
+    return any(re.search(r'\b%s\b' % t, statement, re.IGNORECASE) for t in tables)
+
+
+def _json_value(value):
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, bytes):
+        return '<%d bytes>' % len(value)
+    value = str(value)
+    return value if len(value) <= 200 else value[:200] + '...'
+
+
+def _json_params(parameters):
+    if isinstance(parameters, dict):
+        return dict((k, _json_value(v)) for k, v in list(parameters.items())[:50])
+    if isinstance(parameters, (list, tuple)):
+        return [_json_value(v) for v in parameters[:50]]
+    return _json_value(parameters)
+
+
+def full_scans(plan, tables=FLAGGED_TABLES):
+    '''tables of plan (rows of EXPLAIN QUERY PLAN details) read by a full scan'''
+    scans = []
+    for detail in plan:
+        m = re.match(r'SCAN (?:TABLE )?(\w+)', detail)
+        if m is not None and m.group(1) in tables and m.group(1) not in scans:
+            scans.append(m.group(1))
+    return scans
+
+
+class SlowQueryLog(object):
+    '''log statements of engines slower than threshold (seconds)
+
+    lines go to path if given, otherwise to stderr
+    '''
+
+    def __init__(self, threshold=0.25, path=None, explain=True, flagged_tables=FLAGGED_TABLES,
+                 max_explained=10000):
+        self.threshold = threshold
+        self.explain = explain
+        self.flagged_tables = flagged_tables
+        self.max_explained = max_explained
+        self.logged = 0
+        self._explained = set()
+        self._lock = threading.Lock()
+
+        self.logger = logging.getLogger('slow_query.%d' % id(self))
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        handler = logging.FileHandler(path, encoding='utf-8') if path else logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.logger.addHandler(handler)
+
+    def watch_engine(self, engine):
+        def before(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('_slow_query_start', []).append(time.perf_counter())
+
+        def after(conn, cursor, statement, parameters, context, executemany):
+            elapsed = time.perf_counter() - conn.info['_slow_query_start'].pop()
+            if elapsed >= self.threshold:
+                try:
+                    self.log(conn, cursor, statement, parameters, executemany, elapsed)
+                except Exception as e:
+                    print(e)
+
+        def error(context):
+            if context.connection is not None:
+                stack = context.connection.info.get('_slow_query_start')
+                if stack:
+                    stack.pop()
+
+        event.listen(engine, 'before_cursor_execute', before)
+        event.listen(engine, 'after_cursor_execute', after)
+        event.listen(engine, 'handle_error', error)
+
+    def log(self, conn, cursor, statement, parameters, executemany, elapsed):
+        key = fingerprint(statement)
+        entry = {
+            'time': datetime.now().isoformat(timespec='milliseconds'),
+            'duration_ms': round(elapsed * 1000, 3),
+            'fingerprint': key,
+            'statement': statement,
+            'resource': _resource(),
+        }
+        if cursor.rowcount is not None and cursor.rowcount >= 0:
+            # writes only, see above
+            entry['rows_affected'] = cursor.rowcount
+        if _mentions(statement, REDACTED_TABLES):
+            # literals of a hand written statement could be secrets too
+            entry['statement'] = key
+            entry['params'] = '<redacted>'
+        elif executemany:
+            entry['params'] = '<%d rows>' % len(parameters)
+        else:
+            entry['params'] = _json_params(parameters)
+
+        if self.explain and not executemany and self._first_time(key):
+            plan = self._plan(conn, statement, parameters)
+            if plan is not None:
+                entry['plan'] = plan
+                entry['full_scans'] = full_scans(plan, self.flagged_tables)
+
+        self.logger.info(json.dumps(entry, ensure_ascii=False))
+        self.logged += 1
+
+    def _first_time(self, key):
+        with self._lock:
+            if key in self._explained or len(self._explained) >= self.max_explained:
+                return False
+            self._explained.add(key)
+            return True
+
+    def _plan(self, conn, statement, parameters):
+        if conn.dialect.name != 'sqlite':
+            return None
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            return [row[-1] for row in cursor.fetchall()]
+        except Exception as e:
+            return ['explain failed: %s' % e]
+        finally:
+            cursor.close()
+
+
+def _resource():
+    '''endpoint of the request running the statement, or the thread (background work)'''
+    try:
+        from flask import request, has_request_context
+        if has_request_context():
+            return '%s %s' % (request.method, request.endpoint)
+    except ImportError:
+        pass
+    return 'thread ' + threading.current_thread().name
+
+
+def read_log(f):
+    '''entries of a log, lines that aren't one (logger prefixes ...) skipped'''
+    for line in f:
+        start = line.find('{')
+        if start < 0:
+            continue
+        try:
+            yield json.loads(line[start:])
+        except ValueError:
+            continue
+
+
+def aggregate(entries):
+    groups = {}
+    for e in entries:
+        g = groups.get(e['fingerprint'])
+        if g is None:
+            g = groups[e['fingerprint']] = {'fingerprint': e['fingerprint'], 'durations': [],
+                                            'resources': {}, 'full_scans': [], 'plan': None}
+        g['durations'].append(e['duration_ms'])
+        g['resources'][e['resource']] = g['resources'].get(e['resource'], 0) + 1
+        if 'plan' in e and g['plan'] is None:
+            g['plan'] = e['plan']
+            g['full_scans'] = e.get('full_scans', [])
+
+    report = []
+    for g in groups.values():
+        durations = sorted(g.pop('durations'))
+        g.update(count=len(durations), total_ms=sum(durations), max_ms=durations[-1],
+                 p95_ms=durations[min(len(durations) - 1, int(0.95 * len(durations)))])
+        report.append(g)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='slow query log report')
+    commands = parser.add_subparsers(dest='command')
+    p = commands.add_parser('report', help='aggregate a log by statement fingerprint')
+    p.add_argument('file')
+    p.add_argument('--top', type=int, default=20)
+    p.add_argument('--sort', choices=['total', 'count', 'max'], default='total')
+    p.add_argument('--json', action='store_true', help='print the report as json')
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 1
+
+    with open(args.file, encoding='utf-8') as f:
+        report = aggregate(read_log(f))
+    report.sort(key=lambda g: g[args.sort + '_ms' if args.sort != 'count' else 'count'], reverse=True)
+    report = report[:args.top]
+
+    if args.json:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+        return 0
+
+    for g in report:
+        print('%6d x  total %10.1f ms  p95 %8.1f ms  max %8.1f ms%s' % (
+            g['count'], g['total_ms'], g['p95_ms'], g['max_ms'],
+            '  FULL SCAN: ' + ', '.join(g['full_scans']) if g['full_scans'] else ''))
+        print('    ' + g['fingerprint'])
+        print('    by ' + ', '.join('%s (%d)' % r for r in sorted(g['resources'].items(), key=lambda r: -r[1])))
+        for detail in g['plan'] or []:
+            print('    plan: ' + detail)
+        print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+# applied to every new connection, in this order: busy_timeout first, so that
+# switching to WAL waits for a lock held by another worker instead of failing
+DEFAULT_PRAGMAS = {
+    'busy_timeout': 5000,       # ms a writer waits for the lock before "database is locked"
+    'journal_mode': 'WAL',      # readers don't block the writer and vice versa
+    'synchronous': 'NORMAL',    # with WAL: no fsync per commit, still consistent after a crash
+    'cache_size': -16000,       # negative: KiB of page cache per connection
+    'mmap_size': 128 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+
+
+def is_sqlite(uri):
+    return uri.startswith('sqlite:')
+
+
+def is_memory(uri):
+    return uri in ('sqlite://', 'sqlite:///:memory:')
+
+
+def engine_options(uri, pool_size=5, max_overflow=5, pool_timeout=30):
+    '''engine options (e.g. SQLALCHEMY_ENGINE_OPTIONS) giving a pool of pool_size
+    connections per process, meant to be the number of threads of a worker
+    (sqlalchemy < 2.0 doesn't pool sqlite file databases at all, and opens
+    connections only the thread that opened them may use)
+    '''
+    if is_memory(uri):
+        return {}
+
+    options = {'pool_size': pool_size, 'max_overflow': max_overflow, 'pool_timeout': pool_timeout}
+    if is_sqlite(uri):
+        options['poolclass'] = QueuePool
+        # a pooled connection is handed to whichever thread checks it out next
+        options['connect_args'] = {'check_same_thread': False}
+    return options
+
+
+def tune_sqlite(engine, pragmas=None):
+    '''set pragmas on every connection engine opens, returns the listener'''
+    if engine.dialect.name != 'sqlite':
+        return None
+
+    pragmas = DEFAULT_PRAGMAS if pragmas is None else pragmas
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute('PRAGMA %s = %s' % (name, value))
+        finally:
+            cursor.close()
+
+    event.listen(engine, 'connect', set_pragmas)
+    return set_pragmas
+
+
+def current_pragmas(engine, names=None):
+    '''values of pragmas on a connection of engine, to check what's in effect'''
+    names = list(DEFAULT_PRAGMAS) if names is None else names
+    with engine.connect() as conn:
+        cursor = conn.connection.cursor()
+        try:
+            values = {}
+            for name in names:
+                cursor.execute('PRAGMA %s' % name)
+                values[name] = cursor.fetchone()[0]
+            return values
+        finally:
+            cursor.close()
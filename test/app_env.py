@@ -0,0 +1,57 @@
+'''the app on a new database in a temporary directory, for the tests of the
+resources. importing this module imports main, configured by a settings file
+of its own (FLASKR_SETTINGS), so it must be imported before main is
+'''
+import os, sys, atexit, base64, shutil, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+DIR = tempfile.mkdtemp(prefix='bookshelf-test-')
+atexit.register(shutil.rmtree, DIR, True)
+
+# records of the upstream "provider", json lines
+BOOKS_FILE = os.path.join(DIR, 'books.jsonl')
+open(BOOKS_FILE, 'w').close()
+
+with open(os.path.join(DIR, 'settings.py'), 'w') as f:
+    f.write('SQLALCHEMY_DATABASE_URI = %r\n' % ('sqlite:///' + os.path.join(DIR, 'bookshelf.db')))
+    # nothing from the network, no background writers racing the tests
+    f.write("BOOK_PROVIDERS = [{'type': 'file', 'path': %r, 'check_interval': 0}]\n" % BOOKS_FILE)
+    f.write('TOKEN_SWEEP_INTERVAL = 0\n')
+    f.write('BOOK_MISS_FLUSH_INTERVAL = 0\n')
+    f.write('SLOW_QUERY_THRESHOLD = 0\n')
+os.environ['FLASKR_SETTINGS'] = os.path.join(DIR, 'settings.py')
+
+from main import app, db
+from dao import User, Book
+
+client = app.test_client()
+
+_users = [0]
+
+
+def new_user(password='1234'):
+    '''(user id, headers with a bearer token of a new user)'''
+    _users[0] += 1
+    email = 'user%d@test.local' % _users[0]
+    with app.app_context():
+        # POST /user itself needs a token
+        user = User(email, None, 'user')
+        user.password = password
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+    auth = base64.b64encode(('%s:%s' % (email, password)).encode()).decode()
+    r = client.post('/token', headers={'Authorization': 'Basic ' + auth})
+    return user_id, {'Authorization': 'Bearer ' + r.get_json()['data']['token']}
+
+
+def add_books(isbns, **fields):
+    '''books in db, of titles "title <isbn>" unless given'''
+    with app.app_context():
+        for isbn in isbns:
+            book = Book(isbn, fields.get('title', 'title %d' % isbn), fields.get('author', 'author'))
+            for name, value in fields.items():
+                setattr(book, name, value)
+            db.session.merge(book)
+        db.session.commit()
@@ -0,0 +1,63 @@
+import os, sys, asyncio, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dao import Book
+from provider_client import ProviderError
+from book_providers import BookProvider, BookResolver
+
+
+class AsyncStub(BookProvider):
+    '''answers after delay seconds: a book, None, or ProviderError'''
+
+    def __init__(self, name, delay, answer):
+        BookProvider.__init__(self, name)
+        self.delay = delay
+        self.answer = answer
+        self.cancelled = False
+
+    async def _lookup_async(self, isbn):
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        if self.answer == 'error':
+            raise ProviderError('%s is down' % self.name)
+        return None if self.answer is None else Book(isbn, self.answer, 'author')
+
+
+class BookResolverAsyncTest(unittest.TestCase):
+    def resolve(self, resolver, isbn=9787020002207, providers=()):
+        '''(book, cancelled providers) right after resolve_async returned,
+        before asyncio.run cancels whatever is left
+        '''
+        async def run():
+            book = await resolver.resolve_async(isbn)
+            # let cancelled tasks see it
+            await asyncio.sleep(0)
+            return book, [p.name for p in providers if p.cancelled]
+        return asyncio.run(run())
+
+    def test_hedged_cancels_the_slow_one(self):
+        slow = AsyncStub('slow', 5, 'slow title')
+        fast = AsyncStub('fast', 0.01, 'fast title')
+        resolver = BookResolver([slow, fast], hedge_delay=0.05)
+
+        book, cancelled = self.resolve(resolver, providers=[slow, fast])
+        self.assertEqual(book.title, 'fast title')
+        self.assertEqual(resolver.hedged, 1)
+        self.assertEqual(cancelled, ['slow'])
+
+    def test_next_after_not_found_or_error(self):
+        resolver = BookResolver([AsyncStub('a', 0, None), AsyncStub('b', 0, 'error'),
+                                 AsyncStub('c', 0, 'title')], hedge_delay=1)
+        self.assertEqual(self.resolve(resolver)[0].title, 'title')
+
+        resolver = BookResolver([AsyncStub('a', 0, None), AsyncStub('b', 0, 'error')], hedge_delay=1)
+        with self.assertRaises(ProviderError):
+            self.resolve(resolver)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import os, sys, csv, json, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from app_env import app, db, DIR
+
+from dao import Book
+from catalog import Checkpoint, import_books, export_books, COLUMNS
+
+BASE = 9788100000000
+
+
+def records(first, n):
+    return [{'isbn': BASE + i, 'title': 'title %d' % i, 'author': 'author'} for i in range(first, first + n)]
+
+
+class CatalogTest(unittest.TestCase):
+    def setUp(self):
+        with app.app_context():
+            Book.query.filter(Book.isbn.between(BASE, BASE + 999)).delete(synchronize_session=False)
+            db.session.commit()
+
+    def write_jsonl(self, name, rs):
+        path = os.path.join(DIR, name)
+        with open(path, 'w') as f:
+            for r in rs:
+                f.write(json.dumps(r) + '\n')
+        return path
+
+    def imported(self):
+        with app.app_context():
+            return sorted(b.isbn - BASE for b in Book.query.filter(Book.isbn.between(BASE, BASE + 999)))
+
+    def title(self, isbn):
+        with app.app_context():
+            return db.session.get(Book, isbn).title
+
+    def test_resume_jsonl(self):
+        path = self.write_jsonl('resume.jsonl', records(0, 10))
+        # interrupted after a batch of 4 was committed
+        with open(path, 'rb') as f:
+            offset = sum(len(f.readline()) for _ in range(4))
+        Checkpoint(path).save(offset, 4)
+
+        with app.app_context():
+            import_books(path, 'jsonl', 3, 'upsert')
+        self.assertEqual(self.imported(), list(range(4, 10)))
+        self.assertFalse(os.path.exists(path + '.checkpoint'))
+
+    def test_resume_csv(self):
+        path = os.path.join(DIR, 'resume.csv')
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, ['isbn', 'title', 'author'])
+            writer.writeheader()
+            writer.writerows(records(0, 10))
+        Checkpoint(path).save(0, 7)
+
+        with app.app_context():
+            import_books(path, 'csv', 3, 'upsert')
+        self.assertEqual(self.imported(), [7, 8, 9])
+
+    def test_checkpoint_of_another_input(self):
+        path = self.write_jsonl('changed.jsonl', records(0, 5))
+        Checkpoint(path).save(10, 1)
+        # the file is written again: the checkpoint is stale
+        self.write_jsonl('changed.jsonl', records(0, 6))
+        os.utime(path, (1, 1))
+
+        with app.app_context():
+            import_books(path, 'jsonl', 100, 'upsert')
+        self.assertEqual(self.imported(), list(range(6)))
+
+    def test_invalid_records_and_modes(self):
+        rs = records(0, 3) + [{'isbn': 'x', 'title': 't', 'author': 'a'}, {'isbn': BASE + 9, 'title': 't'}]
+        path = self.write_jsonl('modes.jsonl', rs)
+        with open(path, 'a') as f:
+            f.write('not json\n')
+        with app.app_context():
+            import_books(path, 'jsonl', 2, 'upsert')
+        self.assertEqual(self.imported(), [0, 1, 2])
+
+        changed = [dict(r, title='new') for r in records(0, 2)]
+        with app.app_context():
+            import_books(self.write_jsonl('ignore.jsonl', changed), 'jsonl', 10, 'ignore')
+        self.assertEqual(self.title(BASE), 'title 0')
+        with app.app_context():
+            import_books(self.write_jsonl('upsert.jsonl', changed), 'jsonl', 10, 'upsert')
+        self.assertEqual(self.title(BASE), 'new')
+
+    def test_export_round_trip(self):
+        with app.app_context():
+            import_books(self.write_jsonl('export-in.jsonl', records(0, 7)), 'jsonl', 10, 'upsert')
+            path = os.path.join(DIR, 'export.jsonl')
+            export_books(path, 'jsonl', 2)
+
+        with open(path) as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual(list(rows[0]), COLUMNS)
+        isbns = [r['isbn'] for r in rows]
+        self.assertEqual(isbns, sorted(isbns))
+        self.assertEqual([r['title'] for r in rows if BASE <= r['isbn'] < BASE + 1000],
+                         ['title %d' % i for i in range(7)])
+
+
+if __name__ == '__main__':
+    unittest.main()
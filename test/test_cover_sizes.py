@@ -0,0 +1,42 @@
+import os, sys, shutil, tempfile, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dao import Book
+from cover_derivatives import CoverDerivatives, can_resize
+
+
+class CoverSizesTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def test_pic_sizes(self):
+        book = Book(9787020002207, 'title', 'author')
+        self.assertIsNone(book.pic_sizes())
+
+        book.pic = '/static/cover/9787020002207.jpg'
+        sizes = book.pic_sizes()
+        self.assertEqual(sizes['o'], '/cover/9787020002207?size=o')
+        # only sizes that are really made are listed
+        self.assertEqual(set(sizes), {'o', 's', 'm', 'l'} if can_resize() else {'o'})
+
+    def test_original(self):
+        covers = CoverDerivatives(self.dir)
+        self.assertIsNone(covers.get(9787020002207, 's'))
+
+        with open(os.path.join(self.dir, '9787020002207.png'), 'wb') as f:
+            f.write(b'not really a png')
+        path, mimetype, etag = covers.get(9787020002207, 'o')
+        self.assertEqual((path, mimetype), (os.path.join(self.dir, '9787020002207.png'), 'image/png'))
+
+        # any unknown size is the original, not an entry of its own
+        self.assertEqual(covers.get(9787020002207, 'xxl'), (path, mimetype, etag))
+        self.assertEqual(covers.stats()['known'], 1)
+
+        if not can_resize():
+            self.assertEqual(covers.get(9787020002207, 's'), (path, mimetype, etag))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os, sys, time, unittest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from app_env import app, db, client, new_user, add_books
+
+from dao import CheckRecord
+from ext_book_service import parse_job_id, LOOKUP_JOB_RETENTION
+
+
+def job_of_another_worker(isbn, started=None):
+    started = time.time() if started is None else started
+    return '%d-%d-%s' % (isbn, int(started), 'f' * 16)
+
+
+class LookupJobTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.user_id, cls.headers = new_user()
+
+    def poll(self, job, wait=0):
+        return client.get('/book/lookup/%s?wait=%s' % (job, wait), headers=self.headers)
+
+    def test_job_id_carries_isbn(self):
+        r = client.get('/book/9787000000018?async=1', headers=self.headers)
+        self.assertEqual(r.status_code, 202)
+        isbn, started = parse_job_id(r.get_json()['job'])
+        self.assertEqual(isbn, 9787000000018)
+        self.assertLessEqual(abs(started - time.time()), 5)
+
+    def test_pending_until_saved_elsewhere(self):
+        job = job_of_another_worker(9787000000020)
+        r = self.poll(job)
+        self.assertEqual(r.status_code, 202)
+        self.assertEqual(r.get_json()['job'], job)
+
+        add_books([9787000000020])
+        r = self.poll(job)
+        self.assertEqual(r.get_json()['result'], 0)
+        self.assertEqual(r.get_json()['data']['isbn'], 9787000000020)
+
+    def test_not_found_elsewhere(self):
+        started = time.time()
+        with app.app_context():
+            # a check before the job started tells nothing about it
+            record = CheckRecord(9787000000037)
+            record.last_check_time = datetime.fromtimestamp(started) - timedelta(seconds=30)
+            db.session.add(record)
+            db.session.commit()
+        job = job_of_another_worker(9787000000037, started)
+        self.assertEqual(self.poll(job).status_code, 202)
+
+        with app.app_context():
+            db.session.get(CheckRecord, 9787000000037).last_check_time = datetime.now()
+            db.session.commit()
+        self.assertEqual(self.poll(job).get_json(), {'result': -404, 'msg': 'not found'})
+
+    def test_long_poll_elsewhere(self):
+        job = job_of_another_worker(9787000000044)
+        t = time.monotonic()
+        self.assertEqual(self.poll(job, wait=0.5).status_code, 202)
+        self.assertGreaterEqual(time.monotonic() - t, 0.5)
+
+    def test_unknown_jobs(self):
+        expired = job_of_another_worker(9787000000051, time.time() - LOOKUP_JOB_RETENTION - 1)
+        for job in ('0123456789abcdef', 'a-b-c', expired):
+            self.assertEqual(self.poll(job).get_json()['msg'], 'lookup job not found')
+
+
+if __name__ == '__main__':
+    unittest.main()
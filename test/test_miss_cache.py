@@ -0,0 +1,77 @@
+import os, sys, unittest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from app_env import app, db
+
+from dao import CheckRecord
+from miss_cache import MissCache, BloomFilter, recheck_delay
+
+
+class RecheckDelayTest(unittest.TestCase):
+    def test_backoff(self):
+        self.assertEqual([recheck_delay(n, 60, 600) for n in range(1, 7)], [60, 120, 240, 480, 600, 600])
+
+    def test_no_count(self):
+        # check records older than check_count
+        self.assertEqual(recheck_delay(None, 60, 600), 60)
+        self.assertEqual(recheck_delay(0, 60, 600), 60)
+
+
+class MissCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = MissCache()
+        self.cache.configure(app, base_delay=60, max_delay=600, flush_interval=0)
+
+    def add_record(self, isbn, last_check_time, check_count):
+        with app.app_context():
+            r = CheckRecord(isbn)
+            r.last_check_time = last_check_time
+            r.check_count = check_count
+            db.session.merge(r)
+            db.session.commit()
+
+    def test_backoff(self):
+        isbn = 9787400000001
+        with app.app_context():
+            self.assertTrue(self.cache.is_due(isbn))
+            self.cache.record_miss(isbn)
+            self.cache.record_miss(isbn)
+            now = datetime.now()
+            self.assertFalse(self.cache.is_due(isbn, now + timedelta(seconds=119)))
+            self.assertTrue(self.cache.is_due(isbn, now + timedelta(seconds=121)))
+            self.assertEqual(db.session.get(CheckRecord, isbn).check_count, 2)
+
+        # read back by a process that never saw the misses
+        other = MissCache()
+        other.configure(app, base_delay=60, max_delay=600)
+        with app.app_context():
+            self.assertFalse(other.is_due(isbn, now + timedelta(seconds=119)))
+        self.assertEqual(other.stats()['db_reads'], 1)
+
+    def test_null_count(self):
+        isbn = 9787400000002
+        self.add_record(isbn, datetime.now() - timedelta(seconds=30), None)
+        with app.app_context():
+            self.assertFalse(self.cache.is_due(isbn))
+            self.assertTrue(self.cache.is_due(isbn, datetime.now() + timedelta(seconds=31)))
+            self.cache.record_miss(isbn)
+            self.assertEqual(db.session.get(CheckRecord, isbn).check_count, 1)
+
+    def test_null_time(self):
+        isbn = 9787400000003
+        self.add_record(isbn, None, 3)
+        with app.app_context():
+            self.assertTrue(self.cache.is_due(isbn))
+
+    def test_bloom(self):
+        bloom = BloomFilter(1000)
+        for isbn in range(9787500000000, 9787500001000):
+            bloom.add(isbn)
+        self.assertTrue(all(isbn in bloom for isbn in range(9787500000000, 9787500001000)))
+        false_positives = sum(isbn in bloom for isbn in range(9787600000000, 9787600010000))
+        self.assertLess(false_positives, 300)
+
+
+if __name__ == '__main__':
+    unittest.main()
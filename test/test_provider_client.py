@@ -0,0 +1,181 @@
+import os, sys, time, json, threading, unittest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from provider_client import ProviderClient, ProviderError, CircuitOpenError, LatencyHistogram, RecentStats
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    '''local provider stub
+    /ok        200 json
+    /slow      200 after `delay` seconds
+    /flaky     503 for the first `flaky` requests, then 200
+    /down      always 503
+    '''
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.delay = 0.5
+        self.flaky = 2
+        self.hits = {}
+        self.client_ports = set()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def handle_error(self, request, client_address):
+        # clients hanging up on /slow after their read timeout
+        pass
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep-alive, so connection reuse is visible
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        with self.server.lock:
+            self.server.hits[path] = self.server.hits.get(path, 0) + 1
+            self.server.client_ports.add(self.client_address[1])
+            hits = self.server.hits[path]
+
+        if path == '/slow':
+            time.sleep(self.server.delay)
+
+        if path == '/down' or (path == '/flaky' and hits <= self.server.flaky):
+            self.reply(503, b'{}')
+        else:
+            self.reply(200, json.dumps({'status': '0', 'path': path}).encode('utf-8'))
+
+    def reply(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ProviderClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def client(self, **kwargs):
+        options = dict(connect_timeout=1, read_timeout=0.2, retries=2, backoff=0.01,
+                       max_backoff=0.05, failure_threshold=3, reset_timeout=0.3)
+        options.update(kwargs)
+        return ProviderClient(**options)
+
+    def test_connections_are_reused(self):
+        client = self.client()
+        for _ in range(20):
+            self.assertEqual(client.get_json(self.server.url + '/ok')['path'], '/ok')
+
+        self.assertEqual(self.server.hits['/ok'], 20)
+        self.assertEqual(len(self.server.client_ports), 1)
+
+    def test_read_timeout_is_retried_then_fails(self):
+        client = self.client()
+        start = time.monotonic()
+        self.assertRaises(ProviderError, client.get, self.server.url + '/slow')
+
+        # 3 attempts of ~0.2s each, never the full 0.5s delay
+        self.assertLess(time.monotonic() - start, 1.2)
+        self.assertEqual(self.server.hits['/slow'], 3)
+        self.assertEqual(client.stats()['retried'], 2)
+        self.assertEqual(client.stats()['failures'], 1)
+
+    def test_transient_errors_are_retried(self):
+        client = self.client()
+        self.assertEqual(client.get_json(self.server.url + '/flaky')['path'], '/flaky')
+        self.assertEqual(self.server.hits['/flaky'], 3)
+        self.assertEqual(client.stats()['failures'], 0)
+        self.assertEqual(client.breaker.state, 'closed')
+
+    def test_circuit_breaker(self):
+        client = self.client(retries=0)
+        for _ in range(3):
+            self.assertRaises(ProviderError, client.get, self.server.url + '/down')
+        self.assertEqual(client.breaker.state, 'open')
+
+        # fails fast, upstream not called
+        self.assertRaises(CircuitOpenError, client.get, self.server.url + '/ok')
+        self.assertNotIn('/ok', self.server.hits)
+        self.assertEqual(client.stats()['short_circuited'], 1)
+
+        # after reset timeout one trial request closes the circuit again
+        time.sleep(0.35)
+        client.get(self.server.url + '/ok')
+        self.assertEqual(client.breaker.state, 'closed')
+        self.assertEqual(self.server.hits['/ok'], 1)
+
+    def test_failed_trial_reopens_circuit(self):
+        client = self.client(retries=0)
+        for _ in range(3):
+            self.assertRaises(ProviderError, client.get, self.server.url + '/down')
+
+        time.sleep(0.35)
+        self.assertRaises(ProviderError, client.get, self.server.url + '/down')
+        self.assertEqual(client.breaker.state, 'open')
+        self.assertRaises(CircuitOpenError, client.get, self.server.url + '/down')
+        self.assertEqual(self.server.hits['/down'], 4)
+
+    def test_latency_histogram(self):
+        client = self.client(read_timeout=2)
+        self.server.delay = 0.06
+        for _ in range(5):
+            client.get(self.server.url + '/slow')
+
+        latency = client.stats()['latency']
+        self.assertEqual(latency['count'], 5)
+        self.assertGreaterEqual(latency['sum'], 0.3)
+        self.assertEqual(dict(latency['buckets'])[0.05], 0)
+        self.assertEqual(dict(latency['buckets'])[float('inf')], 5)
+
+
+class LatencyHistogramTest(unittest.TestCase):
+    def test_percentile(self):
+        h = LatencyHistogram()
+        self.assertIsNone(h.percentile(0.95))
+        for _ in range(90):
+            h.observe(0.02)
+        for _ in range(10):
+            h.observe(0.7)
+
+        self.assertEqual(h.percentile(0.5), 0.025)
+        self.assertEqual(h.percentile(0.95), 1.0)
+        h.observe(60)
+        self.assertEqual(h.percentile(1.0), float('inf'))
+
+
+class RecentStatsTest(unittest.TestCase):
+    def test_old_calls_are_forgotten(self):
+        stats = RecentStats(window=0.2)
+        for _ in range(10):
+            stats.observe(3.0, error=True)
+        self.assertEqual(stats.error_rate(), 1.0)
+        self.assertEqual(stats.percentile(0.95), 5.0)
+
+        time.sleep(0.25)
+        stats.observe(0.02)
+        # previous window still counts
+        self.assertAlmostEqual(stats.error_rate(), 10 / 11.0)
+
+        time.sleep(0.45)
+        self.assertEqual(stats.error_rate(), 0.0)
+        self.assertIsNone(stats.percentile(0.95))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os, sys, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from app_env import app, db, client, new_user, add_books
+
+from search import search_books, fts_tokenizer, TRIGRAM
+
+BASE = 9787200000000
+
+
+class SearchTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        add_books([BASE + 1], title='中国历史简编', summary='通史')
+        add_books([BASE + 2], title='唐诗三百首', summary='历史上的中国诗歌')
+        add_books([BASE + 3], title='Sketching Basics', author='Kathe Kollwitz')
+        add_books([BASE + 10 + i for i in range(30)], title='common words', summary='filler')
+        cls.user_id, cls.headers = new_user()
+
+    def search(self, q, **kwargs):
+        with app.app_context():
+            rs, has_more, truncated = search_books(q, **kwargs)
+            return [b.isbn for b in rs], has_more, truncated
+
+    def test_trigram(self):
+        self.assertEqual(fts_tokenizer(), TRIGRAM)
+        # a substring in the middle of a word, title matches ranked first
+        self.assertEqual(self.search('中国')[0], [BASE + 1, BASE + 2])
+        self.assertEqual(self.search('ketch')[0], [BASE + 3])
+        self.assertEqual(self.search('kollwitz sketching')[0], [BASE + 3])
+        self.assertEqual(self.search('nothing like it')[0], [])
+
+    def test_short_terms(self):
+        # shorter than a trigram: filters the matches of the longer terms
+        self.assertEqual(self.search('唐诗三百 中国')[0], [BASE + 2])
+        # or, alone, scans the catalog
+        self.assertEqual(self.search('唐诗')[0], [BASE + 2])
+        self.assertEqual(self.search('唐诗', scan_limit=100000)[2], False)
+
+    def test_paging(self):
+        first, has_more, _ = self.search('common', per_page=20)
+        self.assertTrue(has_more)
+        second, has_more, _ = self.search('common', page=2, per_page=20)
+        self.assertFalse(has_more)
+        self.assertEqual(sorted(first + second), [BASE + 10 + i for i in range(30)])
+
+    def test_truncated(self):
+        isbns, _, truncated = self.search('common', rank_limit=5)
+        self.assertTrue(truncated)
+        self.assertEqual(len(isbns), 5)
+        self.assertFalse(self.search('common', rank_limit=30)[2])
+
+        # the short term matches a book past the first 2 of the catalog
+        isbns, _, truncated = self.search('ka', scan_limit=2)
+        self.assertTrue(truncated)
+        self.assertEqual(isbns, [])
+
+    def test_resource(self):
+        r = client.get('/books/search?q=common&per_page=5', headers=self.headers).get_json()
+        self.assertEqual((r['result'], r['page'], r['per_page'], r['has_more']), (0, 1, 5, True))
+        self.assertEqual(r['truncated'], False)
+        self.assertEqual(len(r['data']), 5)
+
+        r = client.get('/books/search?q=%E4%B8%AD%E5%9B%BD&scope=shelf', headers=self.headers).get_json()
+        self.assertEqual(r['data'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
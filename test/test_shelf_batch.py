@@ -0,0 +1,77 @@
+import os, sys, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from app_env import app, db, client, new_user, add_books
+
+from dao import UserBook, ShelfCounter, ShelfChange
+
+A, B, C, D = 9787900000002, 9787900000019, 9787900000026, 9787900000033
+UNKNOWN = 9787900000057
+
+
+class ShelfBatchTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        add_books([A, B, C, D])
+
+    def setUp(self):
+        self.user_id, self.headers = new_user()
+
+    def batch(self, **body):
+        return client.post('/shelf/books', json=body, headers=self.headers).get_json()
+
+    def shelf(self):
+        with app.app_context():
+            return sorted((ub.book_isbn, ub.comment) for ub in UserBook.query.filter_by(user_id=self.user_id))
+
+    def count(self):
+        with app.app_context():
+            return ShelfCounter.get(self.user_id)
+
+    def test_add_and_remove(self):
+        r = self.batch(add=[A, {'isbn': B, 'comment': 'gift'}, 'x', UNKNOWN])
+        self.assertEqual((r['result'], r['added'], r['removed']), (0, 2, 0))
+        self.assertEqual([i['result'] for i in r['data']['add']], [0, 0, -1, -41])
+        self.assertEqual(self.shelf(), [(A, None), (B, 'gift')])
+        self.assertEqual(self.count(), 2)
+
+        r = self.batch(add=[C], remove=[A, D, 'x'])
+        self.assertEqual((r['added'], r['removed']), (1, 1))
+        self.assertEqual([i['result'] for i in r['data']['remove']], [0, -42, -1])
+        self.assertEqual(self.shelf(), [(B, 'gift'), (C, None)])
+        self.assertEqual(self.count(), 2)
+
+        # logged for sync: one row per book ever on shelf
+        with app.app_context():
+            ops = dict((c.book_isbn, c.op) for c in ShelfChange.query.filter_by(user_id=self.user_id))
+        self.assertEqual(ops, {A: 'd', B: 'a', C: 'a'})
+
+    def test_unique(self):
+        self.batch(add=[A])
+        r = self.batch(add=[A, B, B], unique=1)
+        self.assertEqual([i['result'] for i in r['data']['add']], [-43, 0, -43])
+        self.assertEqual(self.shelf(), [(A, None), (B, None)])
+
+        # copies are kept without unique, a remove takes every copy
+        self.batch(add=[A])
+        self.assertEqual(self.count(), 3)
+        r = self.batch(remove=[A])
+        self.assertEqual(r['removed'], 2)
+        self.assertEqual(self.shelf(), [(B, None)])
+        self.assertEqual(self.count(), 1)
+
+    def test_not_removed_when_just_added(self):
+        r = self.batch(add=[A], remove=[A])
+        self.assertEqual(r['data']['remove'][0]['result'], -42)
+        self.assertEqual(self.shelf(), [(A, None)])
+
+    def test_invalid(self):
+        self.assertEqual(self.batch()['result'], -10)
+        self.assertEqual(self.batch(add=A)['result'], -10)
+        too_many = [A] * (app.config['SHELF_BATCH_MAX'] + 1)
+        self.assertEqual(self.batch(add=too_many)['result'], -11)
+        self.assertEqual(self.shelf(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import os, sys, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from app_env import app, db, client, new_user, add_books
+
+from dao import ShelfChange
+
+A, B, C = 9787800000003, 9787800000027, 9787800000034
+
+
+class ShelfChangesTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        add_books([A, B, C])
+
+    def setUp(self):
+        self.user_id, self.headers = new_user()
+        for isbn in (A, B, C):
+            self.assertEqual(client.post('/shelf/book/%d' % isbn, headers=self.headers).get_json()['result'], 0)
+
+    def changes(self, **args):
+        r = client.get('/shelf/changes', query_string=args, headers=self.headers).get_json()
+        self.assertEqual(r['result'], 0)
+        return r
+
+    def rows(self, r):
+        '''isbn -> (op, comment) of the changes of a response'''
+        fields = r['fields']
+        return dict((c[fields.index('isbn')], (c[fields.index('op')], c[fields.index('comment')]))
+                    for c in r['changes'])
+
+    def test_whole_shelf(self):
+        r = self.changes()
+        self.assertEqual(self.rows(r), {A: ('a', None), B: ('a', None), C: ('a', None)})
+        versions = [c[0] for c in r['changes']]
+        self.assertEqual(versions, sorted(versions))
+        self.assertEqual(r['version'], versions[-1])
+        self.assertFalse(r['has_more'])
+        self.assertEqual(sorted(b['isbn'] for b in r['books']), [A, B, C])
+
+    def test_compaction(self):
+        synced = self.changes()['version']
+        client.put('/shelf/book/%d' % A, json={'comment': 'first'}, headers=self.headers)
+        client.put('/shelf/book/%d' % A, json={'comment': 'second'}, headers=self.headers)
+        client.delete('/shelf/book/%d' % B, headers=self.headers)
+
+        # one row per book, its latest change
+        r = self.changes()
+        self.assertEqual(self.rows(r), {A: ('c', 'second'), B: ('d', None), C: ('a', None)})
+        self.assertEqual(sorted(b['isbn'] for b in r['books']), [A, C])
+        with app.app_context():
+            self.assertEqual(ShelfChange.query.filter_by(user_id=self.user_id).count(), 3)
+
+        # a client synced before gets the two changed books only
+        r = self.changes(since=synced)
+        self.assertEqual(self.rows(r), {A: ('c', 'second'), B: ('d', None)})
+        self.assertEqual(self.changes(since=r['version'])['changes'], [])
+
+    def test_rid_reused(self):
+        client.delete('/shelf/book/%d' % C, headers=self.headers)
+        synced = self.changes()['version']
+        # sqlite hands the rid of the newest book removed out again
+        self.assertEqual(client.post('/shelf/book/%d' % C, headers=self.headers).get_json()['result'], 0)
+
+        r = self.changes(since=synced)
+        self.assertEqual(self.rows(r), {C: ('a', None)})
+        rids = [c[2] for c in self.changes()['changes']]
+        self.assertEqual(len(rids), len(set(rids)))
+
+    def test_paging(self):
+        seen, since = [], 0
+        while True:
+            r = self.changes(since=since, limit=1, books=0)
+            self.assertNotIn('books', r)
+            seen += list(self.rows(r))
+            since = r['version']
+            if not r['has_more']:
+                break
+        self.assertEqual(seen, [A, B, C])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import os, sys, threading, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app_env import app, db, client, new_user, add_books
+from dao import ShelfCounter
+
+ISBNS = [9787000001000 + i * 10 for i in range(45)]
+
+
+class ShelfPagingTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        add_books(ISBNS)
+
+    def setUp(self):
+        self.user_id, self.headers = new_user()
+        for isbn in ISBNS:
+            self.assertEqual(client.post('/shelf/book/%d' % isbn, headers=self.headers).get_json()['result'], 0)
+
+    def page(self, **args):
+        return client.get('/shelf/book', query_string=args, headers=self.headers).get_json()
+
+    def test_pages_by_rid(self):
+        seen = []
+        rid = 0
+        while True:
+            r = self.page(rid=rid, page=20)
+            seen += [b['detail']['isbn'] for b in r['data']]
+            if not r['has_more']:
+                break
+            self.assertGreater(r['next_rid'], rid)
+            rid = r['next_rid']
+
+        self.assertEqual(seen, ISBNS)
+
+    def test_page_size_is_clamped(self):
+        for page in (0, -1, -5):
+            r = self.page(page=page)
+            self.assertEqual(r['per_page'], 1)
+            self.assertEqual(len(r['data']), 1)
+            self.assertTrue(r['has_more'])
+            self.assertGreater(r['next_rid'], 0)
+
+        self.assertEqual(self.page(page=500)['per_page'], 20)
+
+    def test_total_is_counted_once_then_maintained(self):
+        self.assertEqual(self.page(total=1)['count'], 45)
+        client.delete('/shelf/book/%d' % ISBNS[0], headers=self.headers)
+        r = self.page(total=1, page=10)
+        self.assertEqual((r['count'], r['pages']), (44, 5))
+
+    def test_concurrent_first_counts(self):
+        counts = []
+        errors = []
+
+        def count():
+            try:
+                with app.app_context():
+                    counts.append(ShelfCounter.get(self.user_id))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=count) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(counts, [45] * 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
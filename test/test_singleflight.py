@@ -0,0 +1,196 @@
+import os, sys, time, json, threading, unittest
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ext_book_service
+from dao import Book
+from singleflight import SingleFlight
+
+
+class FakeUpstream(ThreadingMixIn, HTTPServer):
+    '''local isbn service, answers /<isbn> after `delay` seconds and counts hits per isbn'''
+    daemon_threads = True
+
+    def __init__(self, delay=0.2):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeUpstreamHandler)
+        self.delay = delay
+        self.hits = {}
+        self.hits_lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+    def total_hits(self):
+        return sum(self.hits.values())
+
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        isbn = self.path.strip('/')
+        with self.server.hits_lock:
+            self.server.hits[isbn] = self.server.hits.get(isbn, 0) + 1
+        time.sleep(self.server.delay)
+
+        if isbn.startswith('err'):
+            self.send_response(500)
+            self.end_headers()
+            return
+
+        body = json.dumps({'isbn': isbn, 'title': 'title of ' + isbn}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def burst(n, fn, *args):
+    '''call fn(*args) from n threads released at the same time, returns results / exceptions'''
+    barrier = threading.Barrier(n)
+    results = [None] * n
+
+    def run(i):
+        barrier.wait()
+        try:
+            results[i] = fn(*args)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        self.upstream = FakeUpstream()
+        threading.Thread(target=self.upstream.serve_forever, daemon=True).start()
+        self.executor = ThreadPoolExecutor(max_workers=16)
+
+    def tearDown(self):
+        self.upstream.shutdown()
+        self.upstream.server_close()
+        self.executor.shutdown()
+
+    def fetch(self, key):
+        response = requests.get(self.upstream.url + key, timeout=5)
+        response.raise_for_status()
+        return response.json()
+
+    def test_concurrent_callers_share_one_fetch(self):
+        flight = SingleFlight(self.executor)
+        results = burst(64, flight.do, '9787111213826', self.fetch, '9787111213826')
+
+        self.assertEqual(self.upstream.hits, {'9787111213826': 1})
+        self.assertTrue(all(r == results[0] for r in results))
+        self.assertEqual(flight.stats()['issued'], 1)
+        self.assertEqual(flight.stats()['coalesced'], 63)
+        self.assertEqual(flight.stats()['in_flight'], 0)
+
+    def test_failure_is_shared_and_not_retained(self):
+        flight = SingleFlight(self.executor, retention=60)
+        results = burst(32, flight.do, 'err1', self.fetch, 'err1')
+
+        self.assertEqual(self.upstream.hits, {'err1': 1})
+        self.assertTrue(all(isinstance(r, requests.HTTPError) for r in results))
+
+        # nothing stranded: next caller issues a new fetch
+        self.assertRaises(requests.HTTPError, flight.do, 'err1', self.fetch, 'err1')
+        self.assertEqual(self.upstream.hits, {'err1': 2})
+        self.assertEqual(flight.stats()['retained'], 0)
+
+    def test_result_retention(self):
+        self.upstream.delay = 0
+        flight = SingleFlight(self.executor, retention=0.5)
+        flight.do('k', self.fetch, 'k')
+        flight.do('k', self.fetch, 'k')
+        self.assertEqual(self.upstream.hits, {'k': 1})
+
+        time.sleep(0.6)
+        flight.do('k', self.fetch, 'k')
+        self.assertEqual(self.upstream.hits, {'k': 2})
+        self.assertEqual(flight.stats(), {'issued': 2, 'coalesced': 1, 'in_flight': 0, 'retained': 1})
+
+        flight.forget('k')
+        flight.do('k', self.fetch, 'k')
+        self.assertEqual(self.upstream.hits, {'k': 3})
+
+    def test_waves_without_retention(self):
+        '''callers arriving right after completion must not find a stale or missing entry'''
+        self.upstream.delay = 0.01
+        flight = SingleFlight(self.executor)
+        for _ in range(20):
+            results = burst(16, flight.do, 'w', self.fetch, 'w')
+            self.assertTrue(all(r == {'isbn': 'w', 'title': 'title of w'} for r in results))
+
+        stats = flight.stats()
+        self.assertEqual(stats['issued'], self.upstream.hits['w'])
+        self.assertEqual(stats['issued'] + stats['coalesced'], 20 * 16)
+        self.assertEqual(stats['in_flight'] + stats['retained'], 0)
+
+
+class QueueToGetBookInfoTest(unittest.TestCase):
+    '''queue_to_get_book_info under bursts, query_book_from_internet replaced by the fake upstream'''
+
+    def setUp(self):
+        self.upstream = FakeUpstream(delay=0.3)
+        threading.Thread(target=self.upstream.serve_forever, daemon=True).start()
+
+        self.query_book_from_internet = ext_book_service.query_book_from_internet
+        ext_book_service.query_book_from_internet = self.fake_query
+        ext_book_service.set_query_retention(2)
+
+    def tearDown(self):
+        ext_book_service.query_book_from_internet = self.query_book_from_internet
+        ext_book_service.set_query_retention(5)
+        self.upstream.shutdown()
+        self.upstream.server_close()
+
+    def fake_query(self, isbn):
+        data = requests.get(self.upstream.url + str(isbn), timeout=5).json()
+        return Book(int(data['isbn']), data['title'], 'author')
+
+    def test_burst_of_popular_isbns(self):
+        isbns = [9787111213826 + i * 10 for i in range(8)]
+        issued = ext_book_service.query_stats()['issued']
+
+        barrier = threading.Barrier(len(isbns) * 12)
+        books = []
+
+        def run(isbn):
+            barrier.wait()
+            books.append(ext_book_service.queue_to_get_book_info(isbn))
+
+        threads = [threading.Thread(target=run, args=(isbn,)) for isbn in isbns for _ in range(12)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # late callers reuse the retained result
+        for isbn in isbns:
+            books.append(ext_book_service.queue_to_get_book_info(isbn))
+
+        self.assertEqual(self.upstream.hits, dict((str(isbn), 1) for isbn in isbns))
+        self.assertEqual(ext_book_service.query_stats()['issued'] - issued, len(isbns))
+        self.assertEqual(len(books), len(isbns) * 13)
+
+        # every caller gets its own instance, so each can add it to its own session
+        self.assertEqual(len(set(id(b) for b in books)), len(books))
+        self.assertEqual(set(b.isbn for b in books), set(isbns))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os, sys, json, shutil, tempfile, unittest
+
+from sqlalchemy import create_engine, text
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from slow_query_log import SlowQueryLog, fingerprint, full_scans, aggregate
+
+
+class SlowQueryLogTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'slow.log')
+        self.engine = create_engine('sqlite://')
+        with self.engine.begin() as conn:
+            conn.execute(text('CREATE TABLE "user" (id INTEGER PRIMARY KEY, email TEXT, hashed_password TEXT)'))
+            conn.execute(text('CREATE TABLE book (isbn INTEGER PRIMARY KEY, title TEXT)'))
+        # every statement is slow
+        self.log = SlowQueryLog(threshold=0, path=self.path)
+        self.log.watch_engine(self.engine)
+
+    def tearDown(self):
+        for handler in self.log.logger.handlers:
+            handler.close()
+        self.engine.dispose()
+        shutil.rmtree(self.dir)
+
+    def entries(self):
+        with open(self.path, encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+    def test_user_statements_are_redacted(self):
+        with self.engine.begin() as conn:
+            conn.execute(text('INSERT INTO "user" (email, hashed_password) VALUES (:email, :pwd)'),
+                         {'email': 'a@b.c', 'pwd': 'secret-hash'})
+            conn.execute(text("SELECT id FROM \"user\" WHERE email = 'a@b.c'"))
+            conn.execute(text('SELECT title FROM book WHERE isbn = :isbn'), {'isbn': 9787108041449})
+
+        with open(self.path, encoding='utf-8') as f:
+            raw = f.read()
+        self.assertNotIn('a@b.c', raw)
+        self.assertNotIn('secret-hash', raw)
+
+        entries = self.entries()
+        self.assertEqual([e['params'] for e in entries], ['<redacted>', '<redacted>', [9787108041449]])
+        self.assertEqual(entries[0]['rows_affected'], 1)
+        self.assertNotIn('rows_affected', entries[2])
+
+    def test_plan_is_logged_once_per_fingerprint(self):
+        with self.engine.begin() as conn:
+            for i in range(3):
+                conn.execute(text('SELECT title FROM book WHERE title = :t'), {'t': str(i)})
+
+        entries = self.entries()
+        self.assertEqual(len(set(e['fingerprint'] for e in entries)), 1)
+        self.assertEqual(sum(1 for e in entries if 'plan' in e), 1)
+        self.assertEqual(full_scans(entries[0]['plan'], ('book',)), ['book'])
+        self.assertEqual(aggregate(entries)[0]['count'], 3)
+
+
+class FingerprintTest(unittest.TestCase):
+    def test_literals_and_lists_are_folded(self):
+        self.assertEqual(fingerprint("SELECT * FROM book WHERE isbn IN (?, ?, ?) AND title = 'x'"),
+                         'SELECT * FROM book WHERE isbn IN (?, ...) AND title = ?')
+        self.assertEqual(fingerprint('SELECT  1\n FROM t'), 'SELECT ? FROM t')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import os, sys, base64, unittest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from app_env import app, db, client, new_user, add_books
+
+from dao import Token, User
+from auth import token_cache_stats, limit_user_tokens
+
+ISBN = 9787111111115
+
+
+def bearer(headers):
+    return headers['Authorization'].split(' ')[1]
+
+
+class TokenCacheTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        add_books([ISBN])
+
+    def get_book(self, headers):
+        return client.get('/book/%d' % ISBN, headers=headers).get_json()['result']
+
+    def test_hit(self):
+        _, headers = new_user()
+        self.assertEqual(self.get_book(headers), 0)
+        hits = token_cache_stats()['hits']
+        self.assertEqual(self.get_book(headers), 0)
+        self.assertEqual(token_cache_stats()['hits'], hits + 1)
+
+    def test_revoked(self):
+        _, headers = new_user()
+        self.assertEqual(self.get_book(headers), 0)
+        self.assertEqual(client.delete('/token', headers=headers).get_json()['result'], 0)
+        self.assertEqual(self.get_book(headers), -30)
+
+    def test_revoked_by_another_worker(self):
+        _, headers = new_user()
+        self.assertEqual(self.get_book(headers), 0)
+        # the row is gone, this process' cache never heard of it
+        with app.app_context():
+            Token.query.filter_by(token=bearer(headers)).delete()
+            db.session.commit()
+        self.assertEqual(self.get_book(headers), -30)
+
+    def test_login_cap(self):
+        user_id, first = new_user()
+        self.assertEqual(self.get_book(first), 0)
+        with app.app_context():
+            email = db.session.get(User, user_id).email
+            # expired ones are dropped too
+            db.session.add(Token('0' * 32, user_id, datetime.utcnow() - timedelta(days=8),
+                                 datetime.utcnow() - timedelta(days=1)))
+            db.session.commit()
+
+        auth = base64.b64encode(('%s:1234' % email).encode()).decode()
+        for _ in range(app.config['TOKEN_MAX_PER_USER']):
+            r = client.post('/token', headers={'Authorization': 'Basic ' + auth})
+            self.assertEqual(r.get_json()['result'], 0)
+
+        self.assertEqual(self.get_book(first), -30)
+        with app.app_context():
+            self.assertEqual(Token.query.filter_by(user_id=user_id).count(),
+                             app.config['TOKEN_MAX_PER_USER'])
+            self.assertEqual(limit_user_tokens(user_id, app.config['TOKEN_MAX_PER_USER']), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
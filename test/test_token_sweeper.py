@@ -0,0 +1,48 @@
+import os, sys, json, unittest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from app_env import app, db, client, new_user
+
+from dao import Token, RevokedToken
+from token_sweeper import TokenSweeper
+
+
+class TokenSweeperTest(unittest.TestCase):
+    def test_sweep(self):
+        user_id, headers = new_user()
+        past = datetime.utcnow() - timedelta(days=1)
+        with app.app_context():
+            for i in range(5):
+                db.session.add(Token('%032x' % (0x5eed0 + i), user_id, past - timedelta(days=7), past))
+                db.session.add(RevokedToken('sweep%d' % i, past))
+            db.session.add(RevokedToken('live', datetime.utcnow() + timedelta(days=1)))
+            db.session.commit()
+
+        sweeper = TokenSweeper(app, interval=0, batch_size=2, pause=0)
+        self.assertIsNone(sweeper.stats()['last_run_time'])
+        # expired rows of other tests may be there too
+        self.assertGreaterEqual(sweeper.sweep(), 10)
+
+        with app.app_context():
+            self.assertEqual(Token.query.filter(Token.expire_time < datetime.utcnow()).count(), 0)
+            self.assertEqual([r.jti for r in RevokedToken.query.filter(RevokedToken.jti.like('sweep%'))], [])
+            self.assertIsNotNone(db.session.get(RevokedToken, 'live'))
+        # the live token of the user is kept
+        self.assertEqual(client.delete('/token', headers=headers).get_json()['result'], 0)
+
+        stats = json.loads(json.dumps(sweeper.stats()))
+        self.assertEqual(stats['runs'], 1)
+        self.assertEqual(stats['last_removed'], stats['total_removed'])
+        self.assertLessEqual(datetime.strptime(stats['last_run_time'], '%Y-%m-%dT%H:%M:%S'), datetime.utcnow())
+        self.assertEqual(sweeper.sweep(), 0)
+
+    def test_cache_stats(self):
+        data = client.get('/stats/cache').get_json()['data']
+        self.assertEqual(set(data), {'book', 'token', 'miss', 'token_sweeper'})
+        # disabled in the tests
+        self.assertEqual(data['token_sweeper']['runs'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
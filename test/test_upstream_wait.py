@@ -0,0 +1,50 @@
+import os, sys, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from app_env import app, db, client, new_user
+
+import ext_book_service
+from db_routing import read_engine
+
+
+class PoolProbe(object):
+    '''resolver finding nothing, noting the connections checked out while it's asked'''
+
+    def __init__(self):
+        with app.app_context():
+            self.pools = read_engine().pool, db.engine.pool
+        self.checked_out = []
+
+    def resolve(self, isbn):
+        # on a thread of the lookup executor
+        self.checked_out.append(tuple(p.checkedout() for p in self.pools))
+        return None
+
+
+class UpstreamWaitTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.user_id, cls.headers = new_user()
+
+    def setUp(self):
+        self.resolver = ext_book_service._resolver
+        self.probe = PoolProbe()
+        ext_book_service.set_book_resolver(self.probe)
+
+    def tearDown(self):
+        ext_book_service.set_book_resolver(self.resolver)
+
+    def test_book(self):
+        r = client.get('/book/9787300000015', headers=self.headers)
+        self.assertEqual(r.get_json()['result'], -404)
+        self.assertEqual(self.probe.checked_out, [(0, 0)])
+
+    def test_books_lookup(self):
+        r = client.post('/books/lookup', json={'isbns': [9787300000022, 9787300000039]},
+                        headers=self.headers)
+        self.assertEqual([d['result'] for d in r.get_json()['data']], [-404, -404])
+        self.assertEqual(self.probe.checked_out, [(0, 0), (0, 0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import time, threading
+from datetime import datetime
+from sqlalchemy.exc import DatabaseError
+
+from dao import db, Token, RevokedToken
+from auth import invalidate_token
+from utils import DATETIME_FORMAT
+
+
+class TokenSweeper(object):
+    '''periodically delete expired rows of token / revoked_token
+
+    rows are deleted in small batches, each one its own short transaction,
+    so the sqlite write lock is never held for long
+    '''
+
+    def __init__(self, app, interval=600, batch_size=500, pause=0.05):
+        self.app = app
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+
+        self.runs = 0
+        self.total_removed = 0
+        self.last_removed = 0
+        self.last_duration = 0.0
+        self.last_run_time = None
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None or self.interval <= 0:
+            return
+
+        self._thread = threading.Thread(target=self._run, name='token-sweeper')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                self.app.logger.error('token sweep failed: %s', e)
+
+    def _delete_batch(self, model, key, now):
+        '''delete at most batch_size expired rows of model, returns their keys'''
+        keys = [k for (k,) in db.session.query(key)
+                .filter(model.expire_time < now).limit(self.batch_size)]
+        if len(keys) > 0:
+            try:
+                model.query.filter(key.in_(keys)).delete(synchronize_session=False)
+                db.session.commit()
+            except DatabaseError:
+                db.session.rollback()
+                raise
+
+        return keys
+
+    def sweep(self):
+        '''remove all expired rows, returns how many were deleted'''
+        start = time.monotonic()
+        now = datetime.utcnow()
+        removed = 0
+
+        with self.app.app_context():
+            for model, key in ((Token, Token.token), (RevokedToken, RevokedToken.jti)):
+                while not self._stop.is_set():
+                    keys = self._delete_batch(model, key, now)
+                    if model is Token:
+                        for k in keys:
+                            invalidate_token(k)
+
+                    removed += len(keys)
+                    if len(keys) < self.batch_size:
+                        break
+
+                    # let other writers in between two batches
+                    time.sleep(self.pause)
+
+        self.runs += 1
+        self.total_removed += removed
+        self.last_removed = removed
+        self.last_duration = time.monotonic() - start
+        self.last_run_time = now
+
+        if removed > 0:
+            self.app.logger.info('token sweep removed %d rows in %.3fs',
+                                 removed, self.last_duration)
+        return removed
+
+    def stats(self):
+        '''json serializable counters, last_run_time is utc, None before the first sweep'''
+        last_run_time = self.last_run_time
+        return {
+            'runs': self.runs,
+            'total_removed': self.total_removed,
+            'last_removed': self.last_removed,
+            'last_duration': self.last_duration,
+            'last_run_time': None if last_run_time is None else last_run_time.strftime(DATETIME_FORMAT),
+        }
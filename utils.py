@@ -1,8 +1,17 @@
-import os, hashlib, re
+import os, hashlib, re, json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 COVER_PIC_DIR = './static/cover/'
 URL_COVER_PIC_ROOT = '/static/cover/'
+URL_COVER_ROOT = '/cover/'
+
+# cover thumbnails, longest edge in px; 'o' is the original picture
+COVER_SIZES = {'s': 96, 'm': 240, 'l': 480}
 
 DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
 
@@ -16,6 +25,13 @@ email_regex = re.compile("^[a-zA-Z0-9\\+\\.\\_\\%\\-\\+]{1,256}" +\
         , re.M)
 
 
+def json_dumps(obj):
+    '''obj as utf-8 encoded json, by orjson if it's installed'''
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
 def generate_password_hash(pwd):
     '''sha256 hash of password'''
     if pwd is None or len(pwd) == 0: